@@ -0,0 +1,250 @@
+"""
+Benchmarks of the eLog client against the local ICAT+ stand-in server.
+
+run with bessyii installed (python3 -m pip install -e .)
+
+  python benchmarks/bench_eLog.py
+
+The stand-in server speaks plain http on localhost, so the pooled numbers only
+show the saved TCP handshakes. Through the proxy and TLS to ICAT the gain is larger.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+import requests
+import Levenshtein as lev
+
+import jinja2
+
+from bluesky import RunEngine, Msg
+from bluesky.preprocessors import SupplementalData
+from ophyd.sim import noisy_det, motor
+
+from bessyii.eLog import (ICATClient, InvestigationIndex, ELogCallback, ELogWriter, RetryPolicy, TemplateRegistry,
+                          writeToELog, _elog_event, _post_elog_event)
+
+# the ICAT+ stand-in server lives with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bessyii', 'test'))
+from icat_sim import IcatServer
+
+
+def posts_per_second(post, n):
+    t0 = time.perf_counter()
+    for i in range(n):
+        assert post(_elog_event(f"benchmark message {i}")) == 200
+    return n/(time.perf_counter() - t0)
+
+
+def bench_pooled_session(n=500):
+
+    """
+    posts per second with a new connection for every post (module level requests.post,
+    as the eLog functions used to do) and with the pooled keep-alive ICATClient
+    """
+    with IcatServer() as server:
+
+        def unpooled(event):
+            url = server.url + '/logbook/session/investigation/id/7645/event/create'
+            response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(event), proxies={})
+            return response.status_code
+
+        client = ICATClient(server.url, proxies={})
+
+        def pooled(event):
+            return _post_elog_event(event, 7645, 'session', client=client)
+
+        before = posts_per_second(unpooled, n)
+        after = posts_per_second(pooled, n)
+        client.close()
+
+    print(f"posts per second, new connection per post: {before:8.1f}")
+    print(f"posts per second, pooled ICATClient:       {after:8.1f}  ({after/before:.1f}x)")
+
+
+def linear_scan(investigations, part_title):
+    # the search requestInvestigationName used to run for every query
+    possible_investigations = []
+    for item in investigations:
+        title = str(item['title'])
+        id_num = str(item['name'])
+        Distance = lev.distance(title.lower(),part_title.lower())
+        Ratio = lev.ratio(title.lower(),part_title.lower())
+        if part_title in title or part_title.lower() in title.lower() or Ratio > 0.8 or Distance < 10 or part_title in id_num:
+            possible_investigations.append(item)
+    return possible_investigations
+
+
+def bench_investigation_search(n=5000, queries=50):
+
+    """
+    time per query of the Levenshtein scan and of the InvestigationIndex, for a staff
+    account with n investigations
+    """
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rng.choice(letters) for c in range(rng.randint(3, 12))) for w in range(3000)]
+    investigations = [{'id': 1000+i, 'name': f'HZB:{2015+i % 8}-{i:05d}',
+                       'title': ' '.join(rng.choice(words) for w in range(6))} for i in range(n)]
+    query_list = [' '.join(rng.sample(words, 2)) for q in range(queries)]
+
+    t0 = time.perf_counter()
+    for query in query_list:
+        linear_scan(investigations, query)
+    scan = (time.perf_counter() - t0)/queries
+
+    t0 = time.perf_counter()
+    index = InvestigationIndex(investigations)
+    build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for query in query_list:
+        index.search(query)
+    search = (time.perf_counter() - t0)/queries
+
+    print(f"{n} investigations, Levenshtein scan: {scan*1e3:8.2f} ms per query")
+    print(f"{n} investigations, trigram index:    {search*1e3:8.2f} ms per query (built once in {build*1e3:.1f} ms)")
+
+
+start_template = """
+<b> Plan Started by {{user_name}}</b>
+<br>{{- plan_name }} ['{{ uid[:6] }}'] (scan num: {{ scan_id }})
+<br>---------
+<br>{{ plan_name }}
+{% if 'plan_args' is defined %}
+    {%- for k, v in plan_args | dictsort %}
+        <br>{{ k }}: {{ v }}
+    {%-  endfor %}
+{% endif %}
+<br>---------
+<br><b>Sample</b>
+{% if sample is defined %}
+    {%- for k, v in sample | dictsort %}
+        <br>{{ k }}: {{ v }}
+    {%-  endfor %}
+{% else %}
+    <br> No Sample Given
+{% endif %}
+<hr style="height:2px;border:none;color:#333;background-color:#333;" />"""
+
+
+class _CollectingWriter:
+    # stands in for ELogWriter, to time only the work done in the callback
+    def __init__(self):
+        self.messages = []
+
+    def submit(self, message, investigation_id, uid=None):
+        self.messages.append(message)
+
+
+def bench_template_render(n=2000):
+
+    """
+    time per start document of compiling and rendering the template, of rendering
+    the template compiled once by the TemplateRegistry, and the time ELogCallback.start
+    spends in the RunEngine when rendering inline or in the writer thread
+    """
+    doc = {'uid': '3f2a9c1e-0000', 'scan_id': 42, 'plan_name': 'scan', 'user_name': 'Q. Quux', 'eLog_id_num': '7645',
+           'plan_args': {f'arg{i}': list(range(i)) for i in range(20)},
+           'sample': {'name': 'N2', 'position': 3, 'comment': 'gas cell'}}
+
+    def per_doc(func):
+        t0 = time.perf_counter()
+        for i in range(n):
+            func()
+        return (time.perf_counter() - t0)/n
+
+    registry = TemplateRegistry()
+    compile_each = per_doc(lambda: jinja2.Template(start_template).render(doc))
+    cached = per_doc(lambda: registry.from_string(start_template).render(doc))
+
+    template = registry.from_string(start_template)
+    inline = ELogCallback(None, template, template, template, writer=_CollectingWriter())
+    deferred = ELogCallback(None, template, template, template, writer=_CollectingWriter(), render_in_writer=True)
+    in_callback = per_doc(lambda: inline.start(doc))
+    in_writer = per_doc(lambda: deferred.start(doc))
+
+    print(f"compile and render per document:      {compile_each*1e6:9.1f} us")
+    print(f"render the cached template:           {cached*1e6:9.1f} us")
+    print(f"ELogCallback.start, inline rendering: {in_callback*1e6:9.1f} us")
+    print(f"ELogCallback.start, render in writer: {in_writer*1e6:9.1f} us")
+
+
+class _SyncWriter:
+    # writes in the callback, as ELogCallback did before the ELogWriter
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, message, investigation_id, uid=None):
+        writeToELog(message, investigation_id, client=self.client)
+
+
+class _TimedCallback:
+    # measures the time the RunEngine spends in the callback for each document
+    def __init__(self, callback):
+        self.callback = callback
+        self.times = []
+
+    def __call__(self, name, doc):
+        t0 = time.perf_counter()
+        self.callback(name, doc)
+        self.times.append(time.perf_counter() - t0)
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    values = sorted(values)
+    return [values[min(len(values)-1, len(values)*p//100)] if values else 0.0 for p in ps]
+
+
+def bench_callback_runs(n_runs=300, latency=0.02, jitter=0.03, error_rate=0.05, max_rate=None):
+
+    """
+    drive ELogCallback through n_runs simulated runs against a slow and unreliable
+    stand-in server, writing in the callback (as before) and through the ELogWriter.
+    Reports the time the RunEngine was blocked in the callback and the latency
+    between submit and write
+    """
+    print(f"{n_runs} runs, server latency {latency}+{jitter} s, error rate {error_rate}, max rate {max_rate}/s")
+    registry = TemplateRegistry()
+    templates = [registry.from_string(start_template),
+                 registry.from_string("<b>Beamline Status</b><br>noisy_det: {{noisy_det}}"),
+                 registry.from_string("<b>Plan ended</b> exit_status: {{exit_status}}")]
+    policy = RetryPolicy(max_attempts=10, backoff=0.01, max_backoff=0.2, max_elapsed=30, fail_fast=False)
+    plan = [Msg('open_run', plan_args={}), Msg('set', motor, 1), Msg('close_run')]
+
+    for name in ['in callback', 'ELogWriter']:
+        with IcatServer(latency=latency, jitter=jitter, error_rate=error_rate, max_rate=max_rate, seed=0) as server:
+            client = ICATClient(server.url, proxies={}, policy=policy)
+            writer = _SyncWriter(client) if name == 'in callback' else ELogWriter(policy=policy, client=client)
+            RE = RunEngine({})
+            sd = SupplementalData()
+            sd.baseline = [noisy_det]
+            RE.preprocessors.append(sd)
+            RE.md['eLog_id_num'] = '7645'
+            timed = _TimedCallback(ELogCallback(None, *templates, writer=writer))
+            RE.subscribe(timed)
+
+            t0 = time.perf_counter()
+            for i in range(n_runs):
+                RE(plan)
+            run_time = time.perf_counter() - t0
+            if name == 'ELogWriter':
+                writer.flush()
+                metrics = writer.metrics
+            client.close()
+
+        p50, p95, p99 = percentiles(timed.times)
+        print(f"  {name:12s}: RunEngine blocked {sum(timed.times):7.2f} s of {run_time:7.2f} s, "
+              f"per document p50 {p50*1e3:7.2f} ms p95 {p95*1e3:7.2f} ms p99 {p99*1e3:7.2f} ms")
+        if name == 'ELogWriter':
+            print(f"  {'':12s}  written {metrics['written']}, failed {metrics['failed']}, retries {metrics['retries']}, latency "
+                  f"p50 {metrics['p50_latency']*1e3:.1f} ms p95 {metrics['p95_latency']*1e3:.1f} ms "
+                  f"p99 {metrics['p99_latency']*1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    bench_pooled_session()
+    bench_investigation_search()
+    bench_template_render()
+    bench_callback_runs()
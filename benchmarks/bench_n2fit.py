@@ -0,0 +1,347 @@
+"""
+Benchmarks of the N2 fit on synthetic N2 1s->pi* spectra.
+
+run with bessyii installed (python3 -m pip install -e .)
+
+  python benchmarks/bench_n2fit.py
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import numpy as np
+from lmfit import Parameters
+from lmfit.models import LinearModel
+
+from scipy.special import wofz
+
+from bessyii.plans.n2fit import N2_fit, N2FitCache, RPTrendStore, SkewedVoigtPeaksModel, faddeeva_function, _jit_kernels
+
+n2 = N2_fit(None, cache=False, trend=False)
+
+centers = [400.345, 400.58, 400.805, 401.02, 401.22, 401.46, 401.68]
+amplitudes = [0.085, 0.1, 0.07, 0.04, 0.02, 0.01, 0.005]
+
+
+def n2_spectrum(n=600, sigma=0.015, gamma=0.03, skew=0.3, noise=0.0005, seed=0):
+    x = np.linspace(399.9, 402.1, n)
+    y = n2.n2_model(x, *amplitudes, *centers, sigma, gamma, skew) + 0.01
+    y += np.random.default_rng(seed).normal(0, noise, n)
+    return x, y/np.max(y)
+
+
+def composite_model(n_peaks):
+    # the model _fit_n2 built before SkewedVoigtPeaksModel
+    pars = Parameters()
+    mod = None
+    for i in range(n_peaks):
+        fit = n2.config_SkewedVoigtModel('voigt'+str(i+1), f'v{i+1}_', 400.345+0.22*i, 400+0.22*i, 401+0.22*i,
+                                         0.02, 0.001, 0.02, 0.05, 0.01, 0.03, 0, 0.0, pars)
+        mod = fit if mod is None else mod + fit
+    lin_mod = LinearModel(prefix='lin_')
+    pars.update(lin_mod.make_params(slope=0, intercept=0.01))
+    return mod + lin_mod, pars
+
+
+def fused_model(n_peaks):
+    mod = SkewedVoigtPeaksModel(n_peaks) + LinearModel(prefix='lin_')
+    composite, pars = composite_model(n_peaks)
+    fused_pars = mod.make_params()
+    for name in fused_pars:
+        fused_pars[name].set(value=pars[name].value, min=pars[name].min, max=pars[name].max)
+    return mod, fused_pars
+
+
+def per_call(f, n):
+    f()
+    t0 = time.perf_counter()
+    for i in range(n):
+        f()
+    return (time.perf_counter()-t0)/n
+
+
+def bench_model_eval(n_points=(600, 5000), n_peaks=(7, 10, 20), n=200):
+
+    """
+    time per evaluation of the composite of SkewedVoigtModels and of SkewedVoigtPeaksModel
+    """
+    for size in n_points:
+        x = np.linspace(399.9, 402.1, size)
+        for peaks in n_peaks:
+            composite, pars = composite_model(peaks)
+            fused, fused_pars = fused_model(peaks)
+            assert np.allclose(composite.eval(pars, x=x), fused.eval(fused_pars, x=x))
+            t_composite = per_call(lambda: composite.eval(pars, x=x), n)
+            t_fused = per_call(lambda: fused.eval(fused_pars, x=x), n)
+            print(f"{size:6d} points {peaks:3d} peaks: composite {t_composite*1e6:8.1f} us, "
+                  f"fused {t_fused*1e6:8.1f} us per evaluation ({t_composite/t_fused:.1f}x)")
+
+
+def bench_fit(n_fits=20, n_peaks=10):
+
+    """
+    time per fit of a synthetic N2 spectrum with the composite and the fused model,
+    with finite differences and with the analytic jacobian
+    """
+    x, y = n2_spectrum()
+    for name, make in [('composite', composite_model), ('fused', fused_model)]:
+        mod, pars = make(n_peaks)
+        for jacobian in [False, True]:
+            fit_kws = {'Dfun': n2._make_jacobian(), 'col_deriv': 1} if jacobian else None
+            t = per_call(lambda: mod.fit(y, pars, x=x, fit_kws=fit_kws), n_fits)
+            print(f"{n_peaks} peaks {name:9s} {'analytic' if jacobian else 'finite differences':18s}: {t*1e3:8.1f} ms per fit")
+
+
+
+def bench_coarse_to_fine(n_points=(2000, 10000, 50000), coarse=(4, 16), n_fits=5):
+
+    """
+    time per stage of the coarse to fine fit of a synthetic N2 spectrum, against the fit
+    of the full spectrum, and the relative difference of sigma and of the valley/peak ratio
+    """
+    for size in n_points:
+        x, y = n2_spectrum(size, noise=0.0005*np.sqrt(size/600))
+        full = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True)
+        t_full = per_call(lambda: n2.fit_spectrum(x, y, gamma=0.03, fix_param=True), n_fits)
+        for n_bin in coarse:
+            result = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, coarse=n_bin)
+            t = per_call(lambda: n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, coarse=n_bin), n_fits)
+            stages = result.stages
+            print(f"{size:6d} points, bins of {stages['coarse']['bin']:2d}: full {t_full*1e3:7.1f} ms ({full.stages['full']['nfev']} evaluations), "
+                  f"coarse {stages['coarse']['time']*1e3:6.1f} ms ({stages['coarse']['nfev']}) + "
+                  f"fine {stages['fine']['time']*1e3:6.1f} ms ({stages['fine']['nfev']} on {stages['fine']['points']} points) "
+                  f"= {t*1e3:7.1f} ms, saves {(t_full-t)*1e3:7.1f} ms ({t_full/t:.1f}x); "
+                  f"sigma {abs(result.sigma/full.sigma-1):.1e}, valley/peak {abs(result.vp_ratio/full.vp_ratio-1):.1e} relative difference")
+
+
+def loop_find_first_max(x, y, fwhm):
+    # find_first_max before it was vectorized
+    step    = x[1]-x[0]
+    ind     = int(fwhm/step/1)
+    n_steps = int(x.shape[0]/ind)
+    for i in range(n_steps):
+        if i == 0:
+            amax    = np.max(y[i*ind:i*ind+ind])
+            argmax  = np.argmax(y[i*ind:i*ind+ind])
+        else:
+            tmax    = np.max(y[i*ind:i*ind+ind])
+            targmax = np.argmax(y[i*ind:i*ind+ind]) +i*ind
+            if tmax <= amax and amax > 0.8:
+                break
+            if tmax >= amax:
+                amax = tmax
+                argmax = targmax
+    return x[argmax]
+
+
+def loop_guess_amps(x, y, vcs):
+    # guess_amp before it was vectorized, called once per peak
+    return [y[(np.abs(x - vc)).argmin()] for vc in vcs]
+
+
+def loop_RMS(data_):
+    # RMS before it was vectorized
+    sum_data = 0
+    for i in data_:
+        sum_data = sum_data + i**2
+    return np.sqrt((1/len(data_))*sum_data)
+
+
+def bench_guess_helpers(n_points=(10_000, 100_000, 1_000_000), fwhm=0.094):
+
+    """
+    time of find_first_max, guess_amp for the 9 peaks after the first and RMS, as loops and vectorized,
+    on synthetic spectra with the first max in the middle of the scan, as in long flyscans
+    """
+    for size in n_points:
+        # a long flyscan has rising background before the N2 edge
+        x = np.linspace(395, 402.1, size)
+        y = np.interp(x, *n2_spectrum(size)) + np.clip((x-395)/5, 0, 1)*0.5
+        y = y/np.max(y)
+        vcs = n2.find_first_max(x, y, fwhm) + np.array([0.235, 0.46, 0.675, 0.875, 1.115, 1.335, 1.525, 1.705, 1.895])
+        residuals = y - np.mean(y)
+        n = max(1, 100_000//size)
+        for name, loop, vectorized in [
+                ('find_first_max', lambda: loop_find_first_max(x, y, fwhm), lambda: n2.find_first_max(x, y, fwhm)),
+                ('guess_amp', lambda: loop_guess_amps(x, y, vcs), lambda: n2.guess_amp(x, y, vcs)),
+                ('RMS', lambda: loop_RMS(residuals), lambda: n2.RMS(residuals))]:
+            assert np.allclose(loop(), vectorized())
+            t_loop = per_call(loop, n)
+            t_vectorized = per_call(vectorized, n)
+            print(f"{size:8d} points {name:15s}: loop {t_loop*1e3:9.3f} ms, vectorized {t_vectorized*1e3:8.3f} ms "
+                  f"({t_loop/t_vectorized:.0f}x)")
+
+
+def bench_multistart(n_starts=8, n_bootstrap=64, workers=(1, 2, 4, 8)):
+
+    """
+    wall time of fit_multistart with n_starts starting points and n_bootstrap bootstrap fits,
+    against the number of worker processes
+    """
+    x, y = n2_spectrum(noise=0.002)
+    t_one = None
+    for max_workers in workers:
+        if max_workers > os.cpu_count():
+            print(f"{max_workers} workers: skipped, {os.cpu_count()} cpus")
+            continue
+        n2.fit_multistart(x, y, n_starts=2, max_workers=max_workers, gamma=0.03, fix_param=True)
+        t0 = time.perf_counter()
+        result = n2.fit_multistart(x, y, n_starts=n_starts, n_bootstrap=n_bootstrap, max_workers=max_workers,
+                                   gamma=0.03, fix_param=True)
+        t = time.perf_counter()-t0
+        t_one = t if t_one is None else t_one
+        low, median, high = result.intervals['sigma']
+        print(f"{max_workers} workers: {n_starts} starts + {n_bootstrap} bootstrap fits in {t:6.2f} s ({t_one/t:.1f}x), "
+              f"sigma {result.sigma:.5f} [{low:.5f}, {high:.5f}]")
+
+
+def bench_faddeeva(n_points=(600, 5000, 50000), n_peaks=10, n_fits=5):
+
+    """
+    time of the Faddeeva function, of the evaluation of 10 peaks and of the fit of a synthetic N2
+    spectrum with wofz and with the FaddeevaTable, and the largest relative difference of w(z)
+    and of sigma
+    """
+    table = faddeeva_function('table')
+    print(f"FaddeevaTable: largest relative error {table.error:.1e} at the cell corners and |z| = {table.radius}")
+    for size in n_points:
+        x, y = n2_spectrum(size, noise=0.0005*np.sqrt(size/600))
+        composite, pars = composite_model(n_peaks)
+        # the z of the peaks of the fit, with sigma 0.015 and gamma 0.03
+        z = (x[None, :] - np.array(centers + [401.87, 402.05, 402.24])[:n_peaks, None] + 0.03j)/(0.015*np.sqrt(2))
+        w = wofz(z)
+        error = np.max(np.abs(table(z) - w)/np.abs(w))
+        n = max(1, 200_000//size)
+        t_wofz = per_call(lambda: wofz(z), n)
+        t_table = per_call(lambda: table(z), n)
+        models = [SkewedVoigtPeaksModel(n_peaks, faddeeva=f) for f in (wofz, table)]
+        fused_pars = models[0].make_params()
+        for name in fused_pars:
+            fused_pars[name].set(value=pars[name].value)
+        t_eval = [per_call(lambda: mod.eval(fused_pars, x=x), n) for mod in models]
+        print(f"{size:6d} points w(z): wofz {t_wofz*1e3:7.2f} ms, table {t_table*1e3:7.2f} ms ({t_wofz/t_table:.1f}x, "
+              f"relative error {error:.1e}); {n_peaks} peaks: wofz {t_eval[0]*1e3:7.2f} ms, table {t_eval[1]*1e3:7.2f} ms "
+              f"({t_eval[0]/t_eval[1]:.1f}x)")
+        # the fit with fixed parameters, the free one stops wherever its degenerate sigma and gamma
+        # take it and is no measure of the accuracy
+        fits = {f: n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, faddeeva=f) for f in ('wofz', 'table')}
+        t = {f: per_call(lambda: n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, faddeeva=f), n_fits) for f in fits}
+        print(f"{size:6d} points fit: wofz {t['wofz']*1e3:8.1f} ms, table {t['table']*1e3:8.1f} ms "
+              f"({t['wofz']/t['table']:.1f}x), sigma {abs(fits['table'].sigma/fits['wofz'].sigma-1):.1e}, "
+              f"valley/peak {abs(fits['table'].vp_ratio/fits['wofz'].vp_ratio-1):.1e} relative difference")
+
+
+def bench_jit(n_points=(600, 5000, 50000), n_fits=5):
+
+    """
+    time of the model, of its jacobian and of the fixed parameters fit of a synthetic N2
+    spectrum with NumPy (wofz and FaddeevaTable) and with the numba kernels
+    """
+    if _jit_kernels() is None:
+        print("numba is not installed, no jit benchmark")
+        return
+    for size in n_points:
+        x, y = n2_spectrum(size, noise=0.0005*np.sqrt(size/600))
+        n = max(1, 200_000//size)
+        times = {}
+        for name, options in [('wofz', {}), ('table', {'faddeeva': 'table'}), ('jit', {'jit': True})]:
+            mod, pars, _ = n2._make_n2_model(x, y, gamma=0.03, fix_param=True, **options)
+            jacobian = n2._make_jacobian(fix_param=True, **options)
+            times[name] = (per_call(lambda: mod.eval(pars, x=x), n),
+                           per_call(lambda: jacobian(pars, y, None, x=x), n),
+                           per_call(lambda: n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, **options), n_fits))
+        print(f"{size:6d} points " + ", ".join(
+            f"{name}: model {t[0]*1e3:7.2f} ms, jacobian {t[1]*1e3:7.2f} ms, fit {t[2]*1e3:8.1f} ms "
+            f"({times['wofz'][2]/t[2]:.1f}x)" for name, t in times.items()))
+
+
+def bench_trend_store(n_rows=(1_000, 10_000, 100_000), n_appends=500, n=20):
+
+    """
+    time to record a fit in the RPTrendStore, and to query and plot RP vs cff of one grating
+    over the last 90 days, with fits of 3 years spread over 3 gratings
+    """
+    entry = {'sigma': 0.015, 'sigma_err': 0.0001, 'center': 400.8, 'RP': 11355.0, 'vp_ratio': 0.8, 'success': True}
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        store = RPTrendStore(os.path.join(directory, 'trend.sqlite'))
+        t0 = time.perf_counter()
+        for i in range(n_appends):
+            store.append(entry, f'uid{i}', start_time=time.time()-i*60, motor='pgm_en', detector='kth01',
+                         options={'fix_param': True}, config={'cff': 2.25, 'grating': '1200', 'exit_slit': 20})
+        print(f"append: {(time.perf_counter()-t0)/n_appends*1e3:.2f} ms per fit")
+        rows = n_appends
+        for size in n_rows:
+            # the older fits are written at once, as append would one by one
+            with sqlite3.connect(store.path) as connection:
+                connection.executemany('INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(f'uid{i}', 'pgm_en', 'kth01', '{}', time.time()-rng.uniform(0, 3*365*86400), time.time(),
+                      json.dumps({'cff': float(rng.choice([1.6, 2.25, 3.5, 5.0])), 'exit_slit': 20,
+                                  'grating': str(rng.choice(['400', '1200', '2400']))}),
+                      0.015, 0.0001, 400.8, rng.normal(11000, 500), 0.8, 1) for i in range(rows, size)])
+            rows = size
+            t_query = per_call(lambda: store.query(days=90, grating='1200'), n)
+            t_all = per_call(lambda: store.query(success=None), max(1, n//10))
+            t_plot = per_call(lambda: store.plot('cff', 'RP', days=90, grating='1200'), max(1, n//10))
+            plt.close('all')
+            found = len(store.query(days=90, grating='1200')['RP'])
+            print(f"{size:7d} fits: RP vs cff of the last 90 days ({found} fits) query {t_query*1e3:6.2f} ms, "
+                  f"plot {t_plot*1e3:6.1f} ms; all fits {t_all*1e3:7.1f} ms")
+
+
+class Run:
+    # the parts of a databroker run read by N2_fit.rp_map, a scan at one cff and exit slit
+    def __init__(self, i, x, y, cff, exit_slit):
+        self.metadata = {'start': {'uid': f'uid{i}', 'motors': ['pgm_en'], 'detectors': ['kth01'], 'cff': cff,
+                                   'exit_slit': exit_slit}}
+        self.primary = self
+        self._data = {'pgm_en': x, 'kth01': y}
+
+    def read(self, variables=None):
+        return self._data
+
+
+def bench_rp_map(cffs=(1.6, 2.25, 3.5, 5.0), slits=(10, 20, 30, 50), workers=(1, 2, 4, 8)):
+
+    """
+    wall time of rp_map over a cff x exit slit grid of scans against the number of worker
+    processes, and of the same map when the grid is extended by one cff, with the fits of the
+    other cells in the cache
+    """
+    grid = [(cff, slit) for cff in cffs for slit in slits]
+    db = {i: Run(i, *n2_spectrum(sigma=0.012+0.0005*i, seed=i), cff, slit) for i, (cff, slit) in enumerate(grid)}
+    t_one = None
+    for max_workers in workers:
+        if max_workers > os.cpu_count():
+            print(f"{max_workers} workers: skipped, {os.cpu_count()} cpus")
+            continue
+        with tempfile.TemporaryDirectory() as directory:
+            fit = N2_fit(db, cache=N2FitCache(os.path.join(directory, 'cache.sqlite')), trend=False)
+            t0 = time.perf_counter()
+            fit.rp_map(range(len(grid)-len(slits)), max_workers=max_workers, progress=False, gamma=0.03, fix_param=True)
+            t = time.perf_counter()-t0
+            t_one = t if t_one is None else t_one
+            t0 = time.perf_counter()
+            rp_map = fit.rp_map(range(len(grid)), max_workers=max_workers, progress=False, gamma=0.03, fix_param=True)
+            t_extended = time.perf_counter()-t0
+        print(f"{max_workers} workers: {len(grid)-len(slits)} cells in {t:6.2f} s ({t_one/t:.1f}x), "
+              f"extended by {len(slits)} cells in {t_extended:6.2f} s, "
+              f"RP {np.nanmin(rp_map.RP):.0f} to {np.nanmax(rp_map.RP):.0f}")
+
+
+if __name__ == '__main__':
+    bench_model_eval()
+    bench_fit()
+    bench_coarse_to_fine()
+    bench_guess_helpers()
+    bench_multistart()
+    bench_faddeeva()
+    bench_jit()
+    bench_trend_store()
+    bench_rp_map()
@@ -1,18 +1,520 @@
 from bessyii.locks import teardown_my_shell,lock_resource
 from getpass import getpass
-import Levenshtein as lev
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import json
 from datetime import datetime, timedelta
 from bluesky.callbacks import CallbackBase
 from pprint import pformat
 import time
+import queue
+import threading
+import atexit
+import hashlib
+import hmac
+import itertools
+import math
+import os
+import random
+import tempfile
+import uuid
+import heapq
+import weakref
+from collections import Counter, OrderedDict, defaultdict, deque
+import msgpack
+import numpy as np
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-def requestInvestigationName(username,password):
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+logger = logging.getLogger(__name__)
+
+ICAT_URL = 'https://icat.helmholtz-berlin.de/icatplus'
+ICAT_PROXIES = {"http": "http://www.bessy.de:3128", "https": "http://www.bessy.de:3128"}
+ICAT_TIMEOUT = 10
+DEFAULT_SESSION_ID = '9987e109-fc74-4e1d-8d5a-d5e518686534'
+
+# messages for the ELogWriter worker thread
+_STOP = object()
+
+
+class ICATUnavailableError(RuntimeError):
+    """ICAT+ could not be reached, or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+
+    """
+    Remember that ICAT+ is down, so that calls fail fast instead of waiting for timeouts.
+
+    After failure_threshold consecutive failures the breaker opens and no request is
+    sent for reset_timeout seconds. Then a single trial request is let through: if it
+    succeeds the breaker closes again, otherwise it stays open for another reset_timeout.
+
+    Parameters
+    ----------
+    failure_threshold: int
+        the number of consecutive failures which open the breaker
+    reset_timeout: float
+        the time in s the breaker stays open before a trial request
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened is not None
+
+    def retry_in(self):
+
+        """
+        the time in s until a request is let through again, 0 if the breaker is closed
+        """
+        with self._lock:
+            if self._opened is None:
+                return 0.0
+            return max(0.0, self._opened + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+
+        """
+        True if a request may be sent now
+        """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.monotonic() - self._opened < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                if self._opened is None:
+                    logger.warning("ICAT+ is not responding, failing fast for %s s", self.reset_timeout)
+                self._opened = time.monotonic()
+            self._trial = False
+
+    def reset(self):
+        self.record_success()
+
+
+class RetryPolicy:
+
+    """
+    How a request to ICAT+ is retried: a capped exponential backoff with jitter,
+    bounded by a number of attempts and by the total time spent.
+
+    Connection errors, timeouts and the codes in retry_codes are retried, any other
+    response is returned to the caller. Every outcome is recorded in the circuit
+    breaker of the client. While the breaker is open the call raises
+    ICATUnavailableError immediately, or, if fail_fast is False, waits for the trial
+    request as long as max_elapsed allows.
+
+    Parameters
+    ----------
+    max_attempts: int
+        the maximum number of requests sent
+    backoff: float
+        the delay in s before the first retry. It is doubled for each further retry
+    max_backoff: float
+        the upper bound in s of the delay between retries
+    max_elapsed: float
+        the maximum time in s spent in one call, including the delays
+    jitter: float
+        the fraction of each delay which is randomised, between 0 and 1
+    fail_fast: bool
+        if True raise as soon as the circuit breaker is open
+    retry_codes: tuple of int
+        the http status codes which are retried
+    """
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=10, max_elapsed=30, jitter=0.5, fail_fast=True,
+                 retry_codes=(408, 429, 500, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_elapsed = max_elapsed
+        self.jitter = jitter
+        self.fail_fast = fail_fast
+        self.retry_codes = retry_codes
+        # the number of retries made with this policy, which is shared by threads
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt):
+
+        """
+        the delay in s after the failed attempt number attempt, counting from 0
+        """
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, request, breaker=None):
+
+        """
+        call request() until it returns a response which is not retried
+
+        Parameters
+        ----------
+        request: callable
+            sends the request and returns a requests.Response
+        breaker: CircuitBreaker, optional
+
+        Returns
+        ------------
+         response : requests.Response
+
+        Raises
+        ------------
+         ICATUnavailableError
+             if the breaker is open or no response was received in time
+        """
+        if breaker is None:
+            breaker = CircuitBreaker(failure_threshold=math.inf)
+        deadline = time.monotonic() + self.max_elapsed
+        error = None
+        for attempt in range(self.max_attempts):
+            if not breaker.allow():
+                wait = breaker.retry_in()
+                if self.fail_fast or time.monotonic() + wait > deadline:
+                    raise ICATUnavailableError(f"ICAT+ is down, not retrying for {wait:.0f} s") from error
+                # retry_in is 0 while the trial request of another call is in flight, back off meanwhile
+                time.sleep(max(wait, min(self.delay(attempt), max(0.0, deadline - time.monotonic()))))
+                if not breaker.allow():
+                    error = ICATUnavailableError("ICAT+ is down, the trial request of another call is not answered yet")
+                    continue
+            try:
+                response = request()
+            except requests.RequestException as e:
+                error = e
+            else:
+                if response.status_code not in self.retry_codes:
+                    breaker.record_success()
+                    return response
+                error = requests.HTTPError(f"error code= {response.status_code}", response=response)
+            # a throttled request is retried, but the server answered so it is not down
+            if not (isinstance(error, requests.HTTPError) and error.response.status_code == 429):
+                breaker.record_failure()
+            logger.debug("ICAT+ request failed (attempt %d): %s", attempt+1, error)
+
+            delay = self.delay(attempt)
+            if attempt+1 == self.max_attempts or time.monotonic() + delay > deadline:
+                break
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+
+        raise ICATUnavailableError(f"no response from ICAT+ after {attempt+1} attempts: {error}") from error
+
+
+class ICATClient:
+
+    """
+    A connection to the ICAT+ REST API shared by all the eLog calls.
+
+    It owns a requests.Session, so the connections through the proxy are pooled and
+    kept alive instead of paying a new TCP and TLS handshake for every message.
+    Failed connection attempts are retried by the transport adapter. Requests that
+    reached the server are never resent by the adapter, so a post can't be duplicated.
+
+    Every request goes through a RetryPolicy, and all of them share the circuit breaker
+    of the client, so once ICAT+ is known to be down all the calls fail fast.
+
+    Parameters
+    ----------
+    icat_url: string, optional
+        the base url of the ICAT+ server
+    proxies: dict, optional
+        the proxies used to reach the ICAT+ server
+    timeout: float, optional
+        the timeout in s of a single request
+    pool_maxsize: int
+        the number of connections kept alive
+    connect_retries: int
+        the number of times a failed connection attempt is retried
+    policy: RetryPolicy, optional
+        the retry policy used when a request doesn't give one
+    breaker: CircuitBreaker, optional
+        the circuit breaker shared by all the requests
+    """
+
+    def __init__(self, icat_url=ICAT_URL, proxies=ICAT_PROXIES, timeout=ICAT_TIMEOUT, pool_maxsize=4, connect_retries=3,
+                 policy=None, breaker=None):
+        self.icat_url = icat_url
+        self.timeout = timeout
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        self.session.proxies.update(proxies)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        retry = Retry(total=connect_retries, connect=connect_retries, read=0, status=0, other=0,
+                      backoff_factor=0.1, allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, policy=None, **kwargs):
+
+        """
+        send a request to icat_url + path, retried according to policy
+
+        Raises
+        ------------
+         ICATUnavailableError
+             if no response was received
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.icat_url + path
+        policy = policy if policy is not None else self.policy
+        return policy.call(lambda: self.session.request(method, url, **kwargs), self.breaker)
+
+    def get(self, path, policy=None, **kwargs):
+        return self.request('GET', path, policy=policy, **kwargs)
+
+    def post(self, path, data, policy=None, **kwargs):
+        return self.request('POST', path, policy=policy, data=json.dumps(data), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+
+    """
+    the ICATClient used when none is given
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ICATClient()
+        return _default_client
+
+
+class ICATSessionCache:
+
+    """
+    A local cache of ICAT+ session ids and investigation lists, keyed by user, so that
+    logging in again (after logout_session or in a new shell) doesn't need ICAT+.
+
+    The password is never stored. A salted hash of it is kept, so that a cached session
+    is only handed to someone who types the right password. Entries expire after their
+    ttl and are then fetched again. The file is only readable by its owner.
+
+    Parameters
+    ----------
+    path: string, optional
+        the cache file. defaults to ~/.bessyii/icat_session_cache.json
+    session_ttl: float
+        the time in s a session id is reused. Keep it below the ICAT+ session lifetime
+    investigations_ttl: float
+        the time in s an investigation list is reused
+    """
+
+    def __init__(self, path=None, session_ttl=3600, investigations_ttl=3600):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bessyii', 'icat_session_cache.json')
+        self.path = path
+        self.session_ttl = session_ttl
+        self.investigations_ttl = investigations_ttl
+        self._lock = threading.Lock()
+
+    def get_session(self, username, password):
+
+        """
+        the cached session_id, full_name of the user, or None if there is no valid one
+        """
+        with self._lock:
+            entry = self._read().get(username)
+        if entry is None or 'session_id' not in entry:
+            return None
+        if time.time() - entry['session_time'] > self.session_ttl:
+            return None
+        if not hmac.compare_digest(entry['password_hash'], self._hash(password, entry['salt'])):
+            return None
+        return entry['session_id'], entry['full_name']
+
+    def put_session(self, username, password, session_id, full_name):
+        salt = os.urandom(16).hex()
+        with self._lock:
+            entries = self._read()
+            entry = entries.setdefault(username, {})
+            entry.update({'session_id': session_id, 'full_name': full_name, 'session_time': time.time(),
+                          'salt': salt, 'password_hash': self._hash(password, salt)})
+            self._write(entries)
+
+    def get_investigations(self, username):
+
+        """
+        the cached investigation list of the user, or None if there is no valid one
+        """
+        with self._lock:
+            entry = self._read().get(username)
+        if entry is None or 'investigations' not in entry:
+            return None
+        if time.time() - entry['investigations_time'] > self.investigations_ttl:
+            return None
+        return entry['investigations']
+
+    def put_investigations(self, username, investigations):
+        with self._lock:
+            entries = self._read()
+            entry = entries.setdefault(username, {})
+            entry.update({'investigations': investigations, 'investigations_time': time.time()})
+            self._write(entries)
+
+    def invalidate(self, username):
+
+        """
+        forget everything cached for the user
+        """
+        with self._lock:
+            entries = self._read()
+            if entries.pop(username, None) is not None:
+                self._write(entries)
+
+    @staticmethod
+    def _hash(password, salt):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), 100000).hex()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        # a temporary file of its own, readable only by the owner, so that shells writing
+        # at the same time each replace the cache with a whole file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+_default_cache = None
+
+
+def get_session_cache():
+
+    """
+    the ICATSessionCache used by authenticate_session when none is given
+    """
+    global _default_cache
+    with _default_client_lock:
+        if _default_cache is None:
+            _default_cache = ICATSessionCache()
+        return _default_cache
+
+
+def getInvestigations(username, password, client=None, cache=None, return_username=False):
+
+    """
+    use a username and password to request all the investigations available to the user
+
+    Parameters
+    ----------
+    username : string
+        the username like qqu
+    password : string
+        the password
+    client : ICATClient, optional
+        the connection to ICAT+, defaults to the shared one
+    cache : ICATSessionCache, optional
+        if given the session and the investigations are taken from it while they are valid.
+        They are kept under the username the session belongs to
+    return_username : bool
+        if True that username is returned as well, see getSessionID
+
+    Returns
+    ------------
+     investigations, full_name : list of dict, string
+
+         investigations as returned by ICAT+, None if they could not be retrieved
+
+         full_name is the full name of the user
+    """
+    if client is None:
+        client = get_client()
+
+    cached = cache.get_session(username, password) if cache is not None else None
+    if cached is not None:
+        session_id, full_name = cached
+    else:
+        # the user may have logged in with another username after a rejected password
+        session_id, full_name, username = getSessionID(username,password,client=client,cache=cache,
+                                                       return_username=True)
+
+    def result(investigations, full_name):
+        return (investigations, full_name, username) if return_username else (investigations, full_name)
+
+    if session_id == None:
+        return result(None, None)
+
+    if cache is not None:
+        investigations = cache.get_investigations(username)
+        if investigations is not None:
+            return result(investigations, full_name)
+
+    path = '/catalogue/'+session_id+'/investigation'
+
+    try:
+        response = client.get(path)
+        if response.status_code == 403 and cached is not None:
+            # the cached session expired on the server, log in again
+            cache.invalidate(username)
+            return getInvestigations(username, password, client=client, cache=cache, return_username=return_username)
+        response.raise_for_status()
+        investigations = json.loads(response.text)
+    except (ICATUnavailableError, requests.RequestException, ValueError) as e:
+        print(f"Could not retrieve the investigations: {e}")
+        return result(None, None)
+
+    if cache is not None:
+        cache.put_investigations(username, investigations)
+    return result(investigations, full_name)
+
+
+def requestInvestigationName(username,password,client=None,cache=None,return_username=False):
     """
     use a username and password to request all the investigations available to the user, then ask the user to select one
+    (see selectInvestigation)
 
     Parameters
     ----------
@@ -20,6 +522,12 @@ def requestInvestigationName(username,password):
         the username like qqu
     password : string
         the password
+    client : ICATClient, optional
+        the connection to ICAT+, defaults to the shared one
+    cache : ICATSessionCache, optional
+        if given the session and the investigations are taken from it while they are valid
+    return_username : bool
+        if True the username the session belongs to is returned as well, see getSessionID
         
     Returns
     ------------
@@ -32,81 +540,167 @@ def requestInvestigationName(username,password):
          id_num is the eLog id number
          
          full_name is the username of the user
+
+     title, name, id_num, full_name, username : string, string, string, string, string
+
+         with return_username
          
     """
-    session_id, full_name = getSessionID(username,password)
-    
-    if session_id == None:
-        
-        print("Authentication Failed\n")
-        return None, None, None
+    response_data, full_name, username = getInvestigations(username,password,client=client,cache=cache,
+                                                           return_username=True)
 
-    url = 'https://icat.helmholtz-berlin.de/icatplus/catalogue/'+session_id+'/investigation'
-    header = {'Content-Type': 'application/json'}
-    proxies = {"http": "http://www.bessy.de:3128", "https": "http://www.bessy.de:3128"}
+    def result(*values):
+        return (*values, username) if return_username else values
     
-    code = 403
-    while code != 200:
-        try:
-            response = requests.get(url, headers=header, proxies=proxies)
-            code = response.status_code
-            if code != 200:
-                #assumes that retrying will work and theat the session_id is valid
-                print(f"error code= {code}, retrying")
-                response.raise_for_status()
-
-            elif code == 200:
-                response_data = json.loads(response.text)
-                
+    if response_data == None:
         
-        except:
-             pass
-            
-            
+        print("Authentication Failed\n")
+        return result(None, None, None, None)
 
 
     #Request the title or some of it, or the investigation id
 
-    possible_investigations = []
-    
-    part_title = input(f"\nEnter part or all of the investigation title or ID: ")
+    investigation = selectInvestigation(response_data)
+    if investigation is None:
+        return result(None, None, None, None)
+
+    title = investigation['title']
+    name = investigation['name'].split(':')[1]
+    id_num = investigation['id']
+ 
+    return result(title, name, id_num, full_name)
+
+
+def _trigrams(text):
+    # the trigrams of every word, padded so that short words and word starts count
+    grams = set()
+    for word in text.lower().split():
+        padded = '  ' + word + ' '
+        grams.update(padded[i:i+3] for i in range(len(padded)-2))
+    return grams
+
+
+class InvestigationIndex:
+
+    """
+    A trigram index over the titles, names and ids of a list of investigations.
+
+    Build it once for a fetched list, then search it as often as needed: only the
+    investigations sharing trigrams with the query are scored, instead of comparing
+    the query to every title. If the query is found verbatim in a title, name or id only
+    those investigations are returned, otherwise they are ranked by the fraction of the
+    query trigrams they contain, which tolerates typos and words in a different order.
+    Queries of less than 3 characters, and queries without any trigram match, are looked
+    for as a substring of every title, name and id.
+
+    Parameters
+    ----------
+    investigations : list of dict
+        as returned by getInvestigations, with keys 'id', 'name' and 'title'
+    """
+
+    def __init__(self, investigations):
+        self.investigations = list(investigations)
+        self._texts = []
+        self._postings = defaultdict(list)
+        for i, item in enumerate(self.investigations):
+            text = ' '.join((str(item.get('title', '')), str(item.get('name', '')), str(item.get('id', '')))).lower()
+            self._texts.append(text)
+            for gram in _trigrams(text):
+                self._postings[gram].append(i)
+
+    def search(self, query, k=10, min_score=0.5):
+
+        """
+        the investigations best matching query
+
+        Parameters
+        ----------
+        query : string
+            part or all of the title, name or id
+        k : int
+            the maximum number of investigations returned
+        min_score : float
+            the minimum fraction of the query trigrams an investigation must contain
+
+        Returns
+        ------------
+         matches : list of (float, dict)
+             the score, from 0 to 1 (above 1 for a verbatim match), and the investigation, best first
+        """
+        query = query.strip().lower()
+        grams = _trigrams(query)
+        if not grams:
+            return []
+        counts = Counter(itertools.chain.from_iterable(self._postings.get(gram, ()) for gram in grams))
+        if len(query) < 3 or not counts:
+            # a short query inside a word shares no trigram with it
+            counts.update({i: 0 for i, text in enumerate(self._texts) if query in text and i not in counts})
+        scores = {}
+        for i, count in counts.items():
+            score = count/len(grams)
+            if query in self._texts[i]:
+                score += 1
+            if score >= min_score:
+                scores[i] = score
+        if any(score > 1 for score in scores.values()):
+            scores = {i: score for i, score in scores.items() if score > 1}
+        best = heapq.nsmallest(k, scores, key=lambda i: (-scores[i], len(self._texts[i]), i))
+        return [(scores[i], self.investigations[i]) for i in best]
+
+
+def selectInvestigation(investigations, index=None, k=10):
+
+    """
+    ask the user for part of the title or id of an investigation, and to choose among the best matches
 
-    while len(possible_investigations) == 0:
-        for item in response_data:
+    Parameters
+    ----------
+    investigations : list of dict
+        as returned by getInvestigations
+    index : InvestigationIndex, optional
+        an index already built for investigations
+    k : int
+        the maximum number of matches shown
+
+    Returns
+    ------------
+     investigation : dict
+         the selected investigation, None if the search was aborted
+    """
+    if index is None:
+        index = InvestigationIndex(investigations)
 
-            title = str(item['title'])
-            id_num = str(item['name'])
-            Distance = lev.distance(title.lower(),part_title.lower())
-            Ratio = lev.ratio(title.lower(),part_title.lower())
+    part_title = input(f"\nEnter part or all of the investigation title or ID: ")
+
+    while True:
+        possible_investigations = [item for score, item in index.search(part_title, k=k)]
 
-            if part_title in title or part_title.lower() in title.lower() or Ratio > 0.8 or Distance < 10 or part_title in id_num:
-                possible_investigations.append(item)
+        if len(possible_investigations) == 1:
+            return possible_investigations[0]
 
-        index_sel = 1
-        if len(possible_investigations) >1:
+        if len(possible_investigations) > 1:
             print(f"Here are the investigations we found ")
             for i, investigation in enumerate(possible_investigations):
                 print(f"    {i+1}. {investigation['title']}")
 
-            index_sel = int(input(f"\nWhich is the correct investigtion: "))
-        if len(possible_investigations) >=1:    
-            title = possible_investigations[index_sel-1]['title']
-            name = possible_investigations[index_sel-1]['name'].split(':')[1]
-            id_num = possible_investigations[index_sel-1]['id']
-        else:
-            print(f"\nNo Investiagtions Found")
-            part_title = input(f"\nEnter part or all of the investigation title or ID, or enter 'exit' to abort search: ") 
-            if part_title == 'exit':
-                return None, None, None
- 
-    return title, name, id_num, full_name
+            index_sel = input(f"\nWhich is the correct investigtion: ")
+            if index_sel.isdigit() and 1 <= int(index_sel) <= len(possible_investigations):
+                return possible_investigations[int(index_sel)-1]
+            print(f"\nPlease enter a number between 1 and {len(possible_investigations)}")
+            continue
 
+        print(f"\nNo Investiagtions Found")
+        part_title = input(f"\nEnter part or all of the investigation title or ID, or enter 'exit' to abort search: ") 
+        if part_title == 'exit':
+            return None
 
 
-def getSessionID(username, password):
+def getSessionID(username, password, client=None, cache=None, return_username=False):
     
     """
-    use a username and password to get a session id and the full name of the user
+    use a username and password to get a session id and the full name of the user.
+    If they are rejected the user is asked for another username and password
 
     Parameters
     ----------
@@ -114,6 +708,12 @@ def getSessionID(username, password):
         the username like qqu
     password : string
         the password
+    client : ICATClient, optional
+        the connection to ICAT+, defaults to the shared one
+    cache : ICATSessionCache, optional
+        if given a valid cached session is returned without asking ICAT+, and a new one is cached
+    return_username : bool
+        if True the username the session belongs to is returned as well
         
     Returns
     ------------
@@ -122,67 +722,79 @@ def getSessionID(username, password):
          session_id is the session id string used to authenticate an eLog session
          
          full_name is the username of the user
+
+     session_id, full_name, username : string, string, string
+
+         with return_username, username is the one which was accepted, which is not
+         the one passed in if the user had to enter another one
          
     """
-    proxies = {"http": "http://www.bessy.de:3128", "https": "http://www.bessy.de:3128"}
-    header = {'Content-Type': 'application/json'}
+    if client is None:
+        client = get_client()
+
+    def result(session_id, full_name):
+        return (session_id, full_name, username) if return_username else (session_id, full_name)
+
+    if cache is not None:
+        cached = cache.get_session(username, password)
+        if cached is not None:
+            return result(*cached)
+
     data = {"plugin":"hzbrex","username":username,"password":password}
-    session_id = None
-    full_name = None
-    code = 403
-    while code != 200:
+    while True:
         try:
-            response = requests.post('https://icat.helmholtz-berlin.de/icatplus/session', headers=header,data=json.dumps(data), proxies=proxies)
-            code = response.status_code
-            if code == 403:
-        
-                print("Authentication Failed")
-                username =str(input("username: "))
-                password = str(getpass())
-                data = {"plugin":"hzbrex","username":username,"password":password}
-                        
-            elif code != 200:
-                print(f"error code= {code}, retrying")
-                response.raise_for_status()
-
-            elif code == 200:
-                
+            response = client.post('/session', data)
+        except ICATUnavailableError as e:
+            print(f"Error requesting session ID: {e}")
+            return result(None, None)
+
+        code = response.status_code
+        if code == 403:
+    
+            print("Authentication Failed")
+            username =str(input("username: "))
+            password = str(getpass())
+            data = {"plugin":"hzbrex","username":username,"password":password}
+                    
+        elif code != 200:
+            print(f"Error requesting session ID, error code= {code}")
+            return result(None, None)
+
+        else:
+            try:
                 response_data = json.loads(response.text)
-                
                 session_id = response_data['sessionId']
                 full_name = response_data['fullName']
-                if session_id and full_name:
-                    print(f"SessionID is {session_id}, Full Name is {full_name}")
-                    return session_id, full_name
-                else:
-                    print("Error requesting session ID. Response is None. Retrying")
-        
-        except:
-             pass
+            except (ValueError, KeyError, TypeError):
+                session_id = full_name = None
+            if session_id and full_name:
+                print(f"SessionID is {session_id}, Full Name is {full_name}")
+                if cache is not None:
+                    cache.put_session(username, password, session_id, full_name)
+                return result(session_id, full_name)
+            else:
+                print("Error requesting session ID. Response is None")
+                return result(None, None)
 
 
-def writeToELog(message, investigation_id, session_id = '9987e109-fc74-4e1d-8d5a-d5e518686534'  ):
-    
+def _elog_event(message, when=None):
+
     """
-    use a username and password to write a message to a particular eLog investigation
+    build the json body of an eLog comment with the machine tag
 
     Parameters
     ----------
     message: string
-        the message to be written    
-    investigation_id:
-        the elog investigation id as returned by requestInvestigationName (id_num)
-    session_id:
-        used to authenticate. defaults to '9987e109-fc74-4e1d-8d5a-d5e518686534' 
-        
+        the message to be written
+    when: datetime, optional
+        the time of the comment, defaults to now
+
     Returns
     ------------
-     response.status_code : int
-         the http response code, 200 is good
-         
+     event : dict
+         the event, time stamped with when
     """
-    # make a new comment with the machine tag
-    now = datetime.now()-timedelta(hours=2)
+    now = (when if when is not None else datetime.now())-timedelta(hours=2)
 
     dt_string = now.strftime("%m/%d/%Y %H:%M:%S") # Note the American format.
     html_event_with_tag ={
@@ -199,37 +811,704 @@ def writeToELog(message, investigation_id, session_id = '9987e109-fc74-4e1d-8d5a
     ]
     } # The tag is used to write "machine"
 
-    #get session id
-    proxies = {"http": "http://www.bessy.de:3128", "https": "http://www.bessy.de:3128"}
-    url = 'https://icat.helmholtz-berlin.de/icatplus/logbook/' + session_id + '/investigation/id/'+ str(investigation_id)+ '/event/create'
-    header = {'Content-Type': 'application/json'}
-    data = html_event_with_tag
-    
+    return html_event_with_tag
+
+
+def _post_elog_event(event, investigation_id, session_id=DEFAULT_SESSION_ID, client=None, policy=None):
+
+    """
+    post an event built by _elog_event to an eLog investigation, retried according to policy
+
+    Returns
+    ------------
+     response.status_code : int
+         the http response code, 200 is good
+
+    Raises
+    ------------
+     ICATUnavailableError
+         if no response was received
+    """
+    if client is None:
+        client = get_client()
+    path = '/logbook/' + session_id + '/investigation/id/'+ str(investigation_id)+ '/event/create'
+    response = client.post(path, event, policy=policy)
+
+    return response.status_code
+
+
+def writeToELog(message, investigation_id, session_id = DEFAULT_SESSION_ID, client=None, writer=None, timeout=30):
     
-    code = 403
-    attempts = 0
-    while code != 200 and attempts<10:
-        try:
-            response = requests.post(url, headers=header,data=json.dumps(data), proxies=proxies)
-            code = response.status_code
-                        
-            if code != 200:
-                print(f"error code= {code}, retrying")
-                response.raise_for_status()
-
-        except:
-             attempts = attempts +1 
+    """
+    write a message to a particular eLog investigation
+
+    The message goes through the spool of the shared writer (see get_writer), so it is
+    written later if ICAT+ can not be reached now. Only if a client is given, and no
+    writer, it is posted directly and lost if ICAT+ can not be reached.
+
+    Parameters
+    ----------
+    message: string
+        the message to be written    
+    investigation_id:
+        the elog investigation id as returned by requestInvestigationName (id_num)
+    session_id:
+        used to authenticate. defaults to '9987e109-fc74-4e1d-8d5a-d5e518686534' 
+    client: ICATClient, optional
+        the connection to ICAT+ to post to directly
+    writer: ELogWriter, optional
+        the writer the message is submitted to, defaults to the shared one
+    timeout: float
+        the time in s to wait for the message to be written
         
-        time.sleep(1)
-            
-            
-    
+    Returns
+    ------------
+     response.status_code : int
+         the http response code, 200 is good. None if the message could not be written
+         within timeout, it is then written later if the writer has a spool
+         
+    """
+    if client is not None and writer is None:
+        # make a new comment with the machine tag
+        data = _elog_event(message)
+        try:
+            code = _post_elog_event(data, investigation_id, session_id, client=client)
+        except ICATUnavailableError as e:
+            print(f"Could not write to the eLog: {e}")
+            return None
+    else:
+        if writer is None:
+            writer = get_writer()
+        uid = uuid.uuid4().hex
+        code = writer.status(uid, timeout=timeout) if writer.submit(message, investigation_id, session_id, uid=uid) else None
+        if code is None:
+            kept = "it is kept in the spool and written later" if writer.spool is not None else "it is lost"
+            print(f"Could not write to the eLog within {timeout} s, {kept}")
+            return None
+
+    if code != 200:
+        print(f"error code= {code}")
+    return code
+
+
+class ELogSpool:
+
+    """
+    An append-only file of eLog posts, so that no entry is lost while ICAT is
+    unreachable or when the shell is restarted.
+
+    Every post is appended as a msgpack record before it is sent, and is marked
+    as written by appending an acknowledgement record with the same key. When the
+    spool is opened the file is read back, the posts that were never acknowledged
+    are pending again and the file is compacted. The key is the uid of the document
+    the message was rendered from, so a document is only ever posted once.
+
+    A post can also be held, to be replaced later by a post which includes it (see
+    ELogCallback with coalesce=True). Held posts are not written, unless the spool is
+    opened again with them still held, after a crash, when they are pending as they are.
+
+    Only one process can use a spool file at a time.
+
+    Parameters
+    ----------
+    path: string, optional
+        the spool file. defaults to ~/.bessyii/elog_spool.msgpack
+    fsync: bool
+        if True every append is synced to disk before it returns
+    keep_acked: int
+        the number of written keys remembered to reject duplicates
+    """
+
+    def __init__(self, path=None, fsync=True, keep_acked=10000):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bessyii', 'elog_spool.msgpack')
+        self.path = path
+        self._fsync = fsync
+        self._keep_acked = keep_acked
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._held = OrderedDict()
+        self._acked = OrderedDict()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lockfile = open(path + '.lock', 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lockfile.close()
+                raise RuntimeError(f"the eLog spool {path} is used by another process")
+
+        self._load()
+        self._compact()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def append(self, event, investigation_id, session_id, uid=None, replaces=()):
+
+        """
+        append a post to the spool
+
+        replaces are the keys of held posts this one includes, they are dropped with the
+        same write
+
+        Returns
+        ------------
+         appended : bool
+             False if a post with this uid is already in the spool or was already written
+        """
+        key = uid if uid is not None else uuid.uuid4().hex
+        record = {'op': 'post', 'key': key, 'investigation_id': str(investigation_id),
+                  'session_id': session_id, 'event': event, 'time': time.time()}
+        with self._lock:
+            appended = key not in self._pending and key not in self._acked
+            replaced = [key for key in replaces if key in self._held]
+            # the post is written before the acknowledgements, a crash in between writes the held posts twice
+            self._write(([record] if appended else []) + [{'op': 'ack', 'key': key} for key in replaced])
+            if appended:
+                self._pending[key] = record
+            for key in replaced:
+                del self._held[key]
+                self._remember(key)
+        return appended
+
+    def hold(self, event, investigation_id, session_id, uid):
+
+        """
+        append a post which is not to be written, unless the spool is opened again before
+        it is replaced (see append)
+
+        Returns
+        ------------
+         held : bool
+             False if a post with this uid is already in the spool or was already written
+        """
+        record = {'op': 'hold', 'key': uid, 'investigation_id': str(investigation_id),
+                  'session_id': session_id, 'event': event, 'time': time.time()}
+        with self._lock:
+            if uid in self._pending or uid in self._held or uid in self._acked:
+                return False
+            self._write([record])
+            self._held[uid] = record
+        return True
+
+    def pending(self, limit=None):
+
+        """
+        the posts not yet written, oldest first
+        """
+        with self._lock:
+            return list(itertools.islice(self._pending.values(), limit))
+
+    def ack(self, keys):
+
+        """
+        mark the posts with these keys as written
+        """
+        with self._lock:
+            keys = [key for key in keys if key in self._pending]
+            self._write([{'op': 'ack', 'key': key} for key in keys])
+            for key in keys:
+                del self._pending[key]
+                self._remember(key)
+            if not self._pending and self._records > 2*self._keep_acked:
+                self._compact()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                self._lockfile.close()
+
+    def _remember(self, key):
+        self._acked[key] = None
+        while len(self._acked) > self._keep_acked:
+            self._acked.popitem(last=False)
+
+    def _write(self, records):
+        if not records:
+            return
+        self._file.write(b''.join(msgpack.packb(record, use_bin_type=True) for record in records))
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+        self._records += len(records)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            # a record cut short by a crash ends the iteration
+            for record in msgpack.Unpacker(f, raw=False):
+                # the posts held by a session which did not end are written as they are
+                if record.get('op') in ('post', 'hold'):
+                    if record['key'] not in self._acked:
+                        self._pending[record['key']] = record
+                elif record.get('op') == 'ack':
+                    self._pending.pop(record['key'], None)
+                    self._remember(record['key'])
+
+    def _compact(self):
+        # rewrite the file with only the acknowledged keys, the pending and the held posts
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+        records = [{'op': 'ack', 'key': key} for key in self._acked]
+        records += list(self._pending.values()) + list(self._held.values())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for record in records:
+                f.write(msgpack.packb(record, use_bin_type=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._file = open(self.path, 'ab')
+        self._records = len(records)
+
+
+class ELogWriter:
+
+    """
+    Write to the eLog from a background thread.
+
+    Messages are put on a bounded queue by submit and posted by a worker thread,
+    so the caller (usually a callback running in the RunEngine) never waits for ICAT.
+    Failed posts are retried according to policy. A post rejected by ICAT (for
+    example with an invalid session) is not retried.
+
+    If a spool is given every message is appended to it before submit returns, and the
+    worker posts the spool in order, batch_size posts at a time. A message which can not
+    be written stays in the spool and is retried every replay_interval seconds, also
+    after a restart, so nothing is dropped while ICAT is down. Without a spool a message
+    is dropped when the queue is full or its retries run out. The writer of get_writer
+    has a spool.
+
+    Parameters
+    ----------
+    maxsize: int
+        the maximum number of messages waiting to be written. Without a spool new
+        messages are dropped when the queue is full, and counted in the metrics
+    policy: RetryPolicy, optional
+        how a post is retried before it is given up (or, with a spool, left for the
+        next replay). defaults to 10 attempts within 5 minutes, waiting while the
+        circuit breaker of the client is open
+    client: ICATClient, optional
+        the connection to ICAT+, defaults to the shared one
+    spool: ELogSpool, optional
+        the spool every message goes through
+    batch_size: int
+        the number of spooled posts written between two acknowledgements
+    replay_interval: float
+        the delay in s between two attempts to write the spool while ICAT is down
+
+    Every writer runs a thread until it is closed, so share one: get_writer returns the
+    writer used when none is given. The writers still running at exit are closed, all of
+    them within 10 s.
+    """
+
+    def __init__(self, maxsize=1000, policy=None, client=None,
+                 spool=None, batch_size=50, replay_interval=60):
+        self._queue = queue.Queue(maxsize=maxsize)
+        if policy is None:
+            policy = RetryPolicy(max_attempts=10, backoff=0.5, max_backoff=30, max_elapsed=300, fail_fast=False)
+        self._policy = policy
+        self._client = client if client is not None else get_client()
+        self._spool = spool
+        self._batch_size = batch_size
+        self._replay_interval = replay_interval
+
+        self._cond = threading.Condition()
+        # with a spool the worker is woken up by this event, the queue only holds the messages to render
+        self._wakeup = threading.Event()
+        self._pending = 0 if spool is None else len(spool)
+        self._metrics = {'submitted': 0, 'written': 0, 'failed': 0, 'dropped': 0, 'duplicates': 0,
+                         'max_latency': 0.0, 'total_latency': 0.0}
+        self._latencies = deque(maxlen=1000)
+        # the response codes of the last posts by uid, see status
+        self._codes = OrderedDict()
+
+        self._thread = threading.Thread(target=self._run, name='eLog-writer', daemon=True)
+        self._thread.start()
+        _writers.add(self)
+        if self._pending:
+            # posts left in the spool by a previous session
+            self._wake()
+
+    def submit(self, message, investigation_id, session_id=DEFAULT_SESSION_ID, uid=None, replaces=()):
+
+        """
+        queue a message for the eLog and return immediately
+
+        uid identifies the document the message was rendered from. With a spool
+        a message whose uid was already submitted is ignored. replaces are the keys of
+        the posts held in the spool which the message includes, see ELogSpool.append
+
+        message can also be a callable returning the message, which is then called in
+        the worker thread. The entry keeps the time of submit. With a spool such a message
+        is only appended to the spool once it has been rendered. It is never dropped: if
+        the queue is full it is rendered here and appended to the spool at once.
+
+        Returns
+        ------------
+         queued : bool
+             False if the message was dropped or is a duplicate
+        """
+        when = None
+        if callable(message):
+            when = datetime.now()
+            item = {'investigation_id': investigation_id, 'session_id': session_id, 'uid': uid, 'time': time.time(),
+                    'replaces': replaces, 'render': message, 'when': when}
+            if self._queue_item(item):
+                self._wake()
+                return True
+            if self._spool is None:
+                return False
+            try:
+                message = message()
+            except Exception:
+                logger.exception("could not render an eLog message")
+                with self._cond:
+                    self._metrics['failed'] += 1
+                return False
+
+        if self._spool is not None:
+            event = _elog_event(message, when)
+            if not self._spool.append(event, investigation_id, session_id, uid=uid, replaces=replaces):
+                with self._cond:
+                    self._metrics['duplicates'] += 1
+                return False
+            with self._cond:
+                self._metrics['submitted'] += 1
+                self._pending += 1
+            self._wake()
+            return True
+
+        item = {'investigation_id': investigation_id, 'session_id': session_id, 'uid': uid, 'time': time.time(),
+                'replaces': replaces, 'event': _elog_event(message)}
+        return self._queue_item(item)
+
+    def _queue_item(self, item):
+        # without a spool a message which does not fit in the queue is dropped, with a spool submit spools it
+        with self._cond:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                if self._spool is None:
+                    self._metrics['dropped'] += 1
+                    logger.warning("eLog queue is full, dropping message for investigation %s", item['investigation_id'])
+                else:
+                    logger.info("eLog queue is full, rendering the message in the caller")
+                return False
+            self._metrics['submitted'] += 1
+            self._pending += 1
+        return True
+
+    def flush(self, timeout=None):
+
+        """
+        wait until all queued messages have been written (or, without a spool, given up)
+
+        Returns
+        ------------
+         done : bool
+             False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def close(self, timeout=None):
+
+        """
+        flush the queue and stop the worker thread. Messages left in a spool are written next time
+        """
+        if not self._thread.is_alive():
+            return
+        self.flush(timeout=timeout)
+        self._queue.put(_STOP)
+        self._wake()
+        self._thread.join(timeout=timeout)
+        if self._spool is not None and not self._thread.is_alive():
+            self._spool.close()
+
+    def status(self, uid, timeout=None):
+
+        """
+        wait until the message submitted with uid is written or given up
+
+        Returns
+        ------------
+         code : int
+             the http response code, 200 is good. None if the message was not sent
+             within timeout, or could not be sent
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: uid in self._codes, timeout=timeout)
+            return self._codes.get(uid)
+
+    @property
+    def spool(self):
+
+        """
+        the ELogSpool every message goes through, or None
+        """
+        return self._spool
+
+    @property
+    def metrics(self):
+
+        """
+        a snapshot of the writer counters, the number of pending messages and the latency in s between submit and write.
+        The latency percentiles are those of the last 1000 messages written
+        """
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics['pending'] = self._pending
+            latencies = sorted(self._latencies)
+        for p in (50, 95, 99):
+            metrics[f'p{p}_latency'] = latencies[min(len(latencies)-1, len(latencies)*p//100)] if latencies else 0.0
+        metrics['retries'] = self._policy.retries
+        metrics['mean_latency'] = metrics['total_latency']/metrics['written'] if metrics['written'] else 0.0
+        return metrics
+
+    def _wake(self):
+        # wake-ups while the worker is busy are coalesced into one
+        if self._spool is not None:
+            self._wakeup.set()
+
+    def _done(self, item, written, code=None):
+        with self._cond:
+            key = item.get('key', item.get('uid'))
+            if key is not None:
+                self._codes[key] = code
+                while len(self._codes) > 1000:
+                    self._codes.popitem(last=False)
+            if written:
+                latency = time.time() - item['time']
+                self._metrics['written'] += 1
+                self._metrics['total_latency'] += latency
+                self._metrics['max_latency'] = max(self._metrics['max_latency'], latency)
+                self._latencies.append(latency)
+            else:
+                self._metrics['failed'] += 1
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def _run(self):
+        if self._spool is not None:
+            return self._run_spool()
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            code = None
+            try:
+                self._render(item)
+                code = self._post(item)
+            except ICATUnavailableError as e:
+                logger.warning("giving up writing to eLog investigation %s: %s", item['investigation_id'], e)
+            except Exception:
+                logger.exception("unexpected error in the eLog writer")
+            self._done(item, code == 200, code)
+
+    def _run_spool(self):
+        # render the queued messages into the spool and write the spool, at once when woken up
+        # and every replay_interval. While ICAT is down the spool is only written again after
+        # replay_interval, however many messages arrive
+        retry_at = 0
+        while True:
+            self._wakeup.wait(timeout=max(0, retry_at - time.monotonic()) if retry_at else self._replay_interval)
+            self._wakeup.clear()
+            stop = False
+            try:
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop = True
+                        continue
+                    self._spool_rendered(item)
+                if time.monotonic() >= retry_at:
+                    retry_at = 0 if self._replay() else time.monotonic() + self._replay_interval
+            except Exception:
+                logger.exception("unexpected error in the eLog writer")
+            if stop:
+                return
+
+    def _render(self, item):
+        if 'render' in item:
+            item['event'] = _elog_event(item.pop('render')(), item.pop('when'))
+
+    def _spool_rendered(self, item):
+        # render a message submitted as a callable and append it to the spool
+        try:
+            self._render(item)
+            appended = self._spool.append(item['event'], item['investigation_id'], item['session_id'], uid=item['uid'],
+                                          replaces=item['replaces'])
+        except Exception:
+            logger.exception("could not render an eLog message")
+            self._done(item, False)
+            return
+        if not appended:
+            with self._cond:
+                self._metrics['submitted'] -= 1
+                self._metrics['duplicates'] += 1
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def _replay(self):
+        # write the spool in order, stop while ICAT is unavailable so that the order is kept.
+        # False if ICAT is unavailable
+        while True:
+            batch = self._spool.pending(self._batch_size)
+            if not batch:
+                return True
+            done = []
+            try:
+                for record in batch:
+                    done.append((record, self._post(record)))
+            except ICATUnavailableError as e:
+                logger.warning("could not write to eLog investigation %s, %d posts kept in the spool: %s",
+                               record['investigation_id'], len(self._spool) - len(done), e)
+                return False
+            finally:
+                self._spool.ack([record['key'] for record, code in done])
+                for record, code in done:
+                    self._done(record, code == 200, code)
+
+    def _post(self, item):
+        # the response code, 200 if written. Raises ICATUnavailableError if it may work later
+        code = _post_elog_event(item['event'], item['investigation_id'], item['session_id'], client=self._client,
+                                policy=self._policy)
+        if code != 200:
+            logger.warning("eLog investigation %s rejected a post, error code= %s", item['investigation_id'], code)
+        return code
+
+
+_default_writer = None
+# not the client lock, the writer gets the default client
+_default_writer_lock = threading.Lock()
+# the writers running, closed at exit
+_writers = weakref.WeakSet()
+
+
+def get_writer():
+
+    """
+    the ELogWriter used by ELogCallback and writeToELog when none is given, started on
+    first use. Every message goes through its spool in ~/.bessyii, so none is lost while
+    ICAT+ is down or when the shell is restarted
+    """
+    global _default_writer
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = ELogWriter(spool=_open_default_spool())
+        return _default_writer
+
+
+def _open_default_spool():
+    # a spool file per shell running at the same time, the next shell to open
+    # one of them writes what a shell which crashed left in it
+    directory = os.path.join(os.path.expanduser('~'), '.bessyii')
+    for n in range(100):
+        try:
+            return ELogSpool(os.path.join(directory, 'elog_spool.msgpack' if n == 0 else f'elog_spool-{n}.msgpack'))
+        except RuntimeError:
+            continue
+    raise RuntimeError(f"all the eLog spools in {directory} are used by other processes")
+
+
+@atexit.register
+def _close_writers(timeout=10):
+    # the queued messages of all the writers are written within timeout s in all
+    deadline = time.monotonic() + timeout
+    for writer in list(_writers):
+        writer.close(timeout=max(0, deadline - time.monotonic()))
 
-    return response.status_code
 
 ########### -------- Callbacks
 
 
+class TemplateRegistry:
+
+    """
+    Load the eLog templates from files, compile each one once and compile it again
+    when its file changes, so templates can be edited while the shell is running.
+
+    instantiate with
+
+      registry = TemplateRegistry()
+      template = registry.get('~/templates/start.html')
+
+    Parameters
+    ----------
+    check_interval: float
+        the minimum time in s between two checks of a file for changes
+    environment_options:
+        passed to jinja2.Environment
+    """
+
+    def __init__(self, check_interval=2, **environment_options):
+        if jinja2 is None:
+            raise ImportError("the TemplateRegistry needs jinja2")
+        self.check_interval = check_interval
+        self.environment = jinja2.Environment(**environment_options)
+        self._lock = threading.Lock()
+        self._files = {}
+        self._strings = {}
+
+    def get(self, path):
+
+        """
+        the compiled template in the file path
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and now - entry['checked'] < self.check_interval:
+                return entry['template']
+            mtime = os.stat(path).st_mtime_ns
+            if entry is None or entry['mtime'] != mtime:
+                with open(path) as f:
+                    template = self.environment.from_string(f.read())
+                entry = {'template': template, 'mtime': mtime}
+                self._files[path] = entry
+            entry['checked'] = now
+            return entry['template']
+
+    def from_string(self, source):
+
+        """
+        the compiled template of source, compiled only the first time
+        """
+        with self._lock:
+            template = self._strings.get(source)
+            if template is None:
+                template = self._strings[source] = self.environment.from_string(source)
+            return template
+
+
+_default_registry = None
+
+
+def get_template_registry():
+
+    """
+    the TemplateRegistry used by ELogCallback when none is given
+    """
+    global _default_registry
+    with _default_client_lock:
+        if _default_registry is None:
+            _default_registry = TemplateRegistry()
+        return _default_registry
+
+
+
+
 class ELogCallback(CallbackBase):
 
     """
@@ -237,9 +1516,37 @@ class ELogCallback(CallbackBase):
     
     If the start document doesn't contain a key 'eLog_id_num' nothing is written and the callback does nothing
     
+    The rendered messages are handed to an ELogWriter, so the RunEngine does not wait for ICAT.
+    The callbacks share the writer of get_writer, whose spool keeps every message until it is
+    written. Pass writer to configure it, for example with another retry policy:
+
+      RE.subscribe(ELogCallback(db, start_template, baseline_template, stop_template,
+                                writer=ELogWriter(policy=RetryPolicy(max_attempts=3), spool=ELogSpool())))
+
+    With coalesce=True the start, baseline and stop messages of a run are joined into
+    one eLog entry written at stop. A long run writes what it has collected once the
+    first message waiting is older than max_delay seconds, or the messages waiting
+    are longer than max_size characters. The rest follows in further entries. If the
+    writer has a spool the messages waiting are held in it, so that they are written
+    after a crash, except those rendered in the writer (see below).
+
+    With baseline_diff=True the first baseline written to an investigation is rendered
+    in full, later ones only with the signals which changed by more than their tolerance
+    since they were last written. If nothing changed no baseline is written. The
+    baseline template should then test its variables with "is defined", or loop over them.
+    tolerances maps signal names to the absolute change ignored, default_tolerance is
+    used for the others.
+
+    The templates are compiled jinja2 templates, or paths to template files which are
+    compiled by a TemplateRegistry and reloaded when they change. With
+    render_in_writer=True the templates are rendered in the writer thread instead
+    of the RunEngine. max_size then only counts the messages rendered in the callback.
 
     """
-    def __init__(self,db,start_template,baseline_template,stop_template):
+    def __init__(self,db,start_template,baseline_template,stop_template,writer=None,
+                 coalesce=False,max_delay=600,max_size=100000,
+                 baseline_diff=False,tolerances=None,default_tolerance=0,
+                 registry=None,render_in_writer=False):
         self._descriptors = {}
         self._baseline_toggle = True
         self._eLog_id_num = None
@@ -247,12 +1554,33 @@ class ELogCallback(CallbackBase):
         self._start_template = start_template
         self._baseline_template = baseline_template
         self._stop_template = stop_template
+        self._writer = writer if writer is not None else get_writer()
+        self._coalesce = coalesce
+        self._max_delay = max_delay
+        self._max_size = max_size
+        self._fragments = []
+        self._fragments_size = 0
+        self._fragments_time = None
+        self._held = []
+        self._timer = None
+        # the messages waiting are also written by the max_delay timer
+        self._lock = threading.RLock()
+        self._run_uid = None
+        self._part = 0
+        self._baseline_diff = baseline_diff
+        self._tolerances = tolerances if tolerances is not None else {}
+        self._default_tolerance = default_tolerance
+        self._last_baseline = {}
+        self._registry = registry
+        self._render_in_writer = render_in_writer
 
     def start(self, doc):
         
         if 'eLog_id_num' in doc:
             self._eLog_id_num = doc['eLog_id_num']
-            writeToELog(self._start_template.render(doc),self._eLog_id_num)
+            self._run_uid = doc['uid']
+            self._part = 0
+            self._write(self._render(self._start_template, doc), doc['uid'])
             
     def descriptor(self, doc):
         self._descriptors[doc['uid']] = doc
@@ -268,7 +1596,9 @@ class ELogCallback(CallbackBase):
                 
                 if self._eLog_id_num != None:
                     
-                    writeToELog(self._baseline_template.render(doc['data']),self._eLog_id_num)
+                    data = self._baseline_changes(doc['data']) if self._baseline_diff else doc['data']
+                    if data:
+                        self._write(self._render(self._baseline_template, data), doc['uid'])
                
             
         # Do something
@@ -278,25 +1608,123 @@ class ELogCallback(CallbackBase):
         
             
         if self._eLog_id_num != None:
-            writeToELog(self._stop_template.render(doc),self._eLog_id_num)
-            self._eLog_id_num = None
+            with self._lock:
+                self._write(self._render(self._stop_template, doc), doc['uid'])
+                self._flush()
+                self._eLog_id_num = None
                 
 
+    def _template(self, template):
+        if isinstance(template, str):
+            if self._registry is None:
+                self._registry = get_template_registry()
+            return self._registry.get(template)
+        return template
+
+    def _render(self, template, data):
+        if self._render_in_writer:
+            return lambda: self._template(template).render(data)
+        return self._template(template).render(data)
+
+    def _baseline_changes(self, data):
+        # the signals which changed since they were last written to this investigation
+        last = self._last_baseline.setdefault(self._eLog_id_num, {})
+        changed = {}
+        for key, value in data.items():
+            if key not in last or self._changed(last[key], value, self._tolerances.get(key, self._default_tolerance)):
+                changed[key] = value
+        # only the written values are kept, so that slow drifts are still reported
+        last.update(changed)
+        return changed
+
+    @staticmethod
+    def _changed(old, new, tolerance):
+        try:
+            old = np.asarray(old)
+            new = np.asarray(new)
+            if old.shape != new.shape:
+                return True
+            if np.issubdtype(old.dtype, np.number) and np.issubdtype(new.dtype, np.number):
+                return bool(np.any(np.abs(new - old) > tolerance))
+            return bool(np.any(old != new))
+        except (TypeError, ValueError):
+            return old != new
+
+    def _write(self, message, uid):
+        if not self._coalesce:
+            self._writer.submit(message, self._eLog_id_num, uid=uid)
+            return
+
+        with self._lock:
+            if not self._fragments:
+                self._fragments_time = time.monotonic()
+                self._timer = threading.Timer(self._max_delay, self._flush_late, args=(self._part,))
+                self._timer.daemon = True
+                self._timer.start()
+            self._fragments.append(message)
+            spool = getattr(self._writer, 'spool', None)
+            if spool is not None and not callable(message):
+                key = f"{uid}-held"
+                if spool.hold(_elog_event(message), self._eLog_id_num, DEFAULT_SESSION_ID, uid=key):
+                    self._held.append(key)
+            if not callable(message):
+                self._fragments_size += len(message)
+            if self._fragments_size > self._max_size or time.monotonic() - self._fragments_time > self._max_delay:
+                self._flush()
+
+    def _flush_late(self, part):
+        # the timer started with the first message waiting, unless those were written already
+        with self._lock:
+            if part == self._part:
+                self._flush()
+
+    def _flush(self):
+        # write the messages collected for this run as one entry
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._fragments:
+                return
+            uid = self._run_uid if self._part == 0 else f"{self._run_uid}-{self._part}"
+            fragments = self._fragments
+            if any(callable(fragment) for fragment in fragments):
+                message = lambda: '\n'.join(fragment() if callable(fragment) else fragment for fragment in fragments)
+            else:
+                message = '\n'.join(fragments)
+            if self._held:
+                self._writer.submit(message, self._eLog_id_num, uid=uid, replaces=self._held)
+            else:
+                self._writer.submit(message, self._eLog_id_num, uid=uid)
+            self._fragments = []
+            self._fragments_size = 0
+            self._held = []
+            self._part += 1
+
     def clear(self):
-        self._baseline_toggle = True
-        self._eLog_id_num = None
-        self._descriptors.clear()
+        with self._lock:
+            # the messages collected so far are written, not dropped
+            self._flush()
+            self._baseline_toggle = True
+            self._eLog_id_num = None
+            self._descriptors.clear()
 
 ###### log in and out functions:
 
   
 
-def authenticate_session(RE,db,lock_list=None):
+def authenticate_session(RE,db,lock_list=None,cache=None):
 
     """
     RE: run engine object
     db: databroker catalog
     lock_list: list of resource locks, optional
+    cache: ICATSessionCache, optional. defaults to the one in ~/.bessyii, pass False to always ask ICAT+
+
+    By default the session id and the investigations of the user are written to
+    ~/.bessyii/icat_session_cache.json, readable only by the account, for an hour.
+    Anyone logged in to the same account can read them from there, so on a shared
+    beamline account pass cache=False to keep them off the disk
     """
     if 'eLog_id_num' in RE.md:
         print("Already logged in")
@@ -304,7 +1732,11 @@ def authenticate_session(RE,db,lock_list=None):
     
     username =str(input("username: "))
     password = str(getpass())
-    title, name, id_num, full_name= requestInvestigationName(username,password)
+    if cache is None:
+        cache = get_session_cache()
+    # username is the one the user finally logged in with
+    title, name, id_num, full_name, username = requestInvestigationName(username,password,cache=cache or None,
+                                                                        return_username=True)
     if title == None or name == None or id_num == None:
         return None
     
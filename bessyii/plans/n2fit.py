@@ -1,9 +1,20 @@
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.ticker import MultipleLocator, FixedLocator, FormatStrFormatter
 import numpy as np
 import warnings
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+import msgpack
 
 from lmfit.models import LinearModel, SkewedVoigtModel, Model
+from lmfit.model import ModelResult
 from lmfit import Parameters
 
 from numpy import (arctan, copysign, cos, exp, isclose, isnan, log, pi, real,
@@ -13,8 +24,1147 @@ from scipy.special import gamma as gamfcn
 from scipy.special import wofz
 
 
+import inspect
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from bluesky.callbacks import CallbackBase
+from functools import lru_cache
+
 from IPython import get_ipython
 
+logger = logging.getLogger(__name__)
+
+
+class FaddeevaTable:
+    """
+    The Faddeeva function w(z) in the upper half plane from a precomputed table,
+    a faster stand-in for scipy.special.wofz in the Voigt profiles
+
+    Inside the circle |z| < radius, w is the Taylor series of the given order around
+    the nearest node of a grid of spacing step over 0 <= Re z, Im z <= radius, whose
+    coefficients w^(n)(z0)/n! are tabulated once from wofz with the recurrence
+    w^(n+1) = -2*z*w^(n) - 2*n*w^(n-1), and w(-conj(z)) = conj(w(z)) for Re z < 0.
+    Outside, it is the asymptotic series i/(sqrt(pi)*z) * sum((2n-1)!!/(2*z**2)**n)
+    with terms terms. Points with Im z < 0, where w grows like exp(-z**2), are
+    passed to wofz.
+
+    The error is bounded by the Taylor remainder at the corners of the cells and
+    by the first term left out of the asymptotic series at |z| = radius, the
+    largest relative error at those points is measured against wofz when the table
+    is made and kept in error. The default table is below 1e-7.
+
+    instantiate with
+
+      w = FaddeevaTable()
+      w(z)        # as wofz(z)
+
+    or use faddeeva_function('table'), which makes the table once per process
+
+    Parameters
+    ----------
+    radius : float
+        the radius of the tabulated region
+    step : float
+        the spacing of the grid
+    order : int
+        the order of the Taylor series
+    terms : int
+        the number of terms of the asymptotic series after the first
+    """
+
+    def __init__(self, radius=6.0, step=0.025, order=3, terms=6):
+        self.radius = radius
+        self.step   = step
+        self.order  = order
+        self.terms  = terms
+        self._n     = int(round(radius/step))+1
+        grid = np.arange(self._n)*step
+        z0 = grid[None, :] + 1j*grid[:, None]
+        derivatives = [wofz(z0), -2*z0*wofz(z0) + 2j/sqrt(pi)]
+        for n in range(1, order):
+            derivatives.append(-2*z0*derivatives[n] - 2*n*derivatives[n-1])
+        factorial = np.cumprod([1]+list(range(1, order+1)))
+        # the Taylor coefficients, highest order first for Horner's scheme, by row v and column u
+        self._coefficients = np.array([(derivatives[n]/factorial[n]).ravel() for n in range(order, -1, -1)])
+        # the factors 2n-1 of the asymptotic series, innermost first
+        self._odd = [float(2*n-1) for n in range(terms, 0, -1)]
+        self.error = self._max_error()
+
+    def _max_error(self):
+        # the cell corners, where the Taylor series is farthest from its node, and the circle |z| = radius
+        grid = np.arange(self._n)*self.step
+        z0 = (grid[None, :] + 1j*grid[:, None]).ravel()
+        half = self.step/2*(1-1e-9)
+        z = np.concatenate([z0 + half*corner for corner in (1+1j, 1-1j, -1+1j, -1-1j)] +
+                           [self.radius*(1+1e-9)*np.exp(1j*np.linspace(0, pi, 181))])
+        z = z[(z.imag >= 0) & (z.real >= 0)]
+        w = wofz(z)
+        return float(np.max(np.abs(self(z) - w)/np.abs(w)))
+
+    def __call__(self, z, out=None):
+        z = np.asarray(z, dtype=complex)
+        if out is None:
+            out = np.empty(z.shape, dtype=complex)
+        elif not out.flags.c_contiguous:
+            out[...] = self(z)
+            return out
+        flat_z, flat_out = z.reshape(-1), out.reshape(-1)
+
+        inside = flat_z.real*flat_z.real + flat_z.imag*flat_z.imag < self.radius*self.radius
+        outer = np.flatnonzero(~inside)
+        inner = np.flatnonzero(inside)
+
+        z_outer = flat_z.take(outer)
+        q = 0.5/(z_outer*z_outer)
+        series = self._odd[0]*q
+        for odd in self._odd[1:]:
+            series += 1
+            series *= odd*q
+        series += 1
+        series /= z_outer
+        series *= 1j/sqrt(pi)
+        flat_out.put(outer, series)
+
+        if inner.size:
+            z_inner = flat_z.take(inner)
+            u = np.abs(z_inner.real)
+            iu = np.rint(u/self.step).astype(np.intp)
+            iv = np.rint(z_inner.imag/self.step).astype(np.intp)
+            # Im z < 0 lands outside the table, it is done by wofz below
+            np.clip(iv, 0, None, out=iv)
+            node = iv*self._n + iu
+            d = (u - iu*self.step) + 1j*(z_inner.imag - iv*self.step)
+            taylor = self._coefficients[0].take(node)
+            for coefficients in self._coefficients[1:]:
+                taylor *= d
+                taylor += coefficients.take(node)
+            np.conjugate(taylor, out=taylor, where=z_inner.real < 0)
+            flat_out.put(inner, taylor)
+
+        lower = np.flatnonzero(flat_z.imag < 0)
+        if lower.size:
+            flat_out.put(lower, wofz(flat_z.take(lower)))
+        return out
+
+
+@lru_cache(maxsize=None)
+def _faddeeva_table():
+    return FaddeevaTable()
+
+
+def faddeeva_function(name='wofz'):
+    """
+    Return the Faddeeva function used by the Voigt profiles of the fit
+
+    Parameters
+    ----------
+    name : string
+        'wofz' for scipy.special.wofz, 'table' for the FaddeevaTable, which is made
+        the first time it is asked for and kept for the process
+
+    Return
+    --------
+    faddeeva: callable
+        w(z, out=None)
+    """
+    if name == 'wofz':
+        return wofz
+    if name == 'table':
+        return _faddeeva_table()
+    raise ValueError(f"unknown Faddeeva function {name!r}, use 'wofz' or 'table'")
+
+
+@lru_cache(maxsize=None)
+def _jit_kernels():
+    # numba is optional, the kernels are imported and compiled the first time a fit asks for them
+    from bessyii.plans import n2fit_jit
+    return None if n2fit_jit.numba is None else n2fit_jit
+
+
+def _use_jit(jit):
+    # True if the numba kernels are asked for and can be used
+    if not jit:
+        return False
+    if _jit_kernels() is None:
+        _warn_no_numba()
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def _warn_no_numba():
+    # once, not at every fit asking for jit
+    warnings.warn('numba is not installed, the N2 fit is evaluated with NumPy')
+
+
+def _jit_skewed_voigt_peaks(x, amplitude, center, sigma, gamma, skew):
+    # the sum of the skewed voigt peaks by the numba kernel, with the Faddeeva function of the FaddeevaTable
+    table = _faddeeva_table()
+    x = np.ascontiguousarray(x, dtype=float)
+    arrays = [np.ascontiguousarray(values, dtype=float) for values in (amplitude, center, sigma, gamma, skew)]
+    return _jit_kernels().skewed_voigt_peaks(x, *arrays, table._coefficients, table._n, table.step, table.radius,
+                                             table.terms, np.empty(x.shape[0]))
+
+
+class SkewedVoigtPeaksModel(Model):
+    """
+    The sum of n_peaks skewed voigt peaks, evaluated in one pass
+
+    It is equivalent to SkewedVoigtModel(prefix='v1_') + ... + SkewedVoigtModel(prefix='vn_'),
+    with the same parameter names v1_amplitude, v1_center, v1_sigma, v1_gamma, v1_skew, ...,
+    but the parameters of all the peaks are gathered in arrays of shape (n_peaks,) and
+    wofz and erf are evaluated once on a (n_peaks, len(x)) grid. The grid is kept in
+    buffers which are reused as long as len(x) does not change, so one instance should
+    not be evaluated from several threads at the same time.
+
+    instantiate with
+
+      mod = SkewedVoigtPeaksModel(10) + LinearModel(prefix='lin_')
+
+    Parameters
+    ----------
+    n_peaks : int
+        the number of peaks
+    peak_prefix : string
+        the prefix of the parameter names, followed by the number of the peak and _
+    faddeeva : callable
+        the Faddeeva function w(z, out=None), wofz or a FaddeevaTable, see faddeeva_function
+    jit : boolean
+        if True and numba is installed, the sum of the peaks is evaluated by a compiled
+        kernel in one pass, with the FaddeevaTable whatever faddeeva is.
+        eval_components still uses NumPy
+    """
+
+    keys = ['amplitude', 'center', 'sigma', 'gamma', 'skew']
+    defaults = {'amplitude': 1.0, 'center': 0.0, 'sigma': 1.0, 'gamma': 1.0, 'skew': 0.0}
+
+    tiny = 1.0e-15
+    s2   = sqrt(2)
+    s2pi = sqrt(2*pi)
+
+    def __init__(self, n_peaks, peak_prefix='v', faddeeva=wofz, jit=False, **kwargs):
+        if n_peaks < 1:
+            raise ValueError('n_peaks must be at least 1')
+        self.n_peaks     = n_peaks
+        self.peak_prefix = peak_prefix
+        self.faddeeva    = faddeeva
+        self.jit         = _use_jit(jit)
+        self.names       = [[f'{peak_prefix}{i+1}_{key}' for i in range(n_peaks)] for key in self.keys]
+        self._values     = np.empty((len(self.keys), n_peaks))
+        self._size       = None
+
+        def skewed_voigt_peaks(x, **values):
+            if self.jit:
+                return _jit_skewed_voigt_peaks(x, *self.parameter_arrays(values))
+            return self.peaks(x, values).sum(axis=0)
+
+        # lmfit finds the parameter names in the signature of the model function
+        skewed_voigt_peaks.__signature__ = inspect.Signature(
+            [inspect.Parameter('x', inspect.Parameter.POSITIONAL_OR_KEYWORD)] +
+            [inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY, default=self.defaults[key])
+             for key, names in zip(self.keys, self.names) for name in names])
+        super().__init__(skewed_voigt_peaks, **kwargs)
+        for name in self.names[self.keys.index('sigma')]:
+            self.set_param_hint(name, min=0)
+        for name in self.names[self.keys.index('gamma')]:
+            self.set_param_hint(name, min=0)
+
+    def _buffers(self, x):
+        if self._size != x.shape[0]:
+            shape      = (self.n_peaks, x.shape[0])
+            self._dx   = np.empty(shape)
+            self._asym = np.empty(shape)
+            self._z    = np.empty(shape, dtype=complex)
+            self._w    = np.empty(shape, dtype=complex)
+            self._size = x.shape[0]
+        return self._dx, self._asym, self._z, self._w
+
+    def parameter_arrays(self, values):
+        """
+        Gather the values of the parameters in arrays of shape (n_peaks,)
+
+        Parameters
+        ----------
+        values : dict or lmfit Parameters
+
+        Return
+        --------
+        amplitude, center, sigma, gamma, skew : np.array
+        """
+        if hasattr(values, 'valuesdict'):
+            values = values.valuesdict()
+        for row, names in zip(self._values, self.names):
+            for i, name in enumerate(names):
+                row[i] = values[name]
+        return self._values
+
+    def peaks(self, x, values):
+        """
+        Evaluate every peak
+
+        Parameters
+        ----------
+        x : numpy.array
+        values : dict or lmfit Parameters
+             the values of the parameters by name
+
+        Return
+        --------
+        peaks : np.array
+             array of shape (n_peaks, len(x)), reused by the next evaluation
+        """
+        x = np.asarray(x, dtype=float)
+        amplitude, center, sigma, gamma, skew = self.parameter_arrays(values)
+        dx, asym, z, w = self._buffers(x)
+        sigma_s2 = np.maximum(self.tiny, sigma*self.s2)[:, None]
+
+        np.subtract(x, center[:, None], out=dx)
+        # the voigt profile, with z = (x-center+1j*gamma)/(sigma*sqrt(2))
+        np.divide(dx, sigma_s2, out=z.real)
+        np.divide(gamma[:, None], sigma_s2, out=z.imag)
+        self.faddeeva(z, out=w)
+        # the skew, 1 + erf(skew*(x-center)/(sigma*sqrt(2)))
+        np.multiply(z.real, skew[:, None], out=asym)
+        erf(asym, out=asym)
+        asym += 1
+        asym *= w.real
+        asym *= (amplitude/np.maximum(self.tiny, sigma*self.s2pi))[:, None]
+        return asym
+
+    def eval_components(self, params=None, **kwargs):
+        """
+        Return the value of every peak by the prefix of its parameters, as SkewedVoigtModel
+        would, and the sum of the peaks by the label lmfit gives to this model
+        """
+        x = kwargs.get('x', self.independent_vars_defvals.get('x'))
+        values = self.make_funcargs(params, kwargs)
+        peaks = self.peaks(x, values)
+        components = {f'{self.peak_prefix}{i+1}_': peak.copy() for i, peak in enumerate(peaks)}
+        components[self.prefix if len(self.prefix) > 1 else self._name] = peaks.sum(axis=0)
+        return components
+
+
+class N2FitResult:
+    """
+    The result of N2_fit.fit_spectrum
+
+    The values used to calculate the RP are extracted when the fit is done. The
+    uncertainty band and the figures are only computed when asked for, so a fit
+    which only needs the numbers does not pay for them.
+
+      result = N2fit_class.fit_spectrum(x, y)
+      print(result.RP, result.vp_ratio)
+      result.plot()                        # the figure of fit_n2
+      result.render_async('n2_fit.pdf')    # or written to file by a background thread
+
+    Attributes
+    ----------
+    x, y : numpy.array
+        the motor positions and the normalized detector readings
+    out : lmfit ModelResult
+    sigma, sigma_err, center, vp_ratio : float
+        as returned by _fit_n2
+    params : dict
+        the best fit value of every parameter
+    covar, var_names :
+        the covariance matrix of the varied parameters and their names
+    """
+
+    def __init__(self, n2, x, y, out, dict_fit=None, fix_param=False, norm=1, fit_kwargs=None):
+        self._n2       = n2
+        self.x         = x
+        self.y         = y
+        self._out      = out
+        self.dict_fit  = dict_fit
+        self.fix_param = fix_param
+        self.norm      = norm
+        self.fit_kwargs = dict(fit_kwargs or {}, fix_param=fix_param)
+        self._uncertainty = None
+        self._vp_ratio_err = None
+        self._report   = None
+        self.stages    = {}
+        # the uid of the scan whose fit this one started from, see N2_fit.fit_scan
+        self.warm_start = None
+
+        if fix_param == False:
+            self.sigma, self.sigma_err, self.center = n2.extract_RP_fwhm_g(out.params, fix_param=fix_param)
+        else:
+            self.sigma, self.sigma_err, self.center = n2.extract_RP_fwhm_g(out.values, fix_param=fix_param)
+        self.vp_ratio  = n2.extract_RP_ratio(x, out.best_fit, out.params, fix_param=fix_param)
+        self.params    = out.params.valuesdict()
+        self.covar     = out.covar
+        self.var_names = out.var_names
+        self.success   = out.success
+        self.message   = out.message
+
+    def to_entry(self):
+        """
+        Return the result as a dict of plain values, which can be stored by N2FitCache
+        or sent between processes, see from_entry
+        """
+        def number(value):
+            return None if value is None else float(value)
+        return {'x': np.asarray(self.x, dtype=float).tobytes(), 'y': np.asarray(self.y, dtype=float).tobytes(),
+                'norm': float(self.norm), 'fit_kwargs': self.fit_kwargs,
+                'sigma': number(self.sigma), 'sigma_err': number(self.sigma_err), 'center': number(self.center),
+                'vp_ratio': number(self.vp_ratio), 'RP': number(self.RP),
+                'params': {name: float(value) for name, value in self.params.items()},
+                'covar': None if self.covar is None else np.asarray(self.covar, dtype=float).tobytes(),
+                'stderr': {name: float(par.stderr) for name, par in self.out.params.items() if par.stderr is not None},
+                'var_names': list(self.var_names), 'success': bool(self.success), 'message': str(self.message),
+                'chisqr': float(self.out.chisqr), 'redchi': float(self.out.redchi), 'report': self.report(),
+                'stages': self.stages, 'vp_ratio_err': number(self._vp_ratio_err)}
+
+    @classmethod
+    def from_entry(cls, n2, entry):
+        """
+        Make the result again from to_entry(), without fitting. The lmfit result is
+        only needed for the figures, it is made again from the stored best fit values
+        and covariance when first used
+        """
+        self = cls.__new__(cls)
+        self._n2          = n2
+        self.x            = np.frombuffer(entry['x'])
+        self.y            = np.frombuffer(entry['y'])
+        self._out         = None
+        self.dict_fit     = None
+        self.norm         = entry['norm']
+        self.fit_kwargs   = entry['fit_kwargs']
+        self.fix_param    = self.fit_kwargs['fix_param']
+        self._uncertainty = None
+        self._vp_ratio_err = entry.get('vp_ratio_err')
+        self.warm_start   = None
+        self.stages       = entry.get('stages', {})
+        for key in ['sigma', 'sigma_err', 'center', 'vp_ratio', 'params', 'var_names', 'success', 'message']:
+            setattr(self, key, entry[key])
+        self._stderr = entry['stderr']
+        self._chisqr = entry['chisqr'], entry['redchi']
+        self._report = entry['report']
+        n = len(self.var_names)
+        self.covar = None if entry['covar'] is None else np.frombuffer(entry['covar']).reshape(n, n)
+        return self
+
+    @property
+    def out(self):
+        """the lmfit ModelResult"""
+        if self._out is None:
+            # a result from the cache, the model is evaluated at the stored best fit without fitting again
+            kwargs = dict(self.fit_kwargs)
+            kwargs.pop('jacobian', None)
+            kwargs.pop('coarse', None)
+            kwargs.pop('jitter', None)
+            mod, pars, self.dict_fit = self._n2._make_n2_model(self.x, self.y, **kwargs)
+            out = ModelResult(mod, pars, data=self.y, fcn_kws={'x': self.x})
+            out.init_fit = mod.eval(pars, x=self.x)
+            for name, value in self.params.items():
+                pars[name].value = value
+                pars[name].stderr = self._stderr.get(name)
+            out.params    = pars
+            out.userkws   = {'x': self.x}
+            out.best_fit  = mod.eval(pars, x=self.x)
+            out.covar     = self.covar
+            out.var_names = self.var_names
+            out.nvarys    = len(self.var_names)
+            out.ndata     = len(self.y)
+            out.chisqr, out.redchi = self._chisqr
+            out.success   = self.success
+            out.message   = self.message
+            self._out = out
+        return self._out
+
+    @property
+    def fwhm_g(self):
+        """the gaussian FWHM"""
+        return 2*self.sigma*np.sqrt(2*np.log(2))
+
+    @property
+    def RP(self):
+        """the resolving power, the center of the first peak over the gaussian FWHM"""
+        return self.center/self.fwhm_g
+
+    @property
+    def uncertainty(self):
+        """the 1-sigma uncertainty of the best fit at every x, computed on first use"""
+        if self._uncertainty is None:
+            self._uncertainty = self.out.eval_uncertainty(x=self.x)
+        return self._uncertainty
+
+    @property
+    def vp_ratio_err(self):
+        """
+        the 1-sigma uncertainty of vp_ratio, from the uncertainty of the best fit at
+        the valley and at the 3rd peak, computed on first use. nan without covariance
+        """
+        self.compute_errors()
+        return self._vp_ratio_err
+
+    def compute_errors(self):
+        """
+        Compute the uncertainty of vp_ratio now rather than on first use, so that
+        to_entry includes it. It needs the lmfit result, which a result from the
+        cache makes again from the covariance
+        """
+        if self._vp_ratio_err is not None:
+            return
+        self._vp_ratio_err = np.nan
+        if self.covar is not None and np.isfinite(self.vp_ratio):
+            names = ['c1', 'c2', 'c3'] if self.fix_param else ['v1_center', 'v2_center', 'v3_center']
+            i1, i2, i3 = self._n2.find_nearest_idx(self.x, [float(self.params[name]) for name in names])
+            if i2 > i1:
+                best_fit = self.out.best_fit
+                valley   = i1 + np.argmin(best_fit[i1:i2])
+                # the height of the 3rd peak, over the background for the free model as in extract_RP_ratio
+                peak     = best_fit[i3]
+                if not self.fix_param:
+                    peak -= self.params['lin_slope']*self.params['v3_center'] + self.params['lin_intercept']
+                # vp_ratio = valley/peak, with the errors of both added in quadrature
+                self._vp_ratio_err = float(np.hypot(self.uncertainty[valley], self.vp_ratio*self.uncertainty[i3])/abs(peak))
+
+    def report(self, min_correl=0.5):
+        """the fit report of lmfit"""
+        if self._report is not None:
+            # a result from the cache
+            return self._report
+        return self.out.fit_report(min_correl=min_correl)
+
+    def draw(self, axes):
+        """
+        Draw the data, the fit with its uncertainty band, the components and the residuals
+
+        Parameters
+        ----------
+        axes : list of 3 matplotlib axes
+        """
+
+        x, y, out = self.x, self.y, self.out
+        delta = self.uncertainty
+
+        ####
+        # axes 0
+        #
+        # initial fit
+        axes[0].plot(x, out.init_fit, 'orange' ,label='initial guess')
+        #
+        axes[0].scatter(x, y, label='data', s=10)
+        #axes[0].plot(x, init, '--', label='initial fit')
+        axes[0].plot(x, out.best_fit, 'r', label='best fit')
+        axes[0].fill_between(x,out.best_fit-delta,out.best_fit+delta,color='gray',alpha=0.4, label='fit uncertainty')
+
+
+        axes[0].legend()
+        axes[0].set_xlabel('Photon energy (eV)')
+        axes[0].set_ylabel('Ion counts (arb. units)')
+
+        #axes[0].set_xlim(399.8,402.5)
+        axes[0].set_ylim(np.min(y)-0.25,np.max(y)+0.25)
+        axes[0].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+
+        # set tick spacing
+        XminorLocator = MultipleLocator(0.1)
+        YminorLocator = MultipleLocator(100000)
+        axes[0].xaxis.set_minor_locator(XminorLocator)
+        axes[0].yaxis.set_minor_locator(YminorLocator)
+        axes[0].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
+        #
+
+        #
+        ################################################################################
+        # axes 1
+
+        axes[1].plot(x, y)
+
+        counter = 0
+
+        if self.dict_fit is not None:
+            comps = out.eval_components(x=x)
+            for i in self.dict_fit.values():
+                counter += 1
+                axes[1].plot(x, comps[i[0]], '--', label='Voigt component ' + str(counter))
+            axes[1].plot(x, comps['lin_'], '--', label='Linear component')
+        else:
+            comps = self.params
+            for i in range(1,8):
+                ind=str(i)
+                counter += 1
+                axes[1].plot(x,self._n2.skewed_voigt(x, amplitude=comps['a'+ind], center=comps['c'+ind], sigma=comps['sigma'], gamma=comps['gamma'], skew=comps['skew']), '--', label='Voigt component ' + str(counter))
+
+
+
+        axes[1].legend()
+        axes[1].set_xlabel('Photon energy (eV)')
+        axes[1].set_ylabel('Ion counts (arb. units)')
+        #axes[1].set_xlim(399.8,402.5)
+        #axes[1].set_ylim(0,990000)
+        axes[1].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+
+        XminorLocator = MultipleLocator(0.1)
+        YminorLocator = MultipleLocator(100000)
+        axes[1].xaxis.set_minor_locator(XminorLocator)
+        axes[1].yaxis.set_minor_locator(YminorLocator)
+        axes[1].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
+        #
+        ########################################################################
+        # axes 2
+        residuals_inital = y - out.init_fit
+        residuals_final = y - out.best_fit
+        #
+        axes[2].plot(x, residuals_final, label='data-best fit')
+        #axes[2].plot(x, np.sqrt(y)*3.0, label='sqrt(y)*3')
+        #axes[2].plot(x, np.sqrt(y)*-3.0, label='sqrt(y)*-3')
+        axes[2].fill_between(x,np.sqrt(y)*-3.0,np.sqrt(y)*3.0,color='gray',alpha=0.4, label='sqrt(data)*\u00b13')
+
+        axes[2].legend()
+        axes[2].set_xlabel('Photon energy (eV)')
+        axes[2].set_ylabel('Residual counts (arb. units)')
+        #axes[2].set_xlim(399.8,402.5)
+        #axes[2].set_ylim(-20000,20000)
+        axes[2].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+
+        XminorLocator = MultipleLocator(0.1)
+        YminorLocator = MultipleLocator(1000)
+        axes[2].xaxis.set_minor_locator(XminorLocator)
+        axes[2].yaxis.set_minor_locator(YminorLocator)
+        axes[2].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
+        # 
+        xmin_ax2, xmax_ax2 = axes[2].axes.get_xlim()
+        ymin_ax2, ymax_ax2 = axes[2].axes.get_ylim()
+
+        axes[2].text(((xmax_ax2-xmin_ax2)*0.55)+xmin_ax2, ((ymax_ax2-ymin_ax2)*0.2)+ymin_ax2, f'RMS initial = {str(np.round(self._n2.RMS(residuals_inital),4))}') #, style = 'italic',fontsize = 30,  color = "green")
+        axes[2].text(((xmax_ax2-xmin_ax2)*0.55)+xmin_ax2, ((ymax_ax2-ymin_ax2)*0.15)+ymin_ax2, f'RMS final   = {str(np.round(self._n2.RMS(residuals_final),4))}')
+
+    def plot(self, save_img=False):
+        """
+        Plot the fit in a new pyplot figure
+
+        Parameters
+        ----------
+        save_img: boolean or string
+               if False no image is saved
+               if is a string the image will be saved with this name as pdf
+
+        Return
+        --------
+        fig : matplotlib figure
+        """
+        plt.rc("font", size=12,family='serif')
+        fig, axes = plt.subplots(3, 1, figsize=(8.0, 16.0))
+        self.draw(axes)
+        plt.subplots_adjust(left=0.14, bottom=None, right=None, top=None, wspace=0.04, hspace=0.14)
+        if save_img != False:
+            plt.savefig(save_img+'.pdf')
+        return fig
+
+    def render(self, filename):
+        """
+        Write the figure of the fit to filename without pyplot, so it can be done
+        outside of the main thread
+
+        Parameters
+        ----------
+        filename : string
+            the file name, the format is given by the extension
+        """
+        with matplotlib.rc_context({'font.size': 12, 'font.family': 'serif'}):
+            fig = Figure(figsize=(8.0, 16.0))
+            self.draw(fig.subplots(3, 1))
+            fig.subplots_adjust(left=0.14, wspace=0.04, hspace=0.14)
+            fig.savefig(filename)
+        return filename
+
+    def render_async(self, filename):
+        """
+        Write the figure of the fit to filename in a background thread
+
+        Return
+        --------
+        future : concurrent.futures.Future
+            the result is the file name, once written
+        """
+        return _render_executor().submit(self.render, filename)
+
+
+_render_pool = None
+
+
+def _render_executor():
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='n2fit-render')
+    return _render_pool
+
+
+class N2FitCache:
+    """
+    A cache of N2 fits on disk, so that fitting a scan again with the same options,
+    for instance to change the figure, returns at once instead of reading the run
+    from the databroker and fitting it again.
+
+    The entries are kept in an SQLite file and keyed by the uid of the run, the motor
+    and detector names and a hash of the fit options. Each entry holds the spectrum,
+    the best fit parameters, their covariance and the values derived from them (see
+    N2FitResult.to_entry). When the entries together exceed max_size, the least
+    recently used ones are removed.
+
+    It also keeps an index of the best fit parameters of the converged fits with the
+    beamline configuration of their run (see N2_fit.config_keys), from which a fit
+    of a new scan can start (see nearest_start).
+
+    Parameters
+    ----------
+    path: string, optional
+        the cache file. defaults to ~/.bessyii/n2fit_cache.sqlite
+    max_size: int
+        the size in bytes of the entries kept
+    max_starts: int
+        the number of fits kept in the index of starting points
+    """
+
+    # change it when the fit changes, so that older results are not returned
+    version = 1
+
+    def __init__(self, path=None, max_size=200*2**20, max_starts=1000):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bessyii', 'n2fit_cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.max_starts = max_starts
+        with self._connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS fits
+                                  (key TEXT PRIMARY KEY, uid TEXT, motor TEXT, detector TEXT,
+                                   used REAL, size INTEGER, entry BLOB)''')
+            connection.execute('''CREATE TABLE IF NOT EXISTS starts
+                                  (uid TEXT, motor TEXT, detector TEXT, model TEXT, config TEXT,
+                                   used REAL, params BLOB, PRIMARY KEY (uid, motor, detector, model))''')
+
+    def _connect(self):
+        # a connection per call, so the cache can be used from several threads and processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def key(self, uid, motor, detector, fit_kwargs, start=None):
+        """
+        Return the key of a fit of the run uid with the options fit_kwargs, started
+        from the parameters values start if given (see nearest_start)
+        """
+        options = json.dumps(fit_kwargs, sort_keys=True, default=str)
+        if start is not None:
+            # a warm started fit is not the cold one, nor the one started from other values
+            options += ':' + json.dumps(start, sort_keys=True)
+        digest  = hashlib.sha256(f'{self.version}:{options}'.encode()).hexdigest()
+        return f'{uid}:{motor}:{detector}:{digest}'
+
+    def get(self, key):
+        """
+        Return the entry stored under key, or None
+        """
+        with self._connect() as connection:
+            row = connection.execute('SELECT entry FROM fits WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE fits SET used = ? WHERE key = ?', (time.time(), key))
+        return msgpack.unpackb(row[0])
+
+    def put(self, key, entry):
+        """
+        Store entry under key and remove the least recently used entries above max_size
+        """
+        uid, motor, detector = key.split(':')[:3]
+        data = msgpack.packb(entry)
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, uid, motor, detector, time.time(), len(data), data))
+            # the entries past max_size, counting from the most recently used
+            connection.execute('''DELETE FROM fits WHERE key IN
+                                  (SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC, rowid DESC) AS total FROM fits)
+                                   WHERE total > ?)''', (self.max_size,))
+
+    @staticmethod
+    def _model(fit_kwargs):
+        # the fits whose parameters have the same names
+        return json.dumps([bool(fit_kwargs.get('fix_param', False)), int(fit_kwargs.get('n_peaks', 10))])
+
+    def put_start(self, key, config, fit_kwargs, params):
+        """
+        Keep the best fit parameters params of the fit stored under key, done with the
+        options fit_kwargs on a run with the beamline configuration config (a dict),
+        and remove the oldest ones above max_starts
+        """
+        uid, motor, detector = key.split(':')[:3]
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO starts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (uid, motor, detector, self._model(fit_kwargs), json.dumps(config, sort_keys=True, default=str),
+                                time.time(), msgpack.packb(params)))
+            connection.execute('''DELETE FROM starts WHERE rowid NOT IN
+                                  (SELECT rowid FROM starts ORDER BY used DESC LIMIT ?)''', (self.max_starts,))
+
+    def nearest_start(self, key, config, fit_kwargs):
+        """
+        Return the uid and the best fit parameters of the fit in the index closest to the
+        beamline configuration config, with the same motor, detector and model as the fit
+        to be stored under key, or None, None.
+
+        Values of config which are not numbers must be equal, the distance between two
+        configurations is the sum of the relative differences of the numbers, the most
+        recent fit is taken between equally distant ones.
+        """
+        uid, motor, detector = key.split(':')[:3]
+        with self._connect() as connection:
+            rows = connection.execute('''SELECT uid, config, params FROM starts
+                                         WHERE motor = ? AND detector = ? AND model = ? AND uid != ?
+                                         ORDER BY used DESC''',
+                                      (motor, detector, self._model(fit_kwargs), uid)).fetchall()
+        config = json.loads(json.dumps(config, sort_keys=True, default=str))
+        best, best_distance = (None, None), np.inf
+        for start_uid, start_config, params in rows:
+            distance = _config_distance(config, json.loads(start_config))
+            if distance < best_distance:
+                best, best_distance = (start_uid, msgpack.unpackb(params)), distance
+        return best
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+
+    @property
+    def size(self):
+        """the size in bytes of the entries"""
+        with self._connect() as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM fits').fetchone()[0]
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM fits')
+            connection.execute('DELETE FROM starts')
+
+
+def _config_distance(config, other):
+    # the distance between two beamline configurations, see N2FitCache.nearest_start
+    if config.keys() != other.keys():
+        return np.inf
+    distance = 0
+    for name, value in config.items():
+        numbers = [isinstance(v, (int, float)) and not isinstance(v, bool) for v in (value, other[name])]
+        if all(numbers):
+            distance += abs(value - other[name])/max(abs(value), abs(other[name]), 1e-15)
+        elif value != other[name]:
+            return np.inf
+    return distance
+
+
+class RPTrendStore:
+    """
+    A record of the N2 fits of scans, to follow the resolving power of the beamline
+    over months without fitting old scans again.
+
+    Each fit is a row of an SQLite table with the uid and start time of the run, the
+    motor, detector and fit options, the beamline configuration of the run (see
+    N2_fit.config_keys) and the values from the fit. Rows are only added: the same
+    fit of the same scan is recorded once. The table is indexed by time and by each
+    of config_keys, so that
+
+      store = RPTrendStore()
+      store.query(days=90, grating='1200')       # a dict of arrays
+      store.plot('cff', 'RP', days=90)           # RP vs cff over the last 90 days
+      store.average('RP', days=90, cff=(2, 3))   # the weighted mean RP and its error
+
+    take milliseconds. N2_fit records its fits in one, see N2_fit.
+
+    Parameters
+    ----------
+    path: string, optional
+        the store file. defaults to ~/.bessyii/rp_trend.sqlite
+    config_keys: tuple of string
+        the keys of the beamline configuration which are indexed and returned by query
+    """
+
+    columns = ['uid', 'time', 'motor', 'detector', 'sigma', 'sigma_err', 'center', 'RP', 'vp_ratio', 'success']
+
+    def __init__(self, path=None, config_keys=('cff', 'grating', 'exit_slit')):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.bessyii', 'rp_trend.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.config_keys = tuple(config_keys)
+        for key in self.config_keys:
+            if not re.fullmatch(r'\w+', key):
+                raise ValueError(f'invalid configuration key {key!r}')
+        with self._connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS fits
+                                  (uid TEXT, motor TEXT, detector TEXT, options TEXT, time REAL, recorded REAL,
+                                   config TEXT, sigma REAL, sigma_err REAL, center REAL, RP REAL, vp_ratio REAL,
+                                   success INTEGER, UNIQUE (uid, motor, detector, options))''')
+            connection.execute('CREATE INDEX IF NOT EXISTS fits_time ON fits (time)')
+            for key in self.config_keys:
+                connection.execute(f'''CREATE INDEX IF NOT EXISTS fits_{key} ON fits
+                                       (json_extract(config, '$.{key}'), time)''')
+
+    def _connect(self):
+        # a connection per call, as N2FitCache
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _options(options):
+        return json.dumps(options, sort_keys=True, default=str)
+
+    def append(self, entry, uid, start_time=None, motor=None, detector=None, options=None, config=None):
+        """
+        Record a fit, unless the same fit of the same scan is already there
+
+        Parameters
+        ----------
+        entry: dict
+            the fit, N2FitResult.to_entry()
+        uid: string
+            the uid of the run
+        start_time: float, optional
+            the start time of the run as a unix time, now if None
+        motor, detector: string, optional
+        options: dict, optional
+            the fit options
+        config: dict, optional
+            the beamline configuration of the run
+        """
+        def number(value):
+            return None if value is None else float(value)
+        # sigma is not a free parameter of the fits with fixed parameters, their sigma_err of 0 is no error
+        sigma_err = None if entry['fit_kwargs'].get('fix_param') else entry['sigma_err']
+        with self._connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (uid, motor, detector, self._options(options or {}),
+                                time.time() if start_time is None else float(start_time), time.time(),
+                                json.dumps(config or {}, sort_keys=True, default=str),
+                                number(entry['sigma']), number(sigma_err), number(entry['center']),
+                                number(entry['RP']), number(entry['vp_ratio']), int(bool(entry['success']))))
+
+    def recorded(self, uid, motor=None, detector=None, options=None):
+        """
+        Return True if the fit of the run uid with the options is recorded
+        """
+        with self._connect() as connection:
+            return connection.execute('''SELECT 1 FROM fits WHERE uid = ? AND motor IS ? AND detector IS ? AND options = ?''',
+                                      (uid, motor, detector, self._options(options or {}))).fetchone() is not None
+
+    def query(self, days=None, since=None, until=None, motor=None, detector=None, success=True, **config):
+        """
+        Return the recorded fits, oldest first
+
+        Parameters
+        ----------
+        days: float, optional
+            only the scans of the last days
+        since, until: float or datetime, optional
+            only the scans started from since and before until
+        motor, detector: string, optional
+            only the fits of this motor and detector
+        success: boolean or None
+            only the converged fits if True, all if None
+        config:
+            only the scans with these values of the configuration keys, a (low, high)
+            tuple for a range of numbers, for instance cff=(2, 3), grating='1200'
+
+        Return
+        --------
+        fits: dict of numpy.array
+            the columns 'uid', 'time', 'motor', 'detector', 'sigma', 'sigma_err',
+            'center', 'RP', 'RP_err', 'vp_ratio', 'success' and one per config key.
+            sigma_err and RP_err are nan for the fits with fixed parameters
+        """
+        unknown = set(config) - set(self.config_keys)
+        if unknown:
+            raise ValueError(f'{sorted(unknown)} are not in config_keys {self.config_keys}')
+        if days is not None:
+            since = time.time() - days*86400
+        conditions, values = [], []
+        for column, operator, value in [('time', '>=', since), ('time', '<', until)]:
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                values.append(value.timestamp() if hasattr(value, 'timestamp') else float(value))
+        for column, value in [('motor', motor), ('detector', detector)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                values.append(value)
+        if success is not None:
+            conditions.append('success = ?')
+            values.append(int(bool(success)))
+        for key, value in config.items():
+            if isinstance(value, tuple):
+                conditions.append(f"json_extract(config, '$.{key}') BETWEEN ? AND ?")
+                values.extend(value)
+            else:
+                conditions.append(f"json_extract(config, '$.{key}') = ?")
+                values.append(value)
+        selected = self.columns + [f"json_extract(config, '$.{key}')" for key in self.config_keys]
+        with self._connect() as connection:
+            rows = connection.execute(f'''SELECT {', '.join(selected)} FROM fits
+                                          {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+                                          ORDER BY time''', values).fetchall()
+        columns = list(zip(*rows)) if rows else [()]*len(selected)
+        fits = {}
+        for name, column in zip(self.columns + list(self.config_keys), columns):
+            if name in ('uid', 'motor', 'detector') or name in self.config_keys:
+                fits[name] = np.array(column, dtype=object)
+            elif name == 'success':
+                fits[name] = np.array(column, dtype=bool)
+            else:
+                fits[name] = np.array([np.nan if value is None else value for value in column], dtype=float)
+        # the fits with fixed parameters recorded before were stored with a sigma_err of 0
+        fits['sigma_err'][fits['sigma_err'] == 0] = np.nan
+        fits['RP_err'] = fits['RP']*fits['sigma_err']/fits['sigma']
+        return fits
+
+    def average(self, y='RP', **filters):
+        """
+        Return the mean of y weighted by its inverse variance over the fits query(**filters)
+        returns, and its error. The fits without an error on y are left out
+
+        Parameters
+        ----------
+        y: string
+            'RP' or 'sigma'
+        filters:
+            the arguments of query
+
+        Return
+        --------
+        mean, error: float, float
+            nan, nan if no fit has an error on y
+        """
+        if y not in ('RP', 'sigma'):
+            raise ValueError(f'only RP and sigma have errors, not {y!r}')
+        fits = self.query(**filters)
+        values, errors = fits[y], fits[y+'_err']
+        selected = np.isfinite(values) & np.isfinite(errors) & (errors > 0)
+        if not selected.any():
+            return np.nan, np.nan
+        weights = 1/errors[selected]**2
+        return float(np.sum(weights*values[selected])/np.sum(weights)), float(1/np.sqrt(np.sum(weights)))
+
+    def plot(self, x='time', y='RP', axes=None, **filters):
+        """
+        Plot y against x for the fits query(**filters) returns, with error bars for RP
+        and sigma, one series per value of the configuration keys which are neither
+        x nor filtered on
+
+        Parameters
+        ----------
+        x, y: string
+            the columns of query to plot, 'time' is shown as dates
+        axes: matplotlib axes, optional
+            where to plot, a new figure if None
+        filters:
+            the arguments of query
+
+        Return
+        --------
+        axes: matplotlib axes
+        """
+        fits = self.query(**filters)
+        if axes is None:
+            axes = plt.subplots(1, 1, figsize=(8.0, 5.0))[1]
+        groups = [key for key in self.config_keys if key != x and key not in filters]
+        labels = [tuple(values) for values in zip(*(fits[key] for key in groups))] if groups else [()]*len(fits['time'])
+        x_values = fits[x]
+        if x == 'time':
+            x_values = np.array(x_values*1e6, dtype='datetime64[us]')
+        errors = fits.get(y+'_err')
+        for label in sorted(set(labels), key=str):
+            selected = np.array([other == label for other in labels], dtype=bool)
+            axes.errorbar(x_values[selected], fits[y][selected], yerr=None if errors is None else errors[selected],
+                          fmt='o', capsize=2, label=', '.join(f'{key} {value}' for key, value in zip(groups, label)) or None)
+        axes.set_xlabel(x)
+        axes.set_ylabel(y)
+        if groups and len(set(labels)) > 1:
+            axes.legend()
+        return axes
+
+
+class RPMap:
+    """
+    The resolving power and the 1st valley over 3rd peak ratio over a grid of two
+    beamline parameters, for instance cff x exit slit, as made by N2_fit.rp_map
+
+      rp_map = N2fit_class.rp_map(grid_scan_uid, 'cff', 'exit_slit', gamma=0.0563)
+      rp_map.RP[i, j]      # at cff rp_map.x[i] and exit slit rp_map.y[j]
+      rp_map.plot()
+
+    Attributes
+    ----------
+    x_name, y_name : string
+        the names of the two parameters
+    x, y : numpy.array
+        their sorted values
+    RP, RP_err, vp_ratio, vp_ratio_err, sigma, sigma_err, center : numpy.array
+        of shape (len(x), len(y)), nan where there is no fit
+    status : numpy.array
+        the status of the fit of each cell as in N2_fit.fit_n2_many, 'missing' if
+        there is no scan and 'incomplete' if the scan of the cell did not finish
+    scans : numpy.array
+        the scan of each cell, 'uid[i,j]' for the cells of a grid scan
+    errors : dict
+        the scans which could not be read, with the error
+    """
+
+    def __init__(self, x_name, y_name, cells, errors=None):
+        self.x_name = x_name
+        self.y_name = y_name
+        self.x      = np.unique([cell['x'] for cell in cells]).astype(float)
+        self.y      = np.unique([cell['y'] for cell in cells]).astype(float)
+        self.errors = dict(errors or {})
+        shape = (len(self.x), len(self.y))
+        for name in ['RP', 'RP_err', 'vp_ratio', 'vp_ratio_err', 'sigma', 'sigma_err', 'center']:
+            setattr(self, name, np.full(shape, np.nan))
+        self.status = np.full(shape, 'missing', dtype=object)
+        self.scans  = np.full(shape, None, dtype=object)
+        fitted = ('ok', 'no uncertainties')
+        for cell in cells:
+            i = np.searchsorted(self.x, cell['x'])
+            j = np.searchsorted(self.y, cell['y'])
+            # a later scan of the same cell replaces the earlier one, unless only the earlier one has a fit
+            if self.status[i, j] in fitted and cell['status'] not in fitted:
+                continue
+            self.scans[i, j]  = cell['scan']
+            self.status[i, j] = cell['status']
+            for name in ['RP', 'RP_err', 'vp_ratio', 'vp_ratio_err', 'sigma', 'sigma_err', 'center']:
+                getattr(self, name)[i, j] = cell[name] if cell['status'] in fitted else np.nan
+
+    def plot(self, save_img=False):
+        """
+        Plot the RP and the valley/peak ratio maps in a new pyplot figure, the
+        values and their uncertainties are written in the cells of small maps
+
+        Parameters
+        ----------
+        save_img: boolean or string
+               if False no image is saved
+               if is a string the image will be saved with this name as pdf
+
+        Return
+        --------
+        fig : matplotlib figure
+        """
+        plt.rc("font", size=12,family='serif')
+        fig, axes = plt.subplots(1, 2, figsize=(14.0, 5.5))
+        for ax, name, label, digits in zip(axes, ['RP', 'vp_ratio'], ['RP', 'valley/peak'], [0, 3]):
+            values = getattr(self, name)
+            errors = getattr(self, name+'_err')
+            mesh = ax.pcolormesh(self.x, self.y, values.T, shading='nearest')
+            fig.colorbar(mesh, ax=ax, label=label)
+            if values.size <= 64:
+                for (i, j), value in np.ndenumerate(values):
+                    if np.isfinite(value):
+                        ax.text(self.x[i], self.y[j], f'{value:.{digits}f}\n±{errors[i, j]:.{digits}f}',
+                                ha='center', va='center', fontsize=8)
+            ax.set_xlabel(self.x_name)
+            ax.set_ylabel(self.y_name)
+            ax.set_title(label)
+        fig.tight_layout()
+        if save_img != False:
+            plt.savefig(save_img+'.pdf')
+        return fig
+
 
 class N2_fit:
     """
@@ -31,16 +1181,38 @@ class N2_fit:
     
       fit_n2(identifier,...)
 
+    Nothing is written to disk unless asked for. With cache=True the fits of scans
+    are kept in an N2FitCache in ~/.bessyii, pass an N2FitCache to choose where it
+    is kept and how large it gets.
+
+    With warm_start=True and a cache the fit of a scan starts from the converged fit
+    in the cache whose beamline configuration is the closest. The configuration is read
+    from the config_keys of the start document of the run or, if not there, from
+    its baseline fields named like them (pgm_cff for 'cff').
+
+    With trend=True, or an RPTrendStore, the fits of scans are also recorded with
+    their beamline configuration, n2.trend.plot('cff', 'RP', days=90) then shows the
+    trend without fitting again.
+
     """
-    def __init__(self, db):
+    def __init__(self, db, cache=None, config_keys=('cff', 'grating', 'exit_slit'), trend=None):
+        # None or False for no cache or trend store, True for the default ones
         self._db = db
+        if cache is True:
+            cache = N2FitCache()
+        self.cache = None if cache is False else cache
+        if trend is True:
+            trend = RPTrendStore(config_keys=config_keys)
+        self.trend = None if trend is False else trend
+        self.config_keys = config_keys
         self.tiny = 1.0e-15
         self.s2   = sqrt(2)
         self.s2pi = sqrt(2*pi)
         
-    def retrieve_spectra(self, identifier, motor=None, detector=None):
+    def retrieve_spectra(self, identifier, motor=None, detector=None, chunk_size=100000):
         """
-        Retrieve the motor and detector values from one scan
+        Retrieve the motor and detector values from one scan. Only these two fields
+        of the primary stream are read, chunk_size events at a time (see read_fields)
 
         Parameters
         ----------
@@ -55,6 +1227,8 @@ class N2_fit:
         detector : string
             the detector to retrieve, if more than one detector was used
             in the scan and we don't want to use the first one
+        chunk_size : int
+            the number of events read at once
 
         Return
         --------
@@ -71,13 +1245,45 @@ class N2_fit:
                 detector  = run.metadata['start']['detectors'][0]
             if motor == None:
                 motor = run.metadata['start']['motors'][0]
-            spectra   = run.primary.read()
-            x    = np.array(spectra[motor])
-            y = np.array(spectra[detector])
-
-            x,y = self.remove_neg_values(x,y)
+            # the negative values are removed chunk by chunk, so that only the kept values are gathered
+            chunks    = [self.remove_neg_values(x, y) for x, y in self.read_fields(run, [motor, detector], chunk_size)]
+            x    = np.concatenate([x for x, y in chunks])
+            y = np.concatenate([y for x, y in chunks])
         return x, y
 
+    def read_fields(self, run, fields, chunk_size=100000):
+        """
+        Read some fields of the primary stream of a run, without the others, for
+        instance not the QuadEM time series or the camera statistics of the scan.
+
+        With databroker's lazy (dask) streams the fields are read chunk_size events
+        at a time, otherwise the fields are read at once.
+
+        Parameters
+        ----------
+        run : databroker run
+        fields : list of string
+        chunk_size : int
+
+        Return
+        --------
+        chunks : iterator of list of np.array
+            for each chunk of events the values of the fields, in the order of fields
+        """
+        stream = run.primary
+        if hasattr(stream, 'to_dask'):
+            dataset = stream.to_dask()
+            arrays  = [dataset[field].data for field in fields]
+            for start in range(0, max(len(arrays[0]), 1), chunk_size):
+                yield [np.asarray(array[start:start+chunk_size]) for array in arrays]
+            return
+        try:
+            data = stream.read(variables=fields)
+        except TypeError:
+            # a stream which can only be read whole
+            data = stream.read()
+        yield [np.asarray(data[field]) for field in fields]
+
     def remove_neg_values(self, x,y):
         """
         Remove negative values from y and corresponding values from x
@@ -92,9 +1298,10 @@ class N2_fit:
         x,y : np.array
             two arrays without negative values
         """
-        ind = np.where(y < 0)
-        x = np.delete(x,ind[0])
-        y = np.delete(y,ind[0])
+        x, y = np.asarray(x), np.asarray(y)
+        keep = ~(y < 0)
+        x = x[keep]
+        y = y[keep]
         return x,y
 
     def config_SkewedVoigtModel(self, model_name, prefix_, value_center, value_center_min, value_center_max, value_sigma, value_sigma_min, value_sigma_max, value_amp, value_amp_min, value_gamma, value_gamma_min, value_skew, pars):
@@ -164,29 +1371,46 @@ class N2_fit:
         --------
         rms : np.array
         """
-        sum_data = 0
-        for i in data_:
-            sum_data = sum_data + i**2          
-        rms = np.sqrt((1/len(data_))*sum_data)
+        data_ = np.asarray(data_)
+        rms = np.sqrt(np.dot(data_, data_)/len(data_))
         return rms
 
     def find_nearest_idx(self, array, value):
         """
-        Find the index of the values in array closer to value
+        Find the index of the values in array closer to value, the first one
+        if two are as close
 
         Parameters
         ----------
         array : numpy.array
-        value : int or float     
+        value : int or float or numpy.array
+             with an array of values, the indices of all of them are found at once
 
 
         Return
         --------
-        idx : int
+        idx : int or numpy.array
         """
         array = np.asarray(array)
-        idx = (np.abs(array - value)).argmin()
-        return idx
+        value = np.asarray(value, dtype=float)
+        step  = np.diff(array)
+        if array.size > 1 and (np.all(step >= 0) or np.all(step <= 0)):
+            # a scan in one direction, found by bisection
+            ascending = array[-1] >= array[0]
+            ordered   = array if ascending else array[::-1]
+            def first_past(values):
+                # the first index at or past values in the direction of the scan
+                if ascending:
+                    return np.searchsorted(ordered, values, side='left')
+                return array.size - np.searchsorted(ordered, values, side='right')
+            right = np.clip(first_past(value), 1, array.size-1)
+            left  = right - 1
+            idx   = np.where(np.abs(array[left]-value) <= np.abs(array[right]-value), left, right)
+            # the first of repeated positions
+            idx   = first_past(array[idx])
+        else:
+            idx = np.array([np.abs(array - v).argmin() for v in value.ravel()]).reshape(value.shape)
+        return idx[()] if idx.ndim == 0 else idx
 
     def guess_amp(self, x,y,vc):
         """
@@ -197,15 +1421,16 @@ class N2_fit:
         ----------
         x : numpy.array
         y : numpy.array
-        vc : int or float     
+        vc : int or float or numpy.array
+             the amplitudes at several values are guessed at once from an array
 
 
         Return
         --------
-        amp : float
+        amp : float or numpy.array
         """
         idx = self.find_nearest_idx(x,vc)
-        amp = y[idx]
+        amp = np.asarray(y)[idx]
         return amp
 
     def find_first_max(self, x,y,fwhm):
@@ -231,19 +1456,17 @@ class N2_fit:
         step    = x[1]-x[0]
         ind     = int(fwhm/step/1) 
         n_steps = int(x.shape[0]/ind)
-        for i in range(n_steps):
-            if i == 0:
-                amax    = np.max(y[i*ind:i*ind+ind])
-                argmax  = np.argmax(y[i*ind:i*ind+ind])
-            else:
-                tmax    = np.max(y[i*ind:i*ind+ind])
-                targmax = np.argmax(y[i*ind:i*ind+ind]) +i*ind
-                if tmax <= amax and amax > 0.8:
-                    break
-                if tmax >= amax:
-                    amax = tmax
-                    argmax = targmax           
-        return x[argmax]
+        # the max of every window at once
+        windows = np.asarray(y)[:n_steps*ind].reshape(n_steps, ind)
+        wmax    = windows.max(axis=1)
+        wargmax = windows.argmax(axis=1) + np.arange(n_steps)*ind
+        # the scan stops at the first window not above the max so far once it is > 0.8
+        amax    = np.maximum.accumulate(wmax)
+        stop    = np.flatnonzero((wmax[1:] <= amax[:-1]) & (amax[:-1] > 0.8))
+        end     = stop[0]+1 if stop.size else n_steps
+        # the last window reaching the max, as a later window as high replaces the max
+        last    = np.flatnonzero(wmax[:end] == amax[end-1])[-1]
+        return x[wargmax[last]]
 
     def extract_RP_fwhm_g(self, params_dict, fix_param=False):
         """
@@ -299,9 +1522,7 @@ class N2_fit:
             cen_v2   = params_dict['v2_center'].value
             cen_v3   = params_dict['v3_center'].value 
 
-            ind_cen_v1 = self.find_nearest_idx(x, cen_v1)
-            ind_cen_v2 = self.find_nearest_idx(x, cen_v2)
-            ind_cen_v3 = self.find_nearest_idx(x, cen_v3)
+            ind_cen_v1, ind_cen_v2, ind_cen_v3 = self.find_nearest_idx(x, [float(cen_v1), float(cen_v2), float(cen_v3)])
             cen_valley = x[np.argmin(y[ind_cen_v1:ind_cen_v2])]
             bg_v3      = params_dict['lin_slope']*cen_v3+params_dict['lin_intercept']
             bg_valley  = params_dict['lin_slope']*cen_valley+params_dict['lin_intercept']
@@ -313,9 +1534,7 @@ class N2_fit:
             cen_v2   = params_dict['c2']
             cen_v3   = params_dict['c3'] 
 
-            ind_cen_v1 = self.find_nearest_idx(x, cen_v1)
-            ind_cen_v2 = self.find_nearest_idx(x, cen_v2)
-            ind_cen_v3 = self.find_nearest_idx(x, cen_v3)
+            ind_cen_v1, ind_cen_v2, ind_cen_v3 = self.find_nearest_idx(x, [float(cen_v1), float(cen_v2), float(cen_v3)])
             cen_valley = x[np.argmin(y[ind_cen_v1:ind_cen_v2])]
             #bg_v3      = params_dict['lin_slope']*cen_v3+params_dict['lin_intercept']
             #bg_valley  = params_dict['lin_slope']*cen_valley+params_dict['lin_intercept']
@@ -332,18 +1551,19 @@ class N2_fit:
     # tiny had been numpy.finfo(numpy.float64).eps ~=2.2e16.
     # here, we explicitly set it to 1.e-15 == numpy.finfo(numpy.float64).resolution
 
-    def voigt(self, x, amplitude=1.0, center=0.0, sigma=1.0, gamma=None):
+    def voigt(self, x, amplitude=1.0, center=0.0, sigma=1.0, gamma=None, faddeeva=wofz):
         """Return a 1-dimensional Voigt function.
         voigt(x, amplitude, center, sigma, gamma) =
             amplitude*wofz(z).real / (sigma*s2pi)
         For more information, see: https://en.wikipedia.org/wiki/Voigt_profile
+        faddeeva is the function evaluated in place of wofz, see faddeeva_function
         """
         if gamma is None:
             gamma = sigma
         z = (x-center + 1j*gamma) / max(self.tiny, (sigma*self.s2))
-        return amplitude*wofz(z).real / max(self.tiny, (sigma*self.s2pi))
+        return amplitude*faddeeva(z).real / max(self.tiny, (sigma*self.s2pi))
 
-    def skewed_voigt(self, x, amplitude=1.0, center=0.0, sigma=1.0, gamma=None, skew=0.0):
+    def skewed_voigt(self, x, amplitude=1.0, center=0.0, sigma=1.0, gamma=None, skew=0.0, faddeeva=wofz):
         """Return a Voigt lineshape, skewed with error function.
         Equal to: voigt(x, center, sigma, gamma)*(1+erf(beta*(x-center)))
         where ``beta = skew/(sigma*sqrt(2))``
@@ -354,70 +1574,194 @@ class N2_fit:
         """
         beta = skew/max(self.tiny, (self.s2*sigma))
         asym = 1 + erf(beta*(x-center))
-        return asym * self.voigt(x, amplitude, center, sigma, gamma=gamma)
-
-    def n2_model(self, x, a1,a2,a3,a4,a5,a6,a7, c1,c2,c3,c4,c5,c6,c7, sigma,gamma,skew):
-        tw = self.skewed_voigt(x,amplitude=a1,  center=c1,  sigma=sigma,  gamma=gamma,  skew=skew) +\
-             self.skewed_voigt(x,amplitude=a2,  center=c2,  sigma=sigma,  gamma=gamma,  skew=skew)+\
-             self.skewed_voigt(x,amplitude=a3,  center=c3,  sigma=sigma,  gamma=gamma,  skew=skew)+\
-             self.skewed_voigt(x,amplitude=a4,  center=c4,  sigma=sigma,  gamma=gamma,  skew=skew)+\
-             self.skewed_voigt(x,amplitude=a5,  center=c5,  sigma=sigma,  gamma=gamma,  skew=skew)+\
-             self.skewed_voigt(x,amplitude=a6,  center=c6,  sigma=sigma,  gamma=gamma,  skew=skew)+\
-             self.skewed_voigt(x,amplitude=a7,  center=c7,  sigma=sigma,  gamma=gamma,  skew=skew)
+        return asym * self.voigt(x, amplitude, center, sigma, gamma=gamma, faddeeva=faddeeva)
+
+    def n2_model(self, x, a1,a2,a3,a4,a5,a6,a7, c1,c2,c3,c4,c5,c6,c7, sigma,gamma,skew, faddeeva=wofz, jit=False):
+        if jit:
+            # the numba kernel, see _use_jit
+            return _jit_skewed_voigt_peaks(x, [a1,a2,a3,a4,a5,a6,a7], [c1,c2,c3,c4,c5,c6,c7],
+                                           np.full(7, sigma), np.full(7, gamma), np.full(7, skew))
+        f = faddeeva
+        tw = self.skewed_voigt(x,amplitude=a1,  center=c1,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f) +\
+             self.skewed_voigt(x,amplitude=a2,  center=c2,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)+\
+             self.skewed_voigt(x,amplitude=a3,  center=c3,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)+\
+             self.skewed_voigt(x,amplitude=a4,  center=c4,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)+\
+             self.skewed_voigt(x,amplitude=a5,  center=c5,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)+\
+             self.skewed_voigt(x,amplitude=a6,  center=c6,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)+\
+             self.skewed_voigt(x,amplitude=a7,  center=c7,  sigma=sigma,  gamma=gamma,  skew=skew, faddeeva=f)
 
              #skewed_voigt(x,amplitude=a8,  center=c8,  sigma=sigma,  gamma=gamma,  skew=skew)+\
              #skewed_voigt(x,amplitude=a9,  center=c9,  sigma=sigma,  gamma=gamma,  skew=skew)+\
              #skewed_voigt(x,amplitude=a10, center=c10, sigma=sigma,  gamma=gamma,  skew=skew)
         return tw
 
-    # internal fit routine
-    def _fit_n2(self, x,y, print_fit_results=False, save_img=False,fit_data=True, 
-                vc1='auto', amp_sf=6,sigma = 0.02, sigma_min=0.001,sigma_max=0.02,gamma=0.055, fix_param=False):
+    ##########################
+    # analytic derivatives, passed to leastsq in place of finite differences
+
+    def skewed_voigt_derivatives(self, x, amplitude=1.0, center=0.0, sigma=1.0, gamma=None, skew=0.0, faddeeva=wofz):
         """
-        This function performs a fit on the array x and y of a nitrogen spectra. 
-        The initial guess of the fit can be modified via the arguments.
+        Return the derivatives of skewed_voigt with respect to its parameters.
+
+        With z = (x-center+1j*gamma)/(sigma*sqrt(2)) the derivative of the Faddeeva
+        function is w'(z) = -2*z*w(z) + 2j/sqrt(pi), and the skew term
+        1+erf(u) with u = skew*(x-center)/(sigma*sqrt(2)) has derivative
+        2/sqrt(pi)*exp(-u**2)
 
         Parameters
-        ----------
-        x : numpy.array
-             the motor position array
-        y : numpy.array
-              the detector readings array
-        print_fit_results: boolean
-               if True the fit results report from lm fit is printed on the terminal
-        save_img: boolean or string
-               if False no image is saved
-               if is a string use the image will be saved with this name 
-               (include the extension: pdf,png,jpg...)
-        fit_data: boolean
-               If False the data and the initial guess will be shown
-               If True the fit will be performed
-        vc1: string or float:
-               If 'auto' the first max will be guessed automatically
-               if the automatic guess fails input the position of the first max
-        amp_sf: int or float
-               scaling factor for the amplitude. empirically a value of 6 works well
-        sigma: int or float
-               the sigma of the gaussian contribution to the voigt peak   
-        sigma_min: int or float
-               the lower bound for the sigma parameter for the fit
-        sigma_max: int or float
-               the upper bound for the sigma parameter for the fit
-        gamma: int or float
-               the gamma of the loretzian contribution to the voigt peak
-        fix_param: boolean
-               two rountines can be used
-               if True, the sigma and gamma and skew of all the seven peaks are the same
-               if False, the sigma and gamma and skew of all the seven peaks are indipendent
+        ----------
+        x : numpy.array
+        amplitude, center, sigma, gamma, skew: float or numpy.array
+             the parameters of skewed_voigt, arrays of shape (n_peaks, 1)
+             give the derivatives of n_peaks peaks at once
+        faddeeva: callable
+             the Faddeeva function, see faddeeva_function
 
         Return
         --------
-        sigma_v2, center_v1,sigma_v2_err, vp_ratio: float
+        derivatives: dict
+             the derivatives with keys 'amplitude', 'center', 'sigma', 'gamma' and 'skew'
         """
-        # normalize intensity
-        norm = np.max(y)
-        y = y/norm
+        if gamma is None:
+            gamma = sigma
+        sigma_s2 = np.maximum(self.tiny, sigma*self.s2)
+        norm     = np.maximum(self.tiny, sigma*self.s2pi)
+        dx       = x-center
+        z        = (dx + 1j*gamma) / sigma_s2
+        w        = faddeeva(z)
+        dw       = -2*z*w + 2j/sqrt(pi)
+        u        = skew*dx/sigma_s2
+        asym     = 1 + erf(u)
+        dasym    = 2/sqrt(pi)*exp(-u**2)
+        shape    = w.real/norm
+        voigt    = amplitude*shape
+
+        return {'amplitude': asym*shape,
+                'center':    asym*amplitude*(-dw.real/sigma_s2)/norm - voigt*dasym*skew/sigma_s2,
+                'sigma':     asym*amplitude*((-dw*z).real/sigma - w.real/sigma)/norm - voigt*dasym*u/sigma,
+                'gamma':     asym*amplitude*(-dw.imag/sigma_s2)/norm,
+                'skew':      voigt*dasym*dx/sigma_s2}
+
+    def n2_jacobian(self, params, x, fix_param=False, faddeeva=wofz):
+        """
+        Return the derivatives of the model built by _fit_n2 with respect to every
+        parameter in params, for the fixed parameters model (a1..a7, c1..c7, sigma,
+        gamma, skew) or the SkewedVoigtModel components with prefixes v1_, v2_...
+        plus the linear background
+
+        Parameters
+        ----------
+        params : lmfit Parameters
+        x : numpy.array
+        fix_param : boolean
+             True if the routine with fixed parameters is being used
+             otherwise False
+        faddeeva: callable
+             the Faddeeva function, see faddeeva_function
 
+        Return
+        --------
+        derivatives: dict
+             the derivative for each parameter name
+        """
+        values = params.valuesdict()
+        derivatives = {'lin_slope': x, 'lin_intercept': np.ones_like(x)}
+        if fix_param == False:
+            prefixes = [name[:-len('center')] for name in values if name.startswith('v') and name.endswith('_center')]
+            keys     = ['amplitude', 'center', 'sigma', 'gamma', 'skew']
+            d = self.skewed_voigt_derivatives(x, faddeeva=faddeeva,
+                                              **{key: np.array([values[prefix+key] for prefix in prefixes])[:, None] for key in keys})
+            for key in keys:
+                for prefix, derivative in zip(prefixes, d[key]):
+                    derivatives[prefix+key] = derivative
+        else:
+            for key in ['sigma', 'gamma', 'skew']:
+                derivatives[key] = np.zeros_like(x)
+            i = 1
+            while 'a'+str(i) in values:
+                d = self.skewed_voigt_derivatives(x, amplitude=values['a'+str(i)], center=values['c'+str(i)],
+                                                  sigma=values['sigma'], gamma=values['gamma'], skew=values['skew'],
+                                                  faddeeva=faddeeva)
+                derivatives['a'+str(i)] = d['amplitude']
+                derivatives['c'+str(i)] = d['center']
+                for key in ['sigma', 'gamma', 'skew']:
+                    derivatives[key] += d[key]
+                i += 1
+        return derivatives
+
+    def _make_jacobian(self, fix_param=False, faddeeva='wofz', jit=False):
+        """
+        Return the Dfun for lmfit's leastsq: the columns of the jacobian of the
+        residual data-model for the varied parameters, in the order lmfit uses for them.
+        With jit they are computed by the numba kernel, see _jit_jacobian
+        """
+        if _use_jit(jit):
+            def jacobian(params, data, weights, x=None):
+                return self._jit_jacobian(params, x, weights, fix_param=fix_param)
+            return jacobian
+
+        faddeeva = faddeeva_function(faddeeva)
+
+        def jacobian(params, data, weights, x=None):
+            derivatives = self.n2_jacobian(params, x, fix_param=fix_param, faddeeva=faddeeva)
+            jac = -np.array([derivatives[name] for name, par in params.items() if par.vary and not par.expr])
+            if weights is not None:
+                jac = jac*weights
+            return jac
+        return jacobian
+
+    def _jit_jacobian(self, params, x, weights, fix_param=False):
+        """
+        Return the columns of the jacobian of the residual data-model for the varied
+        parameters, as the Dfun of _make_jacobian, computed in one pass over the
+        peaks and the points by the numba kernel n2fit_jit.skewed_voigt_peaks_jacobian
+        """
+        varied = [name for name, par in params.items() if par.vary and not par.expr]
+        row    = {name: i for i, name in enumerate(varied)}
+        values = params.valuesdict()
+        if fix_param == False:
+            prefixes = [name[:-len('center')] for name in values if name.startswith('v') and name.endswith('_center')]
+            names    = [[prefix+key for key in ['amplitude', 'center', 'sigma', 'gamma', 'skew']] for prefix in prefixes]
+        else:
+            # the peaks share sigma, gamma and skew, their derivatives add up in the same row
+            names = []
+            while 'a'+str(len(names)+1) in values:
+                i = str(len(names)+1)
+                names.append(['a'+i, 'c'+i, 'sigma', 'gamma', 'skew'])
+        arrays  = np.array([[values[name] for name in peak] for peak in names], dtype=float).T.copy()
+        rows    = np.array([[row.get(name, -1) for name in peak] for peak in names], dtype=np.intp)
+        x       = np.ascontiguousarray(x, dtype=float)
+        weights = np.empty(0) if weights is None else np.ascontiguousarray(np.broadcast_to(weights, x.shape), dtype=float)
+        table   = _faddeeva_table()
+        jac     = np.zeros((len(varied), x.shape[0]))
+        _jit_kernels().skewed_voigt_peaks_jacobian(x, *arrays, rows, weights, table._coefficients, table._n, table.step,
+                                                   table.radius, table.terms, jac)
+        for name, derivative in [('lin_slope', x), ('lin_intercept', 1.0)]:
+            if name in row:
+                jac[row[name]] = -derivative*(weights if weights.size else 1.0)
+        return jac
+
+    def _make_n2_model(self, x, y, vc1='auto', amp_sf=6, sigma=0.02, sigma_min=0.001, sigma_max=0.02, gamma=0.055,
+                       fix_param=False, n_peaks=10, start=None, faddeeva='wofz', jit=False):
+        """
+        Build the model of the N2 spectrum and its initial parameters from the
+        normalized spectrum, see _fit_n2 for the arguments. faddeeva is the name
+        of the Faddeeva function of the Voigt profiles, see faddeeva_function, and
+        jit evaluates the model with numba if it is installed, see _use_jit
+
+        If start is given, the initial parameters are its values (the best fit values of
+        a previous fit) instead of the ones guessed from the spectrum, and the bounds
+        of the centers and amplitudes follow them. The sigma, gamma and skew of each
+        peak of the free model are not taken from start: sigma and gamma trade off
+        against each other, and from a previous optimum leastsq crawls along that
+        valley for thousands of evaluations, or runs the skew of a peak outside the
+        spectrum away
+
+        Return
+        --------
+        mod, pars, dict_fit: lmfit Model, lmfit Parameters, dict
+            dict_fit describes the peaks of the fit with independent parameters,
+            it is None for the fixed parameters fit
+        """
         centers       = np.array([400.58,400.805,401.02,401.22,401.46,401.68,401.87,402.05,402.24])
         diff_centers  = np.abs(400.345-centers)
         #print('diff_centers',diff_centers)
@@ -434,40 +1778,36 @@ class N2_fit:
         lin_slope = 0.0000001
         #vc1 = 'auto'
 
-        if vc1 == 'auto':
+        if vc1 == 'auto' and start is not None:
+            vc1 = start['v1_center' if fix_param == False else 'c1']
+        elif vc1 == 'auto':
             vc1 = self.find_first_max(x,y, fwhm)
 
         if fix_param == False:
-            guess = {'vc1': vc1,                  'amp1':np.max(y)/amp_sf,
-                    'vc2': vc1+diff_centers[0],  'amp2':self.guess_amp(x,y,vc1+diff_centers[0])/amp_sf,
-                    'vc3': vc1+diff_centers[1],  'amp3':self.guess_amp(x,y,vc1+diff_centers[1])/amp_sf,
-                    'vc4': vc1+diff_centers[2],  'amp4':self.guess_amp(x,y,vc1+diff_centers[2])/amp_sf,
-                    'vc5': vc1+diff_centers[3],  'amp5':self.guess_amp(x,y,vc1+diff_centers[3])/amp_sf,
-                    'vc6': vc1+diff_centers[4],  'amp6':self.guess_amp(x,y,vc1+diff_centers[4])/amp_sf,
-                    'vc7': vc1+diff_centers[5],  'amp7':self.guess_amp(x,y,vc1+diff_centers[5])/amp_sf,
-                    'vc8': vc1+diff_centers[6],  'amp8':self.guess_amp(x,y,vc1+diff_centers[6])/amp_sf,
-                    'vc9': vc1+diff_centers[7],  'amp9':self.guess_amp(x,y,vc1+diff_centers[7])/amp_sf,
-                    'vc10':vc1+diff_centers[8],  'amp10':self.guess_amp(x,y,vc1+diff_centers[8])/amp_sf,
-                    }
-            #for key in guess.keys():
-            #    print (key, guess[key])
+            if not 1 <= n_peaks <= len(centers)+1:
+                raise ValueError(f'n_peaks must be between 1 and {len(centers)+1}')
+            guess = {'vc1': vc1, 'amp1': np.max(y)/amp_sf}
+            amps  = self.guess_amp(x,y,vc1+diff_centers[:n_peaks-1])/amp_sf
+            for i in range(2, n_peaks+1):
+                guess['vc'+str(i)]  = vc1+diff_centers[i-2]
+                guess['amp'+str(i)] = amps[i-2]
             #                    'prefix_', value_center,    center_min,         center_max,         sigma,  sigma_min,  sigma_max,  amp,           amp_min, gamma, skew]
-            dict_fit = {'voigt1': ['v1_',   guess['vc1'],    guess['vc1']-fwhm,  guess['vc1']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp1'],  guess['amp1']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt2': ['v2_',   guess['vc2'],    guess['vc2']-fwhm,  guess['vc2']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp2'],  guess['amp2']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt3': ['v3_',   guess['vc3'],    guess['vc3']-fwhm,  guess['vc3']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp3'],  guess['amp3']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt4': ['v4_',   guess['vc4'],    guess['vc4']-fwhm,  guess['vc4']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp4'],  guess['amp4']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt5': ['v5_',   guess['vc5'],    guess['vc5']-fwhm,  guess['vc5']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp5'],  guess['amp5']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt6': ['v6_',   guess['vc6'],    guess['vc6']-fwhm,  guess['vc6']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp6'],  guess['amp6']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt7': ['v7_',   guess['vc7'],    guess['vc7']-fwhm,  guess['vc7']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp7'],  guess['amp7']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt8': ['v8_',   guess['vc8'],    guess['vc8']-fwhm,  guess['vc8']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp8'],  guess['amp8']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt9': ['v9_',   guess['vc9'],    guess['vc9']-fwhm,  guess['vc9']+fwhm,  sigma,  sigma_min,  sigma_max,  guess['amp9'],  guess['amp9']/amp_mf,   gamma, gamma_min, 0.0],
-                        'voigt10': ['v10_', guess['vc10'],   guess['vc10']-fwhm, guess['vc10']+fwhm, sigma,  sigma_min,  sigma_max,  guess['amp10'], guess['amp10']/amp_mf,   gamma, gamma_min, 0.0]
-                    }
-
-            #for key in dict_fit.keys():
-            #    print (key, dict_fit[key])
-            pars = Parameters()
-
+            dict_fit = {}
+            for i in range(1, n_peaks+1):
+                vc, amp = guess['vc'+str(i)], guess['amp'+str(i)]
+                dict_fit['voigt'+str(i)] = ['v'+str(i)+'_', vc, vc-fwhm, vc+fwhm, sigma, sigma_min, sigma_max, amp, amp/amp_mf, gamma, gamma_min, 0.0]
+
+            # all the peaks are evaluated together by one model,
+            # with the same parameters as SkewedVoigtModel(prefix='v1_') + SkewedVoigtModel(prefix='v2_') + ...
+            peaks_mod = SkewedVoigtPeaksModel(n_peaks, faddeeva=faddeeva_function(faddeeva), jit=jit)
+            pars = peaks_mod.make_params()
+            for prefix_, value_center, value_center_min, value_center_max, value_sigma, value_sigma_min, value_sigma_max, \
+                    value_amp, value_amp_min, value_gamma, value_gamma_min, value_skew in dict_fit.values():
+                pars[''.join((prefix_, 'center'))].set(     value=value_center, min=value_center_min, max=value_center_max                    )
+                pars[''.join((prefix_, 'sigma'))].set(      value=value_sigma,  min=value_sigma_min,  max=value_sigma_max                     )
+                pars[''.join((prefix_, 'amplitude'))].set(  value=value_amp,    min=value_amp_min                                             )
+                pars[''.join((prefix_, 'gamma'))].set(      value=value_gamma,  min=value_gamma_min                                           )
+                pars[''.join((prefix_, 'skew'))].set(       value=value_skew                                                                  )
 
             ################################################################################
             ################################################################################
@@ -477,50 +1817,22 @@ class N2_fit:
             #
             pars['lin_slope'].set(value=lin_slope)
             pars['lin_intercept'].set(value=np.average(y[-10:]))
-            mod = lin_mod
-
-            for key in list(dict_fit.keys()):
-                model_name       = key
-                prefix_          = dict_fit[key][0]
-                value_center     = dict_fit[key][1]
-                value_center_min = dict_fit[key][2]
-                value_center_max = dict_fit[key][3]
-                value_sigma      = dict_fit[key][4]
-                value_sigma_min  = dict_fit[key][5] 
-                value_sigma_max  = dict_fit[key][6]
-                value_amp        = dict_fit[key][7]
-                value_amp_min    = dict_fit[key][8]
-                value_gamma      = dict_fit[key][9]
-                value_gamma_min  = dict_fit[key][10]
-                value_skew       = dict_fit[key][11]
-
-                fit = self.config_SkewedVoigtModel(model_name, prefix_, 
-                                            value_center, value_center_min, value_center_max, 
-                                            value_sigma, value_sigma_min, value_sigma_max, 
-                                            value_amp, value_amp_min, 
-                                            value_gamma, value_gamma_min, 
-                                            value_skew, 
-                                            pars)
-                if key == 'voigt1':
-                    mod = fit
-                else:
-                    mod = mod + fit
 
-
-            mod = mod + lin_mod   
+            mod = peaks_mod + lin_mod
 
         elif fix_param == True:
-            print('Using fixed parameters fit')
+            logger.debug('Using fixed parameters fit')
+            amps  = self.guess_amp(x,y,vc1+diff_centers)/amp_sf
             guess = {'vc1': vc1,                  'amp1':np.max(y)/amp_sf,
-             'vc2': vc1+diff_centers[0],  'amp2':self.guess_amp(x,y,vc1+diff_centers[0])/amp_sf,
-             'vc3': vc1+diff_centers[1],  'amp3':self.guess_amp(x,y,vc1+diff_centers[1])/amp_sf,
-             'vc4': vc1+diff_centers[2],  'amp4':self.guess_amp(x,y,vc1+diff_centers[2])/amp_sf,
-             'vc5': vc1+diff_centers[3],  'amp5':self.guess_amp(x,y,vc1+diff_centers[3])/amp_sf,
-             'vc6': vc1+diff_centers[4],  'amp6':self.guess_amp(x,y,vc1+diff_centers[4])/amp_sf,
-             'vc7': vc1+diff_centers[5],  'amp7':self.guess_amp(x,y,vc1+diff_centers[5])/amp_sf,
-             'vc8': vc1+diff_centers[6],  'amp8':self.guess_amp(x,y,vc1+diff_centers[6])/amp_sf,
-             'vc9': vc1+diff_centers[7],  'amp9':self.guess_amp(x,y,vc1+diff_centers[7])/amp_sf,
-             'vc10':vc1+diff_centers[8],  'amp10':self.guess_amp(x,y,vc1+diff_centers[8])/amp_sf,
+             'vc2': vc1+diff_centers[0],  'amp2':amps[0],
+             'vc3': vc1+diff_centers[1],  'amp3':amps[1],
+             'vc4': vc1+diff_centers[2],  'amp4':amps[2],
+             'vc5': vc1+diff_centers[3],  'amp5':amps[3],
+             'vc6': vc1+diff_centers[4],  'amp6':amps[4],
+             'vc7': vc1+diff_centers[5],  'amp7':amps[5],
+             'vc8': vc1+diff_centers[6],  'amp8':amps[6],
+             'vc9': vc1+diff_centers[7],  'amp9':amps[7],
+             'vc10':vc1+diff_centers[8],  'amp10':amps[8],
             }
 
             pars = Parameters()
@@ -532,7 +1844,8 @@ class N2_fit:
             pars['lin_intercept'].set(value=np.average(y[-10:]))
 
 
-            mod = Model(self.n2_model) + lin_mod
+            # faddeeva and jit are not parameters, lmfit passes them to n2_model as options
+            mod = Model(self.n2_model, faddeeva=faddeeva_function(faddeeva), jit=_use_jit(jit)) + lin_mod
            # pars = mod.make_params(a1=guess['amp1'],a2=guess['amp2'],a3=guess['amp3'],a4=guess['amp4'],a5=guess['amp5'],
            #                 a6=guess['amp6'],a7=guess['amp7'],a8=guess['amp8'],a9=guess['amp9'],a10=guess['amp10'], 
            #                 c1=guess['vc1'],c2=guess['vc2'],c3=guess['vc3'],c4=guess['vc4'],c5=guess['vc5'],
@@ -544,143 +1857,438 @@ class N2_fit:
                             c6=guess['vc6'],c7=guess['vc7'], 
                             sigma=0.02,gamma=0.055,skew=0, lin_slope=lin_slope, lin_intercept=np.average(y[-10:]))
 
-        #################################################################################
-        ################################################################################
-        # 
-        init = mod.eval(pars, x=x)
-
-
-        # here it plots the intial guesses if fit=False
-        if fit_data == False:
-            plt.rc("font", size=12,family='serif')
-            fig, axes = plt.subplots(1, 1, figsize=(8.0, 16.0))
-            axes.plot(x, init, 'orange' ,label='initial guess')
-            axes.scatter(x, y, label='data')
-            #axes.set_ylim(-.05,1.1)
-            return None,None,None,None,None
-
-
-        #from timer import Timer 
-        #t1 = Timer()
-
-        #t1.start()
-        out = mod.fit(y, pars, x=x)
-        delta = out.eval_uncertainty(x=x)
-        if print_fit_results == True:
-            print(out.fit_report(min_correl=0.5))
+            dict_fit = None
+
+        if start is not None:
+            for name, value in start.items():
+                if name not in pars or pars[name].expr:
+                    continue
+                if fix_param == False and name.endswith(('_sigma', '_gamma', '_skew')):
+                    continue
+                if name.endswith('_center'):
+                    pars[name].set(min=value-fwhm, max=value+fwhm)
+                elif name.endswith('_amplitude'):
+                    pars[name].set(min=value/amp_mf)
+                pars[name].set(value=np.clip(value, pars[name].min, pars[name].max))
+
+        return mod, pars, dict_fit
+
+    def fit_spectrum(self, x, y, vc1='auto', amp_sf=6, sigma=0.02, sigma_min=0.001, sigma_max=0.02, gamma=0.055,
+                     fix_param=False, jacobian=True, n_peaks=10, start=None, coarse=None, jitter=None, faddeeva='wofz',
+                     jit=False):
+        """
+        Fit a N2 spectrum without plotting anything, see _fit_n2 for the arguments.
+        start are the parameter values to start from, see _make_n2_model. jitter is
+        the seed of random initial parameters drawn around the usual ones, see jitter_params
 
-        ####
-        # axes 0
-        plt.rc("font", size=12,family='serif')
-        fig, axes = plt.subplots(3, 1, figsize=(8.0, 16.0))
-        #
-        # initial fit
-        axes[0].plot(x, out.init_fit, 'orange' ,label='initial guess')
-        #
-        axes[0].scatter(x, y, label='data', s=10)
-        #axes[0].plot(x, init, '--', label='initial fit')
-        axes[0].plot(x, out.best_fit, 'r', label='best fit')
-        axes[0].fill_between(x,out.best_fit-delta,out.best_fit+delta,color='gray',alpha=0.4, label='fit uncertainty')
+        Return
+        --------
+        result: N2FitResult
+            the values extracted from the fit, with the figures made on request.
+            result.stages has the number of points, of model evaluations and the
+            time in s of each stage of the fit
+        """
+        # normalize intensity
+        norm = np.max(y)
+        y = y/norm
+        model_kwargs = dict(vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min, sigma_max=sigma_max, gamma=gamma,
+                            fix_param=fix_param, n_peaks=n_peaks, faddeeva=faddeeva, jit=jit)
+        fit_kws = {'Dfun': self._make_jacobian(fix_param=fix_param, faddeeva=faddeeva, jit=jit), 'col_deriv': 1} if jacobian else None
+        stages = {}
+
+        fine_start = start
+        # bins wider than a quarter of sigma smear the peaks and the binned fit wanders off
+        n_bin = 1 if coarse is None else min(int(coarse), int(sigma/4/np.median(np.abs(np.diff(x)))))
+        if n_bin > 1:
+            # converge on the binned spectrum, then refine on the full resolution around the peaks
+            t0 = time.perf_counter()
+            x_coarse, y_coarse = self.bin_spectrum(x, y, n_bin)
+            mod, pars, dict_fit = self._make_n2_model(x_coarse, y_coarse, start=start, **model_kwargs)
+            self.jitter_params(pars, jitter, fwhm=2.355*sigma*2)
+            out = mod.fit(y_coarse, pars, x=x_coarse, fit_kws=fit_kws)
+            stages['coarse'] = {'points': len(x_coarse), 'bin': n_bin, 'nfev': out.nfev, 'time': time.perf_counter()-t0}
+            fine_start = out.params.valuesdict()
+            x, y = self.peaks_window(x, y, fine_start, fwhm=2.355*sigma*2)
+
+        t0 = time.perf_counter()
+        mod, pars, dict_fit = self._make_n2_model(x, y, start=fine_start, **model_kwargs)
+        if n_bin <= 1:
+            self.jitter_params(pars, jitter, fwhm=2.355*sigma*2)
+        out = mod.fit(y, pars, x=x, fit_kws=fit_kws)
+        stages['fine' if stages else 'full'] = {'points': len(x), 'nfev': out.nfev, 'time': time.perf_counter()-t0}
+
+        fit_kwargs = dict(vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min, sigma_max=sigma_max, gamma=gamma,
+                          jacobian=jacobian, n_peaks=n_peaks, coarse=coarse)
+        if start is not None:
+            fit_kwargs['start'] = start
+        if jitter is not None:
+            fit_kwargs['jitter'] = jitter
+        if faddeeva != 'wofz':
+            fit_kwargs['faddeeva'] = faddeeva
+        if jit:
+            fit_kwargs['jit'] = jit
+        result = N2FitResult(self, x, y, out, dict_fit=dict_fit, fix_param=fix_param, norm=norm, fit_kwargs=fit_kwargs)
+        result.stages = stages
+        return result
+
+    def jitter_params(self, pars, seed, fwhm, spread=0.3):
+        """
+        Draw the initial values of the parameters at random around their values, in place:
+        the centers within fwhm/2, the amplitudes, sigma and gamma scaled by a log-normal
+        factor of width spread and the skew shifted by spread, all within their bounds.
+        Nothing changes if seed is None
 
+        Parameters
+        ----------
+        pars : lmfit Parameters
+        seed : int or None
+        fwhm : float
+        spread : float
+        """
+        if seed is None:
+            return
+        rng = np.random.default_rng(seed)
+        for name, par in pars.items():
+            if not par.vary or par.expr:
+                continue
+            if name.endswith('center') or re.fullmatch(r'c\d+', name):
+                value = par.value + rng.uniform(-fwhm/2, fwhm/2)
+            elif name.endswith(('amplitude', 'sigma', 'gamma')) or re.fullmatch(r'a\d+', name):
+                value = par.value*np.exp(rng.normal(0, spread))
+            elif name.endswith('skew'):
+                value = par.value + rng.normal(0, spread)
+            else:
+                continue
+            par.set(value=np.clip(value, par.min, par.max))
 
-        axes[0].legend()
-        axes[0].set_xlabel('Photon energy (eV)')
-        axes[0].set_ylabel('Ion counts (arb. units)')
+    def fit_multistart(self, x, y, n_starts=8, n_bootstrap=0, confidence=0.95, max_workers=None, seed=0, **fit_kwargs):
+        """
+        Fit a N2 spectrum from several starting points and keep the best fit, optionally
+        with bootstrap confidence intervals. The fits are spread over worker processes,
+        so the time taken goes down with the number of cpus.
 
-        #axes[0].set_xlim(399.8,402.5)
-        axes[0].set_ylim(np.min(y)-0.25,np.max(y)+0.25)
-        axes[0].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+        The first start is the usual initial guess, the others are drawn around it
+        (see jitter_params). The best fit is the converged one with the lowest chi-square.
+        The bootstrap refits the best fit plus the residuals drawn again with replacement,
+        starting from the best fit, n_bootstrap times.
 
-        # set tick spacing
-        XminorLocator = MultipleLocator(0.1)
-        YminorLocator = MultipleLocator(100000)
-        axes[0].xaxis.set_minor_locator(XminorLocator)
-        axes[0].yaxis.set_minor_locator(YminorLocator)
-        axes[0].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
-        #
+        Parameters
+        ----------
+        x : numpy.array
+        y : numpy.array
+        n_starts : int
+            the number of starting points
+        n_bootstrap : int
+            the number of bootstrap fits, 0 for none
+        confidence : float
+            the probability within the confidence intervals
+        max_workers : int
+            the number of processes fitting, the number of cpus if None
+        seed : int
+            the seed of the starting points and of the bootstrap
+        fit_kwargs :
+            the fit options of fit_spectrum
 
-        #
-        ################################################################################
-        # axes 1
+        Return
+        --------
+        result: N2FitResult
+            the best fit, with
+            result.starts: a list of dict with the 'jitter', 'chisqr', 'sigma', 'vp_ratio' and
+                'success' of each start
+            result.intervals: None without bootstrap, else {'sigma': (low, median, high),
+                'vp_ratio': ..., 'RP': ...} the percentile intervals of the bootstrap fits,
+                and 'n': the number of them which converged
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        rng = np.random.default_rng(seed)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=_pool_context()) as pool:
+            jitters = [None] + [int(j) for j in rng.integers(0, 2**31, n_starts-1)]
+            futures = [pool.submit(_fit_n2_worker, x, y, dict(fit_kwargs, jitter=jitter)) for jitter in jitters]
+            entries, error = [], None
+            for future in futures:
+                try:
+                    entries.append(future.result())
+                except Exception as e:
+                    entries.append(None)
+                    error = e
+            starts = [{'jitter': jitter, 'chisqr': np.nan, 'sigma': np.nan, 'vp_ratio': np.nan, 'success': False}
+                      for jitter in jitters]
+            for start, entry in zip(starts, entries):
+                if entry is not None:
+                    start.update(chisqr=entry['chisqr'], sigma=entry['sigma'], vp_ratio=entry['vp_ratio'],
+                                 success=entry['success'])
+            fitted = [i for i, entry in enumerate(entries) if entry is not None]
+            if not fitted:
+                raise RuntimeError('no fit of the N2 spectrum succeeded') from error
+            converged = [i for i in fitted if entries[i]['success']] or fitted
+            best = N2FitResult.from_entry(self, entries[min(converged, key=lambda i: entries[i]['chisqr'])])
+            best.starts = starts
+            best.intervals = None
+
+            if n_bootstrap:
+                # the spectrum normalized by fit_spectrum, which the best fit describes
+                best_fit = best.out.best_fit
+                residuals = best.y - best_fit
+                samples = [best_fit + rng.choice(residuals, len(residuals)) for i in range(n_bootstrap)]
+                bootstrap_kwargs = dict(fit_kwargs, start=best.params)
+                values = [entry for entry in pool.map(_bootstrap_worker, [best.x]*n_bootstrap, samples,
+                                                      [bootstrap_kwargs]*n_bootstrap, chunksize=max(1, n_bootstrap//32))
+                          if entry is not None]
+                tail = 100*(1-confidence)/2
+                best.intervals = {'n': len(values)}
+                for key in ['sigma', 'vp_ratio', 'RP']:
+                    estimates = np.array([value[key] for value in values], dtype=float)
+                    estimates = estimates[np.isfinite(estimates)]
+                    best.intervals[key] = (tuple(np.percentile(estimates, [tail, 50, 100-tail])) if estimates.size
+                                           else (np.nan,)*3)
+        return best
+
+    def bin_spectrum(self, x, y, n):
+        """
+        Average every n consecutive points of a spectrum, the last bin
+        averages the points left
 
-        axes[1].plot(x, y)
+        Parameters
+        ----------
+        x : numpy.array
+        y : numpy.array
+        n : int
+            the number of points in a bin
 
-        counter = 0
+        Return
+        --------
+        x, y: numpy.array
+        """
+        x, y    = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        starts  = np.arange(0, len(x), n)
+        counts  = np.diff(np.append(starts, len(x)))
+        return np.add.reduceat(x, starts)/counts, np.add.reduceat(y, starts)/counts
 
-        if fix_param == False:
-            comps = out.eval_components(x=x)
-            for i in dict_fit.values():
-                counter += 1
-                axes[1].plot(x, comps[i[0]], '--', label='Voigt component ' + str(counter))
-            axes[1].plot(x, comps['lin_'], '--', label='Linear component')
-        elif fix_param == True:
-            comps = out.values
-            for i in range(1,8):
-                ind=str(i)
-                counter += 1
-                axes[1].plot(x,self.skewed_voigt(x, amplitude=comps['a'+ind], center=comps['c'+ind], sigma=comps['sigma'], gamma=comps['gamma'], skew=comps['skew']), '--', label='Voigt component ' + str(counter))
+    def peaks_window(self, x, y, params, fwhm):
+        """
+        Return the part of a spectrum from 2 fwhm below the first peak to 2 fwhm above
+        the last one, the peaks being the centers in the parameters values params
+        """
+        centers = [value for name, value in params.items() if name.endswith('_center') or re.fullmatch(r'c\d+', name)]
+        inside  = (x >= min(centers)-2*fwhm) & (x <= max(centers)+2*fwhm)
+        return x[inside], y[inside]
 
+    def fit_scan(self, identifier, motor=None, detector=None, warm_start=False, **fit_kwargs):
+        """
+        Fit the N2 spectrum of one scan without plotting anything. With a cache the
+        result is looked up in it first and stored there after the fit.
 
+        Parameters
+        ----------
+        identifier : negative int or string
+            the scan, as for fit_n2
+        motor, detector : string
+            as for retrieve_spectra
+        warm_start : boolean
+            if True the fit starts from the best fit parameters of the previous
+            converged fit with the closest beamline configuration, if there is one.
+            It needs a cache, the result is cached apart from the one of the cold fit
+        fit_kwargs :
+            the fit options of fit_spectrum
 
-        axes[1].legend()
-        axes[1].set_xlabel('Photon energy (eV)')
-        axes[1].set_ylabel('Ion counts (arb. units)')
-        #axes[1].set_xlim(399.8,402.5)
-        #axes[1].set_ylim(0,990000)
-        axes[1].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+        Return
+        --------
+        result: N2FitResult
+            result.warm_start is the uid of the scan whose fit it started from, or None
+        """
+        self._check_warm_start(warm_start)
+        key, entry, x, y, run_info = self._cached_or_spectra(identifier, motor, detector, fit_kwargs, warm_start)
+        if entry is not None:
+            self._record(run_info, entry)
+            return N2FitResult.from_entry(self, entry)
+        config = None if run_info is None else run_info['config']
+        start_uid, start = (None, None) if run_info is None else run_info['start']
+        result = self.fit_spectrum(x, y, start=start, **fit_kwargs)
+        result.warm_start = start_uid
+        if key is not None or run_info is not None:
+            entry = result.to_entry()
+        if key is not None:
+            self.cache.put(key, entry)
+            self._put_start(key, config, fit_kwargs, entry)
+        if run_info is not None:
+            self._record(run_info, entry)
+        return result
+
+    def _check_warm_start(self, warm_start):
+        if warm_start and self.cache is None:
+            warnings.warn('warm_start needs a cache to find the fits to start from, the fits start cold', stacklevel=3)
+
+    def _warm_start(self, key, config, fit_kwargs):
+        # the uid and the parameters of the fit to start from, or None, None
+        if key is None or config is None:
+            return None, None
+        return self.cache.nearest_start(key, config, fit_kwargs)
+
+    def _put_start(self, key, config, fit_kwargs, entry):
+        # converged fits with their uncertainties are kept as starting points
+        if config is not None and entry['success'] and entry['sigma_err'] is not None:
+            self.cache.put_start(key, config, fit_kwargs, entry['params'])
+
+    def _record(self, run_info, entry):
+        # the fits whose beamline configuration was read are added to the trend store
+        if self.trend is not None and run_info is not None and run_info['config'] is not None:
+            self.trend.append(entry, run_info['uid'], start_time=run_info['time'], motor=run_info['motor'],
+                              detector=run_info['detector'], options=run_info['options'], config=run_info['config'])
+
+    def beamline_config(self, run):
+        """
+        Return the beamline configuration of a run, {key: value} for the config_keys
+        found in its start document or its baseline
+        """
+        start  = run.metadata['start']
+        config = {key: start[key] for key in self.config_keys if key in start}
+        missing = [key for key in self.config_keys if key not in config]
+        if missing:
+            try:
+                baseline = run.baseline.read()
+            except Exception:
+                return config
+            for key in missing:
+                for name in baseline.data_vars:
+                    if name == key or name.endswith('_'+key):
+                        value = baseline[name].values[0]
+                        config[key] = value.item() if hasattr(value, 'item') else value
+                        break
+        return config
+
+    def _fit_options(self, fit_kwargs):
+        # the same fit gets the same key whether its options are given or left to their defaults
+        options = inspect.signature(self.fit_spectrum).bind(None, None, **fit_kwargs)
+        options.apply_defaults()
+        return {name: value for name, value in options.arguments.items() if name not in ('x', 'y')}
+
+    def _cached_or_spectra(self, identifier, motor, detector, fit_kwargs, warm_start=False):
+        # returns the cache key and the cached entry, or the key and the spectrum
+        # to fit, with the uid, start time, motor, detector, fit options, beamline
+        # configuration of the run and the uid and parameters of the fit to start from.
+        # The configuration is only read for a new fit, a warm started one or for a
+        # cached one the trend store has not recorded
+        key = None
+        run_info = None
+        if (self.cache is not None or self.trend is not None) and identifier != 'Jens':
+            run      = self._db[identifier]
+            start    = run.metadata['start']
+            motor    = motor if motor is not None else start['motors'][0]
+            detector = detector if detector is not None else start['detectors'][0]
+            options  = self._fit_options(fit_kwargs)
+            run_info = {'uid': start['uid'], 'time': start.get('time'), 'motor': motor, 'detector': detector,
+                        'options': options, 'config': None, 'start': (None, None)}
+            if self.cache is not None:
+                key   = self.cache.key(start['uid'], motor, detector, options)
+                if warm_start:
+                    run_info['config'] = self.beamline_config(run)
+                    run_info['start']  = self._warm_start(key, run_info['config'], fit_kwargs)
+                    if run_info['start'][1] is not None:
+                        key = self.cache.key(start['uid'], motor, detector, options, start=run_info['start'][1])
+                entry = self.cache.get(key)
+                if entry is not None:
+                    if (self.trend is not None and run_info['config'] is None
+                            and not self.trend.recorded(start['uid'], motor, detector, options)):
+                        run_info['config'] = self.beamline_config(run)
+                    return key, entry, None, None, run_info
+            if run_info['config'] is None:
+                run_info['config'] = self.beamline_config(run)
+        x, y = self.retrieve_spectra(identifier, motor=motor, detector=detector)
+        return key, None, x, y, run_info
 
-        XminorLocator = MultipleLocator(0.1)
-        YminorLocator = MultipleLocator(100000)
-        axes[1].xaxis.set_minor_locator(XminorLocator)
-        axes[1].yaxis.set_minor_locator(YminorLocator)
-        axes[1].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
-        #
-        ########################################################################
-        # axes 2
-        residuals_inital = y - out.init_fit
-        residuals_final = y - out.best_fit
-        #
-        axes[2].plot(x, residuals_final, label='data-best fit')
-        #axes[2].plot(x, np.sqrt(y)*3.0, label='sqrt(y)*3')
-        #axes[2].plot(x, np.sqrt(y)*-3.0, label='sqrt(y)*-3')
-        axes[2].fill_between(x,np.sqrt(y)*-3.0,np.sqrt(y)*3.0,color='gray',alpha=0.4, label='sqrt(data)*\u00b13')
+    # internal fit routine
+    def _fit_n2(self, x,y, print_fit_results=False, save_img=False,fit_data=True, 
+                vc1='auto', amp_sf=6,sigma = 0.02, sigma_min=0.001,sigma_max=0.02,gamma=0.055, fix_param=False, jacobian=True, n_peaks=10,
+                plot=True, coarse=None, faddeeva='wofz', jit=False):
+        """
+        This function performs a fit on the array x and y of a nitrogen spectra. 
+        The initial guess of the fit can be modified via the arguments.
 
-        axes[2].legend()
-        axes[2].set_xlabel('Photon energy (eV)')
-        axes[2].set_ylabel('Residual counts (arb. units)')
-        #axes[2].set_xlim(399.8,402.5)
-        #axes[2].set_ylim(-20000,20000)
-        axes[2].tick_params(axis='both',direction='in',length=6,top=True,right=True)
+        Parameters
+        ----------
+        x : numpy.array
+             the motor position array
+        y : numpy.array
+              the detector readings array
+        print_fit_results: boolean
+               if True the fit results report from lm fit is printed on the terminal
+        save_img: boolean or string
+               if False no image is saved
+               if is a string use the image will be saved with this name 
+               (include the extension: pdf,png,jpg...)
+        fit_data: boolean
+               If False the data and the initial guess will be shown
+               If True the fit will be performed
+        vc1: string or float:
+               If 'auto' the first max will be guessed automatically
+               if the automatic guess fails input the position of the first max
+        amp_sf: int or float
+               scaling factor for the amplitude. empirically a value of 6 works well
+        sigma: int or float
+               the sigma of the gaussian contribution to the voigt peak   
+        sigma_min: int or float
+               the lower bound for the sigma parameter for the fit
+        sigma_max: int or float
+               the upper bound for the sigma parameter for the fit
+        gamma: int or float
+               the gamma of the loretzian contribution to the voigt peak
+        fix_param: boolean
+               two rountines can be used
+               if True, the sigma and gamma and skew of all the seven peaks are the same
+               if False, the sigma and gamma and skew of all the seven peaks are indipendent
+        jacobian: boolean
+               if True the analytic derivatives of the model are used by the fit
+               if False lmfit estimates them by finite differences
+        n_peaks: int
+               the number of peaks fitted if fix_param is False, at most 10
+        plot: boolean
+               if False only the fit is done, no figure is made
+        coarse: int, optional
+               if given, the spectrum is first fitted with every coarse points averaged into one,
+               then at full resolution around the peaks starting from that fit. It takes less
+               time on spectra of thousands of points. The bins are kept narrower than sigma/4
+        faddeeva: string
+               'wofz' evaluates the Voigt profiles with scipy's wofz, 'table' with the
+               faster FaddeevaTable, within 1e-7 relative of wofz
+        jit: boolean
+               if True and numba is installed, the model and its derivatives are computed
+               by compiled kernels, with the FaddeevaTable. Without numba the fit runs
+               with NumPy and a warning
 
-        XminorLocator = MultipleLocator(0.1)
-        YminorLocator = MultipleLocator(1000)
-        axes[2].xaxis.set_minor_locator(XminorLocator)
-        axes[2].yaxis.set_minor_locator(YminorLocator)
-        axes[2].tick_params(which='minor',axis='both',direction='in',length=3,top=True,right=True)
-        # 
-        xmin_ax2, xmax_ax2 = axes[2].axes.get_xlim()
-        ymin_ax2, ymax_ax2 = axes[2].axes.get_ylim()
+        Return
+        --------
+        sigma_v2, center_v1,sigma_v2_err, vp_ratio: float
+        """
+        if fit_data == False:
+            # normalize intensity
+            y = y/np.max(y)
+            mod, pars, dict_fit = self._make_n2_model(x, y, vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min,
+                                                      sigma_max=sigma_max, gamma=gamma, fix_param=fix_param, n_peaks=n_peaks)
+            init = mod.eval(pars, x=x)
 
-        axes[2].text(((xmax_ax2-xmin_ax2)*0.55)+xmin_ax2, ((ymax_ax2-ymin_ax2)*0.2)+ymin_ax2, f'RMS initial = {str(np.round(self.RMS(residuals_inital),4))}') #, style = 'italic',fontsize = 30,  color = "green")
-        axes[2].text(((xmax_ax2-xmin_ax2)*0.55)+xmin_ax2, ((ymax_ax2-ymin_ax2)*0.15)+ymin_ax2, f'RMS final   = {str(np.round(self.RMS(residuals_final),4))}')
+            # here it plots the intial guesses if fit=False
+            plt.rc("font", size=12,family='serif')
+            fig, axes = plt.subplots(1, 1, figsize=(8.0, 16.0))
+            axes.plot(x, init, 'orange' ,label='initial guess')
+            axes.scatter(x, y, label='data')
+            #axes.set_ylim(-.05,1.1)
+            return None,None,None,None,None
 
-        plt.subplots_adjust(left=0.14, bottom=None, right=None, top=None, wspace=0.04, hspace=0.14)
-        if save_img != False:
-            plt.savefig(save_img+'.pdf')
-        plt.show()
-        #extracting values to calculate RP
+        result = self.fit_spectrum(x, y, vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min, sigma_max=sigma_max,
+                                   gamma=gamma, fix_param=fix_param, jacobian=jacobian, n_peaks=n_peaks, coarse=coarse,
+                                   faddeeva=faddeeva, jit=jit)
+        if print_fit_results == True:
+            print(result.report(min_correl=0.5))
 
-        if fix_param == False:    
-            sigma_v2, sigma_v2_err,center_v1 = self.extract_RP_fwhm_g(out.params,fix_param=fix_param)
-            vp_ratio = self.extract_RP_ratio(x, out.best_fit,out.params,fix_param=fix_param)
-        elif fix_param == True:    
-            sigma_v2, sigma_v2_err,center_v1 = self.extract_RP_fwhm_g(out.values,fix_param=fix_param)
-            vp_ratio = self.extract_RP_ratio(x, out.best_fit,out.params,fix_param=fix_param)    
+        if plot:
+            result.plot(save_img=save_img)
+            plt.show()
 
-        return sigma_v2, center_v1,sigma_v2_err, vp_ratio
+        return result.sigma, result.center, result.sigma_err, result.vp_ratio
 
     def fit_n2(self, scan, motor='pgm', detector='Keithley01',print_fit_report=False, save_img=False, fit=True,
-               vc1='auto', amp_sf=6,sigma = 0.02, sigma_min=0.001,sigma_max=0.02,gamma=0.0563, fix_param = False):
+               vc1='auto', amp_sf=6,sigma = 0.02, sigma_min=0.001,sigma_max=0.02,gamma=0.0563, fix_param = False, jacobian=True, n_peaks=10,
+               plot=True, warm_start=False, coarse=None, faddeeva='wofz', jit=False):
         """
         This function calls _n2fit to perform a fit on the array x and y of a nitrogen spectra. 
         The initial guess of the fit can be modified via the arguments.
@@ -724,6 +2332,27 @@ class N2_fit:
             two rountines can be used
             if True, the sigma and gamma and skew of all the seven peaks are the same
             if False, the sigma and gamma and skew of all the seven peaks are indipendent
+        jacobian: boolean
+            if True the analytic derivatives of the model are used by the fit
+            if False lmfit estimates them by finite differences
+        n_peaks: int
+            the number of peaks fitted if fix_param is False, at most 10
+        plot: boolean
+            if False only the fit is done, no figure is made
+        warm_start: boolean
+            if True the fit starts from the previous converged fit with the closest
+            beamline configuration, see fit_scan. vc1 is then not needed
+        coarse: int, optional
+            if given, the spectrum is first fitted with every coarse points averaged into one,
+            then at full resolution around the peaks starting from that fit. It takes less
+            time on spectra of thousands of points. The bins are kept narrower than sigma/4
+        faddeeva: string
+            'wofz' evaluates the Voigt profiles with scipy's wofz, 'table' with the
+            faster FaddeevaTable, within 1e-7 relative of wofz
+        jit: boolean
+            if True and numba is installed, the model and its derivatives are computed
+            by compiled kernels, with the FaddeevaTable. Without numba the fit runs
+            with NumPy and a warning
 
         Return
         --------
@@ -731,12 +2360,22 @@ class N2_fit:
             the resolving power RP calculated by the gaussian contribution  
             and the valley over peak ratio, both estimated by the fit
         """
-        energy, intensity                  = self.retrieve_spectra(scan)
-        sigma, center, sigma_err,vp_ratio  = self._fit_n2(energy, intensity, print_fit_results=print_fit_report, save_img=save_img,fit_data=fit,
-                                                    vc1=vc1,amp_sf=amp_sf,sigma=sigma,sigma_min=sigma_min,sigma_max=sigma_max,gamma=gamma,
-                                                    fix_param=fix_param)
         if fit == False:
+            energy, intensity = self.retrieve_spectra(scan)
+            self._fit_n2(energy, intensity, fit_data=False, vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min,
+                         sigma_max=sigma_max, gamma=gamma, fix_param=fix_param, n_peaks=n_peaks)
             return
+
+        result = self.fit_scan(scan, warm_start=warm_start, vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min,
+                               sigma_max=sigma_max, gamma=gamma, fix_param=fix_param, jacobian=jacobian, n_peaks=n_peaks,
+                               coarse=coarse, faddeeva=faddeeva, jit=jit)
+        if print_fit_report == True:
+            print(result.report(min_correl=0.5))
+        if plot:
+            result.plot(save_img=save_img)
+            plt.show()
+        sigma, center, sigma_err, vp_ratio = result.sigma, result.center, result.sigma_err, result.vp_ratio
+
         fwhm_g         = 2*sigma*np.sqrt(2*np.log(2))
         fwhm_l         = 2*gamma
         RP             = center/ fwhm_g
@@ -757,3 +2396,551 @@ class N2_fit:
             print('The valley/peak ratio is', np.round(vp_ratio,2))
 
         return RP, vp_ratio
+
+    def fit_n2_many(self, identifiers, motor=None, detector=None, max_workers=None, fetch_workers=4, progress=True,
+                    vc1='auto', amp_sf=6, sigma=0.02, sigma_min=0.001, sigma_max=0.02, gamma=0.0563, fix_param=False,
+                    jacobian=True, n_peaks=10, warm_start=False, coarse=None, faddeeva='wofz', jit=False):
+        """
+        Fit the N2 spectra of many scans, for instance all the scans of a cff or exit slit series.
+        The spectra are read from the databroker in threads and fitted in worker processes,
+        without plotting.
+
+        Parameters
+        ----------
+        identifiers : list of negative int or string
+            the scans to fit, as for fit_n2
+        motor : string
+            the motor and axis name connected by a _, the first motor of each scan if None
+        detector : string
+            the detector to retrieve, the first detector of each scan if None
+        max_workers : int
+            the number of processes fitting, the number of cpus if None
+        fetch_workers : int
+            the number of threads reading the spectra from the databroker
+        progress : boolean or callable
+            if True a line is printed for each fitted scan
+            if callable it is called with (number of scans done, number of scans, row)
+        vc1, amp_sf, sigma, sigma_min, sigma_max, gamma, fix_param, jacobian, n_peaks, warm_start, coarse, faddeeva, jit:
+            the fit options, as for fit_n2. The fits start from the previous fits, not
+            from the ones done in the same call
+
+        Return
+        --------
+        rows: list of dict
+            one row per identifier, in the same order, with the keys
+            'scan', 'sigma', 'sigma_err', 'center', 'vp_ratio', 'RP' and 'status'
+            status is 'ok', 'no uncertainties' if the fit did not estimate the errors,
+            'not converged: ...' with the message of the fit, or the error which made
+            reading or fitting the scan fail.
+            pandas.DataFrame(rows) makes a table of them.
+            The fits found in the cache are not done again
+        """
+        self._check_warm_start(warm_start)
+        fit_kwargs = dict(vc1=vc1, amp_sf=amp_sf, sigma=sigma, sigma_min=sigma_min, sigma_max=sigma_max, gamma=gamma,
+                          fix_param=fix_param, jacobian=jacobian, n_peaks=n_peaks, coarse=coarse, faddeeva=faddeeva, jit=jit)
+        identifiers = list(identifiers)
+        rows = [{'scan': identifier, 'sigma': np.nan, 'sigma_err': np.nan, 'center': np.nan, 'vp_ratio': np.nan,
+                 'RP': np.nan, 'status': None} for identifier in identifiers]
+        done = 0
+
+        def report(i):
+            nonlocal done
+            done += 1
+            row = rows[i]
+            if callable(progress):
+                progress(done, len(rows), row)
+            elif progress:
+                print(f"{done}/{len(rows)} scan {row['scan']}: RP {np.round(row['RP'], 0)}, "
+                      f"valley/peak {np.round(row['vp_ratio'], 2)}, {row['status']}")
+
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetcher, \
+             ProcessPoolExecutor(max_workers=max_workers, mp_context=_pool_context()) as pool:
+            fetches = {fetcher.submit(self._cached_or_spectra, identifier, motor, detector, fit_kwargs, warm_start): i
+                       for i, identifier in enumerate(identifiers)}
+            fits = {}
+            for future in as_completed(fetches):
+                i = fetches[future]
+                try:
+                    key, entry, x, y, run_info = future.result()
+                except Exception as e:
+                    rows[i]['status'] = f'reading failed: {e!r}'
+                    report(i)
+                    continue
+                if entry is not None:
+                    self._record(run_info, entry)
+                    rows[i].update(_entry_row(entry))
+                    report(i)
+                    continue
+                start = None if run_info is None else run_info['start'][1]
+                fits[pool.submit(_fit_n2_worker, x, y, dict(fit_kwargs, start=start))] = i, key, run_info
+
+            for future in as_completed(fits):
+                i, key, run_info = fits[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    rows[i]['status'] = f'fit failed: {e!r}'
+                else:
+                    if key is not None:
+                        self.cache.put(key, entry)
+                        self._put_start(key, run_info['config'], fit_kwargs, entry)
+                    self._record(run_info, entry)
+                    rows[i].update(_entry_row(entry))
+                report(i)
+        return rows
+
+    def rp_map(self, identifiers, x='cff', y='exit_slit', motor=None, detector=None, max_workers=None, fetch_workers=4,
+               progress=True, decimals=6, **fit_kwargs):
+        """
+        Fit the N2 spectra measured over a grid of two beamline parameters, for instance
+        cff x exit slit, and make the maps of the RP and the valley/peak ratio with
+        their uncertainties. The cells are fitted in worker processes, as in fit_n2_many.
+
+        The grid is a grid_scan over the two parameters and the energy, or a series of
+        energy scans whose parameters are read from the start document or the baseline
+        as in beamline_config, or both. With a cache the fits of the cells are kept in it,
+        so when the grid is extended, by more scans or by another grid_scan, only the new
+        cells are fitted.
+
+        Parameters
+        ----------
+        identifiers : negative int or string, or a list of them
+            the grid_scan or the scans of the grid, as for fit_n2. If a cell is in more
+            than one scan, the fit of the last of them is used
+        x, y : string
+            the two parameters, the names of the config keys or of the motors of the
+            grid_scan, or the last part of the motor name after a _ (cff for pgm_cff)
+        motor : string
+            the energy motor, the motor of the grid_scan which is neither x nor y or
+            the first motor of the scans if None
+        detector : string
+            the detector to retrieve, the first detector of each scan if None
+        max_workers : int
+            the number of processes fitting, the number of cpus if None
+        fetch_workers : int
+            the number of threads reading the scans from the databroker
+        progress : boolean or callable
+            if True a line is printed for each cell
+            if callable it is called with (number of cells done, number of cells, cell)
+        decimals : int
+            the parameter values are rounded to decimals, so that the scans of a cell
+            with slightly different readings end up in the same cell
+        fit_kwargs :
+            the fit options of fit_spectrum
+
+        Return
+        --------
+        rp_map : RPMap
+        """
+        if isinstance(identifiers, (int, str)):
+            identifiers = [identifiers]
+        identifiers = list(identifiers)
+        options = self._fit_options(fit_kwargs)
+        cells, errors, ready = [], {}, []
+        done = 0
+
+        def report(cell):
+            nonlocal done
+            done += 1
+            if callable(progress):
+                progress(done, len(cells), cell)
+            elif progress:
+                print(f"{done}/{len(cells)} {x} {cell['x']}, {y} {cell['y']}: RP {np.round(cell['RP'], 0)}, "
+                      f"valley/peak {np.round(cell['vp_ratio'], 2)}, {cell['status']}")
+
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetcher, \
+             ProcessPoolExecutor(max_workers=max_workers, mp_context=_pool_context()) as pool:
+            fetches = {fetcher.submit(self._map_cells, identifier, x, y, motor, detector, options, decimals): n
+                       for n, identifier in enumerate(identifiers)}
+            run_cells = [[] for identifier in identifiers]
+            fits = {}
+            for future in as_completed(fetches):
+                n = fetches[future]
+                try:
+                    run_cells[n] = future.result()
+                except Exception as e:
+                    errors[identifiers[n]] = f'reading failed: {e!r}'
+                    continue
+                for cell in run_cells[n]:
+                    entry = cell['entry']
+                    # the entries cached before vp_ratio_err was stored only need it computed
+                    if (entry is None and cell['spectrum'] is not None) or \
+                       (entry is not None and entry.get('vp_ratio_err') is None):
+                        x_values, y_values = cell['spectrum'] if entry is None else (None, None)
+                        fits[pool.submit(_rp_map_worker, x_values, y_values, fit_kwargs, entry)] = cell
+                    else:
+                        ready.append(cell)
+            cells = [cell for cells_of_run in run_cells for cell in cells_of_run]
+
+            for cell in ready:
+                if cell['entry'] is not None:
+                    self._record(cell['run_info'], cell['entry'])
+                    cell.update(_map_row(cell['entry']))
+                report(cell)
+            for future in as_completed(fits):
+                cell = fits[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    cell['status'] = f'fit failed: {e!r}'
+                else:
+                    if cell['key'] is not None:
+                        self.cache.put(cell['key'], entry)
+                        if cell['entry'] is None:
+                            self._put_start(cell['key'], cell['run_info']['config'], fit_kwargs, entry)
+                    cell['entry'] = entry
+                    self._record(cell['run_info'], entry)
+                    cell.update(_map_row(entry))
+                report(cell)
+        return RPMap(x, y, cells, errors)
+
+    def _map_cells(self, identifier, x, y, motor, detector, options, decimals):
+        # the cells of the map in one scan, each with its cache key and cached entry,
+        # or else its spectrum to fit
+        run      = self._db[identifier]
+        start    = run.metadata['start']
+        detector = detector if detector is not None else start['detectors'][0]
+        config   = self.beamline_config(run)
+        if start.get('plan_name') == 'grid_scan' and len(start.get('shape', ())) == 3:
+            return self._grid_cells(run, x, y, motor, detector, options, config, decimals)
+        motor    = motor if motor is not None else start['motors'][0]
+        missing  = [name for name in (x, y) if name not in config]
+        if missing:
+            raise KeyError(f"{', '.join(missing)} not found in the start document or the baseline")
+        cell = self._map_cell(identifier, config[x], config[y], decimals,
+                              {'uid': start['uid'], 'time': start.get('time'), 'motor': motor, 'detector': detector,
+                               'options': options, 'config': config})
+        if cell['entry'] is None:
+            cell['spectrum'] = self.retrieve_spectra(identifier, motor=motor, detector=detector)
+        return [cell]
+
+    def _grid_cells(self, run, x, y, motor, detector, options, config, decimals):
+        # the cells of a grid_scan over x, y and the energy. The cell (i, j) is the
+        # energy scan at the i-th value of x and the j-th value of y, its fit is
+        # cached under the uid of the run followed by [i,j]
+        start  = run.metadata['start']
+        motors = list(start['motors'])
+        shape  = start['shape']
+
+        def axis(name):
+            for k, field in enumerate(motors):
+                if field == name or field.endswith('_'+name):
+                    return k
+            raise KeyError(f"{name} is not a motor of the grid_scan {motors}")
+        ax, ay = axis(x), axis(y)
+        ae     = [k for k in range(3) if k not in (ax, ay)][0] if motor is None else motors.index(motor)
+        values = [np.linspace(*extent, n) for extent, n in zip(start['extents'], shape)]
+        cells  = []
+        for i, value_x in enumerate(values[ax]):
+            for j, value_y in enumerate(values[ay]):
+                cell = self._map_cell(f"{start['uid']}[{i},{j}]", value_x, value_y, decimals,
+                                      {'uid': f"{start['uid']}[{i},{j}]", 'time': start.get('time'),
+                                       'motor': motors[ae], 'detector': detector, 'options': options,
+                                       'config': dict(config, **{x: float(value_x), y: float(value_y)})})
+                cell['index'] = i, j
+                cells.append(cell)
+        if all(cell['entry'] is not None for cell in cells):
+            return cells
+
+        chunks = list(self.read_fields(run, [motors[ae], detector]))
+        energy = np.concatenate([chunk[0] for chunk in chunks])
+        signal = np.concatenate([chunk[1] for chunk in chunks])
+        # the position of every event in the grid, the snaking axes go backwards every other pass
+        events = np.arange(len(energy))
+        index  = []
+        for k, n in enumerate(shape):
+            inner = int(np.prod(shape[k+1:]))
+            position = (events // inner) % n
+            if k > 0 and start.get('snaking', [False]*3)[k]:
+                position = np.where((events // (inner*n)) % 2 == 1, n-1-position, position)
+            index.append(position)
+        for cell in cells:
+            if cell['entry'] is not None:
+                continue
+            i, j = cell['index']
+            selected = (index[ax] == i) & (index[ay] == j)
+            if selected.sum() < shape[ae]:
+                cell['status'] = 'incomplete' if selected.any() else 'missing'
+                continue
+            order = np.argsort(energy[selected])
+            cell['spectrum'] = self.remove_neg_values(energy[selected][order], signal[selected][order])
+        return cells
+
+    def _map_cell(self, scan, value_x, value_y, decimals, run_info):
+        # a cell of rp_map with the cached fit of its spectrum, if there is one
+        key = None if self.cache is None else self.cache.key(run_info['uid'], run_info['motor'], run_info['detector'],
+                                                              run_info['options'])
+        return {'scan': scan, 'x': round(float(value_x), decimals), 'y': round(float(value_y), decimals),
+                'key': key, 'entry': None if key is None else self.cache.get(key), 'spectrum': None,
+                'run_info': run_info, 'status': 'missing', 'RP': np.nan, 'vp_ratio': np.nan}
+
+
+class N2FitCallback(CallbackBase):
+    """
+    A callback which fits the N2 spectrum while the scan runs, so that a long scan
+    can be stopped as soon as the resolving power is known well enough.
+
+    instantiate with
+
+      live = N2FitCallback(N2_fit(db), sigma_rel_err=0.02, gamma=0.0563, fix_param=True)
+      RE.subscribe(live)
+
+    The events of the primary stream are collected and every `every` new points the
+    spectrum so far is fitted in a worker thread, starting from the previous fit with
+    uncertainties. A fit is not started while the previous one runs, the RunEngine
+    never waits for it.
+    Each fit gives an estimate, a dict with the keys
+
+      'points', 'sigma', 'sigma_err', 'RP', 'RP_err', 'vp_ratio', 'success',
+      'warm_start' (True if the fit started from the previous one), 'time' (of the fit in s),
+      'good_enough' (the stop early hint) and 'status' ('ok', 'no uncertainties',
+      'not converged: ...' or 'fit failed: ...')
+
+    which is appended to live.estimates and passed to on_update, or logged at debug level
+    if on_update is None. good_enough is True when the relative error of sigma is below sigma_rel_err,
+    and the RP moved less than rp_rel_change since the previous estimate (if given).
+    on_update runs in the worker thread; to abort the scan on the hint use for instance
+
+      N2FitCallback(n2, on_update=lambda e: e['good_enough'] and RE.request_pause())
+
+    At the stop of the run the whole spectrum is fitted once more, live.result is the
+    N2FitResult of the last fit. wait() waits for it. The next run does not: its start
+    drops the fits of the previous run which have not ended.
+
+    Only the runs which scan the motor and read the detector are fitted, and of those
+    only the ones predicate accepts, for instance
+
+      N2FitCallback(n2, motor='pgm_en', predicate=lambda doc: doc.get('plan_name') == 'scan')
+
+    Parameters
+    ----------
+    n2: N2_fit
+    motor, detector: string
+        the fields of the events fitted, the first motor and detector of the start
+        document if None, as for N2_fit.retrieve_spectra. A run whose start document
+        has no motor or detector of that name (or the name of the field up to a _) is
+        not fitted
+    every: int
+        the number of new points between two fits
+    min_points: int
+        the number of points before the first fit
+    sigma_rel_err: float
+        the relative error of sigma below which the estimate is good enough
+    rp_rel_change: float, optional
+        the relative change of the RP between two estimates below which it is good enough
+    on_update: callable, optional
+        called with each estimate
+    predicate: callable, optional
+        called with the start document of each run, the run is only fitted if it returns True
+    fit_kwargs:
+        the fit options of N2_fit.fit_spectrum
+    """
+    def __init__(self, n2, motor=None, detector=None, every=50, min_points=100, sigma_rel_err=0.02,
+                 rp_rel_change=None, on_update=None, predicate=None, **fit_kwargs):
+        self._n2 = n2
+        self._motor_name = motor
+        self._detector_name = detector
+        self.every = every
+        self.min_points = min_points
+        self.sigma_rel_err = sigma_rel_err
+        self.rp_rel_change = rp_rel_change
+        self.on_update = on_update
+        self.predicate = predicate
+        self.fit_kwargs = fit_kwargs
+        self.estimates = []
+        self.result = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='n2fit-live')
+        self._lock = threading.Lock()
+        self._future = None
+        self._final = None
+        self._primary = set()
+        self._x, self._y = [], []
+        self._fitted = 0
+        self._start = None
+        self._run = None
+        self._active = False
+
+    def start(self, doc):
+        # the fits of the previous run are not waited for, the pending ones are cancelled
+        # and the results of the one running are dropped
+        with self._lock:
+            for future in (self._future, self._final):
+                if future is not None:
+                    future.cancel()
+            self._run = doc['uid']
+            self._start = None
+            self.estimates = []
+            self.result = None
+        self._future = None
+        self._final = None
+        motors, detectors = doc.get('motors') or [None], doc.get('detectors') or [None]
+        self._motor = self._motor_name if self._motor_name is not None else motors[0]
+        self._detector = self._detector_name if self._detector_name is not None else detectors[0]
+        self._active = (self._in(self._motor, motors) and self._in(self._detector, detectors)
+                        and (self.predicate is None or bool(self.predicate(doc))))
+        self._primary = set()
+        self._x, self._y = [], []
+        self._fitted = 0
+
+    @staticmethod
+    def _in(field, names):
+        # the field of a device is its name, or its name followed by _ and the component
+        return field is not None and any(name is not None and (field == name or field.startswith(name+'_'))
+                                         for name in names)
+
+    def descriptor(self, doc):
+        if self._active and doc.get('name') == 'primary':
+            self._primary.add(doc['uid'])
+
+    def event(self, doc):
+        if doc['descriptor'] not in self._primary:
+            return
+        data = doc['data']
+        if self._motor not in data or self._detector not in data:
+            return
+        self._x.append(data[self._motor])
+        self._y.append(data[self._detector])
+        n = len(self._x)
+        if n >= self.min_points and n - self._fitted >= self.every and (self._future is None or self._future.done()):
+            self._fitted = n
+            self._future = self._executor.submit(self._fit, self._run, np.array(self._x), np.array(self._y))
+
+    def stop(self, doc):
+        if self._active and len(self._x) >= self.min_points and len(self._x) > self._fitted:
+            # after the fit still running, if any
+            self._fitted = len(self._x)
+            self._final = self._executor.submit(self._fit, self._run, np.array(self._x), np.array(self._y))
+
+    def wait(self, timeout=None):
+        """
+        Wait for the fits submitted to end, return live.result
+        """
+        for future in (self._future, self._final):
+            if future is not None:
+                future.exception(timeout=timeout)
+        return self.result
+
+    @property
+    def good_enough(self):
+        """the stop early hint of the last estimate"""
+        with self._lock:
+            return bool(self.estimates) and self.estimates[-1]['good_enough']
+
+    def close(self):
+        """
+        Wait for the fits and stop the worker thread
+        """
+        self._executor.shutdown(wait=True)
+
+    def _fit(self, run, x, y):
+        # runs in the worker thread, run is the uid of the run the spectrum is from
+        x, y = self._n2.remove_neg_values(x, y)
+        result, start = None, None
+        estimate = {'points': len(x), 'sigma': np.nan, 'sigma_err': np.nan, 'RP': np.nan, 'RP_err': np.nan,
+                    'vp_ratio': np.nan, 'success': False, 'warm_start': self._start is not None, 'time': np.nan,
+                    'good_enough': False}
+        t0 = time.perf_counter()
+        try:
+            result = self._n2.fit_spectrum(x, y, start=self._start, **self.fit_kwargs)
+        except Exception as e:
+            estimate['status'] = f'fit failed: {e!r}'
+        else:
+            estimate['time'] = time.perf_counter()-t0
+            estimate.update(sigma=result.sigma, RP=result.RP, vp_ratio=result.vp_ratio, success=bool(result.success))
+            # extract_RP_fwhm_g gives no error for the fixed parameters fit, it is taken from lmfit
+            sigma_err = result.out.params['sigma' if result.fix_param else 'v2_sigma'].stderr
+            if sigma_err:
+                estimate['sigma_err'] = sigma_err
+                estimate['RP_err'] = abs(result.RP*sigma_err/result.sigma)
+            if not result.success:
+                estimate['status'] = f'not converged: {result.message}'
+            elif not sigma_err or result.sigma <= 0:
+                # typically the first peaks are not scanned yet
+                estimate['status'] = 'no uncertainties'
+            else:
+                estimate['status'] = 'ok'
+                start = result.params
+            estimate['good_enough'] = self._good_enough(estimate)
+        with self._lock:
+            if run != self._run:
+                # another run started meanwhile
+                return
+            if result is not None:
+                self.result = result
+            if start is not None:
+                self._start = start
+            self.estimates.append(estimate)
+        if self.on_update is not None:
+            self.on_update(estimate)
+        else:
+            logger.debug("N2 fit of %d points: RP %s +/- %s, valley/peak %s%s, %s", estimate['points'],
+                         np.round(estimate['RP'], 0), np.round(estimate['RP_err'], 0), np.round(estimate['vp_ratio'], 2),
+                         ', good enough' if estimate['good_enough'] else '', estimate['status'])
+
+    def _good_enough(self, estimate):
+        if estimate['status'] != 'ok' or not estimate['sigma_err'] < self.sigma_rel_err*estimate['sigma']:
+            return False
+        if self.rp_rel_change is not None:
+            previous = [e for e in self.estimates if e['status'] == 'ok']
+            if not previous or not abs(estimate['RP']/previous[-1]['RP']-1) < self.rp_rel_change:
+                return False
+        return True
+
+
+def _pool_context():
+    # a forkserver imports this module once and forks clean workers from it,
+    # rather than forking the session with its threads or importing in every worker
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _fit_n2_worker(x, y, fit_kwargs):
+    # runs in the worker processes of N2_fit.fit_n2_many and N2_fit.fit_multistart
+    return N2_fit(None, cache=False, trend=False).fit_spectrum(x, y, **fit_kwargs).to_entry()
+
+
+def _bootstrap_worker(x, y, fit_kwargs):
+    # runs in the worker processes of N2_fit.fit_multistart, only the values of converged fits are sent back
+    try:
+        result = N2_fit(None, cache=False, trend=False).fit_spectrum(x, y, **fit_kwargs)
+    except Exception:
+        return None
+    if not result.success:
+        return None
+    return {'sigma': float(result.sigma), 'vp_ratio': float(result.vp_ratio), 'RP': float(result.RP)}
+
+
+def _rp_map_worker(x, y, fit_kwargs, entry=None):
+    # runs in the worker processes of N2_fit.rp_map, fits the spectrum, or only adds
+    # the uncertainty of the valley/peak ratio to an entry of the cache
+    n2 = N2_fit(None, cache=False, trend=False)
+    result = n2.fit_spectrum(x, y, **fit_kwargs) if entry is None else N2FitResult.from_entry(n2, entry)
+    # to_entry only holds vp_ratio_err once computed, which needs the lmfit result and so is done here
+    result.compute_errors()
+    return result.to_entry()
+
+
+def _entry_row(entry):
+    # the values of a row of N2_fit.fit_n2_many
+    if not entry['success']:
+        status = f"not converged: {entry['message']}"
+    elif entry['sigma_err'] is None:
+        status = 'no uncertainties'
+    else:
+        status = 'ok'
+    return {'sigma': entry['sigma'], 'center': entry['center'], 'vp_ratio': entry['vp_ratio'], 'RP': entry['RP'],
+            'sigma_err': np.nan if entry['sigma_err'] is None else entry['sigma_err'], 'status': status}
+
+
+def _map_row(entry):
+    # the values of a cell of N2_fit.rp_map. The fits with fixed parameters report no
+    # error on sigma, the one of the fit parameter is used
+    row = _entry_row(entry)
+    if entry['fit_kwargs']['fix_param'] and row['status'] == 'ok':
+        row['sigma_err'] = entry['stderr'].get('sigma', np.nan)
+    row['RP_err'] = row['RP']*row['sigma_err']/row['sigma']
+    row['vp_ratio_err'] = np.nan if entry.get('vp_ratio_err') is None else entry['vp_ratio_err']
+    return row
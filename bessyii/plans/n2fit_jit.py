@@ -0,0 +1,117 @@
+##### -------  numba kernels of the N2 fit -----------------
+
+# Imported by bessyii.plans.n2fit only when a fit asks for jit=True, so that numba
+# stays optional. Each kernel goes once over the peaks and the points, without the
+# (n_peaks, len(x)) temporaries of the NumPy model. The Faddeeva function is the
+# FaddeevaTable of n2fit, scipy's wofz can not be called from numba.
+# Without numba the kernels are plain Python, n2fit does not use them then, but
+# their logic can still be tested through kernel.py_func as with numba.
+
+import cmath
+import math
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+TINY     = 1.0e-15
+S2       = math.sqrt(2)
+S2PI     = math.sqrt(2*math.pi)
+SQRTPI   = math.sqrt(math.pi)
+
+
+def _njit(function):
+    # numba keeps the Python function of a kernel as its py_func, so does this without numba
+    if numba is None:
+        function.py_func = function
+        return function
+    return numba.njit(cache=True)(function)
+
+
+@_njit
+def faddeeva_upper(z, coefficients, n, step, radius, terms):
+    # FaddeevaTable.__call__ for one z with Im z >= 0
+    u = z.real
+    v = z.imag
+    if u*u + v*v >= radius*radius:
+        q = 0.5/(z*z)
+        series = 0j
+        for k in range(terms, 0, -1):
+            series = (2*k-1)*q*(1 + series)
+        return 1j/SQRTPI*(1 + series)/z
+    au = abs(u)
+    iu = int(round(au/step))
+    iv = int(round(v/step))
+    node = iv*n + iu
+    d = complex(au - iu*step, v - iv*step)
+    taylor = coefficients[0, node]
+    for r in range(1, coefficients.shape[0]):
+        taylor = taylor*d + coefficients[r, node]
+    if u < 0:
+        return taylor.conjugate()
+    return taylor
+
+
+@_njit
+def faddeeva(z, coefficients, n, step, radius, terms):
+    if z.imag < 0:
+        # w(z) = 2*exp(-z**2) - w(-z)
+        return 2*cmath.exp(-z*z) - faddeeva_upper(-z, coefficients, n, step, radius, terms)
+    return faddeeva_upper(z, coefficients, n, step, radius, terms)
+
+
+@_njit
+def skewed_voigt_peaks(x, amplitude, center, sigma, gamma, skew, coefficients, n, step, radius, terms, out):
+    """
+    The sum of the skewed voigt peaks with the parameters in the arrays amplitude,
+    center, sigma, gamma and skew of shape (n_peaks,), written to out
+    """
+    out[:] = 0
+    for i in range(amplitude.shape[0]):
+        sigma_s2 = max(TINY, sigma[i]*S2)
+        scale    = amplitude[i]/max(TINY, sigma[i]*S2PI)
+        for j in range(x.shape[0]):
+            dx = x[j] - center[i]
+            w = faddeeva(complex(dx/sigma_s2, gamma[i]/sigma_s2), coefficients, n, step, radius, terms)
+            out[j] += scale*w.real*(1 + math.erf(skew[i]*dx/sigma_s2))
+    return out
+
+
+@_njit
+def skewed_voigt_peaks_jacobian(x, amplitude, center, sigma, gamma, skew, rows, weights, coefficients, n, step,
+                                radius, terms, jac):
+    """
+    Add the derivatives of the residual data-model with respect to the parameters of
+    every peak to the rows of jac, as N2_fit.skewed_voigt_derivatives gives them.
+    rows has shape (n_peaks, 5), the row of the amplitude, center, sigma, gamma and skew
+    of each peak, -1 for the parameters which do not vary; peaks sharing a parameter
+    share its row. weights are the weights of the residual, or empty
+    """
+    weighted = weights.shape[0] > 0
+    for i in range(amplitude.shape[0]):
+        sigma_s2 = max(TINY, sigma[i]*S2)
+        norm     = max(TINY, sigma[i]*S2PI)
+        for j in range(x.shape[0]):
+            dx    = x[j] - center[i]
+            z     = complex(dx/sigma_s2, gamma[i]/sigma_s2)
+            w     = faddeeva(z, coefficients, n, step, radius, terms)
+            dw    = -2*z*w + 2j/SQRTPI
+            u     = skew[i]*dx/sigma_s2
+            asym  = 1 + math.erf(u)
+            dasym = 2/SQRTPI*math.exp(-u*u)
+            shape = w.real/norm
+            voigt = amplitude[i]*shape
+            factor = -weights[j] if weighted else -1.0
+            if rows[i, 0] >= 0:
+                jac[rows[i, 0], j] += factor*asym*shape
+            if rows[i, 1] >= 0:
+                jac[rows[i, 1], j] += factor*(asym*amplitude[i]*(-dw.real/sigma_s2)/norm - voigt*dasym*skew[i]/sigma_s2)
+            if rows[i, 2] >= 0:
+                jac[rows[i, 2], j] += factor*(asym*amplitude[i]*((-dw*z).real/sigma[i] - w.real/sigma[i])/norm
+                                              - voigt*dasym*u/sigma[i])
+            if rows[i, 3] >= 0:
+                jac[rows[i, 3], j] += factor*asym*amplitude[i]*(-dw.imag/sigma_s2)/norm
+            if rows[i, 4] >= 0:
+                jac[rows[i, 4], j] += factor*voigt*dasym*dx/sigma_s2
+    return jac
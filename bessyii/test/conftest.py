@@ -0,0 +1,112 @@
+import uuid
+
+import numpy as np
+import pytest
+
+## Set up env, shared by the N2 fit tests
+
+# the vibrational peaks of the N2 1s->pi* transition, spaced as _fit_n2 expects them
+CENTERS = [400.345, 400.58, 400.805, 401.02, 401.22, 401.46, 401.68]
+AMPLITUDES = [0.085, 0.1, 0.07, 0.04, 0.02, 0.01, 0.005]
+
+
+class Run:
+    # the parts of a databroker run read by N2_fit.retrieve_spectra
+    def __init__(self, x, y, **config):
+        self.metadata = {'start': {'uid': str(uuid.uuid4()), 'motors': ['pgm_en'], 'detectors': ['kth01'], **config}}
+        self.primary = self
+        self.reads = 0
+        self._data = {'pgm_en': x, 'kth01': y}
+
+    def read(self, variables=None):
+        self.reads += 1
+        return {name: value for name, value in self._data.items() if variables is None or name in variables}
+
+
+class LazyRun(Run):
+    # a run whose primary stream is read lazily, as databroker's to_dask()
+    class Column:
+        def __init__(self, run, values):
+            self.run, self.values = run, values
+
+        @property
+        def data(self):
+            return self
+
+        def __len__(self):
+            return len(self.values)
+
+        def __getitem__(self, index):
+            self.run.slices.append(index)
+            return self.values[index]
+
+    def __init__(self, x, y, **columns):
+        super().__init__(x, y)
+        self._data.update(columns)
+        self.slices = []
+        self.columns = []
+
+    def to_dask(self):
+        lazy = self
+
+        class Dataset(dict):
+            def __getitem__(self, name):
+                lazy.columns.append(name)
+                return LazyRun.Column(lazy, lazy._data[name])
+        return Dataset()
+
+
+@pytest.fixture(scope='session')
+def n2():
+    # imported here so that the eLog tests do not need the dependencies of the N2 fit
+    from bessyii.plans.n2fit import N2_fit
+    return N2_fit(None, cache=False, trend=False)
+
+
+@pytest.fixture
+def centers():
+    return list(CENTERS)
+
+
+@pytest.fixture
+def amplitudes():
+    return list(AMPLITUDES)
+
+
+@pytest.fixture(scope='session')
+def n2_spectrum(n2):
+    # a synthetic N2 spectrum with a background and noise
+    def n2_spectrum(n=600, sigma=0.02, gamma=0.055, skew=0.3, noise=0.002, seed=0):
+        x = np.linspace(399.9, 402.1, n)
+        y = n2.n2_model(x, *AMPLITUDES, *CENTERS, sigma, gamma, skew) + 0.01
+        y += np.random.default_rng(seed).normal(0, noise, n)
+        return x, y
+    return n2_spectrum
+
+
+@pytest.fixture
+def fake_run():
+    return Run
+
+
+@pytest.fixture
+def lazy_run():
+    return LazyRun
+
+
+@pytest.fixture
+def grid_run(n2_spectrum):
+    # a grid_scan over cff, exit slit and energy, the exit slit snaking
+    def grid_run(cffs, slits, sigmas, n=400, snaking=True):
+        events = {'pgm_cff': [], 'exit_slit': [], 'pgm_en': [], 'kth01': []}
+        for i, cff in enumerate(cffs):
+            for j in (range(len(slits))[::-1] if snaking and i % 2 else range(len(slits))):
+                x, y = n2_spectrum(n=n, sigma=sigmas[i][j], gamma=0.03, noise=0.0005, seed=10*i+j)
+                for name, values in [('pgm_cff', [cff]*n), ('exit_slit', [slits[j]]*n), ('pgm_en', x), ('kth01', y)]:
+                    events[name].extend(values)
+        run = Run(np.array(events['pgm_en']), np.array(events['kth01']), plan_name='grid_scan',
+                  motors=['pgm_cff', 'exit_slit', 'pgm_en'], shape=[len(cffs), len(slits), n],
+                  extents=[[cffs[0], cffs[-1]], [slits[0], slits[-1]], [399.9, 402.1]], snaking=[False, snaking, False])
+        run._data.update({name: np.array(events[name]) for name in ['pgm_cff', 'exit_slit']})
+        return run
+    return grid_run
@@ -0,0 +1,196 @@
+##### -------  Local stand-in for the ICAT+ REST API -----------------
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class IcatServer:
+
+    """
+    A local HTTP server which answers like ICAT+, so that the eLog client can be
+    tested and measured without reaching icat.helmholtz-berlin.de
+
+    instantiate with
+
+      server = IcatServer(latency=0.2)
+      server.start()
+      writeToELog("hello", 7645, client=ICATClient(server.url, proxies={}))
+
+    or use it as a context manager. Every event posted is kept in server.events
+    and the number of requests received in server.requests
+
+    It emulates the session, investigation, event/create and tag endpoints used by
+    bessyii.eLog, and can be made slow, unreliable or throttled.
+
+    Parameters
+    ----------
+    latency: float
+        the delay in s added before every response
+    jitter: float
+        a random delay between 0 and jitter s added to latency
+    error_code: int, optional
+        if set every request is answered with this code, as when the service is down
+    error_rate: float
+        the fraction of requests answered with 503, chosen at random
+    max_rate: float, optional
+        the number of requests per second above which requests are answered with 429
+    seed: int, optional
+        the seed of the random errors and delays
+    users: dict, optional
+        the accounts which can log in, {username: (password, full name)}
+    investigations: list of dict, optional
+        the investigations returned to every user, with keys 'id', 'name' and 'title'
+    host: string
+        the address to listen on
+    port: int
+        the port to listen on, 0 picks a free one
+    """
+
+    _routes = [
+        ('POST', re.compile(r'^/icatplus/session$'), '_session'),
+        ('GET', re.compile(r'^/icatplus/catalogue/(?P<session_id>[^/]+)/investigation$'), '_investigations'),
+        ('POST', re.compile(r'^/icatplus/logbook/(?P<session_id>[^/]+)/investigation/id/(?P<investigation_id>[^/]+)/event/create$'), '_create_event'),
+        ('GET', re.compile(r'^/icatplus/logbook/(?P<session_id>[^/]+)/investigation/id/(?P<investigation_id>[^/]+)/tag$'), '_tags'),
+    ]
+
+    # the tags of every investigation, the machine tag is the one used by writeToELog
+    tags = [{'_id': '60deb980e105e3001a3daa2a', 'name': 'machine', 'color': '#000000'}]
+
+    def __init__(self, latency=0.0, jitter=0.0, error_code=None, error_rate=0.0, max_rate=None, users=None, investigations=None,
+                 seed=None, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_code = error_code
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self._random = random.Random(seed)
+        self._tokens = max_rate
+        self._refilled = time.monotonic()
+        self.users = users if users is not None else {}
+        self.investigations = investigations if investigations is not None else []
+        self.events = []
+        self.sessions = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """the base url to pass to ICATClient"""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/icatplus'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='icat-sim', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _session(self, body):
+        body = body or {}
+        account = self.users.get(body.get('username'))
+        if account is None or account[0] != body.get('password'):
+            return 403, {'message': 'authentication failed'}
+        session_id = str(uuid.uuid4())
+        with self._lock:
+            self.sessions[session_id] = body['username']
+        return 200, {'sessionId': session_id, 'fullName': account[1]}
+
+    def _investigations(self, body, session_id):
+        if session_id not in self.sessions:
+            return 403, {'message': 'invalid session'}
+        return 200, self.investigations
+
+    def _create_event(self, body, session_id, investigation_id):
+        with self._lock:
+            self.events.append({'session_id': session_id, 'investigation_id': investigation_id, 'event': body})
+        return 200, body
+
+    def _tags(self, body, session_id, investigation_id):
+        return 200, self.tags
+
+    def _throttled(self):
+        # a token bucket refilled at max_rate, holding at most one second of requests
+        if self.max_rate is None:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._refilled)*self.max_rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def _handle(self, method, path, body):
+        with self._lock:
+            self.requests += 1
+            throttled = self._throttled()
+            failed = self._random.random() < self.error_rate
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.error_code is not None:
+            return self.error_code, {'message': 'unavailable'}
+        if throttled:
+            return 429, {'message': 'too many requests'}
+        if failed:
+            return 503, {'message': 'unavailable'}
+        for route_method, pattern, name in self._routes:
+            match = pattern.match(path)
+            if match is not None and route_method == method:
+                return getattr(self, name)(body, **match.groupdict())
+        return 404, {'message': 'not found'}
+
+    def _make_handler(self):
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # keep the connections alive like the real server
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code, body):
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(code)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting
+                    self.close_connection = True
+
+            def _read_json(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return json.loads(self.rfile.read(length) or b'null')
+
+            def do_GET(self):
+                self._reply(*sim._handle('GET', self.path, self._read_json()))
+
+            def do_POST(self):
+                self._reply(*sim._handle('POST', self.path, self._read_json()))
+
+        return Handler
@@ -0,0 +1,127 @@
+import json
+import os
+import stat
+import threading
+import time
+
+import pytest
+from bessyii.eLog import ICATClient, ICATSessionCache, getInvestigations, getSessionID, requestInvestigationName
+from icat_sim import IcatServer
+
+## Set up env
+
+users = {'qqu': ('secret', 'Quentin Quux')}
+investigations = [{'id': 7645, 'name': 'HZB:2021-1234', 'title': 'Resolving power of the UE52 PGM'},
+                  {'id': 7646, 'name': 'HZB:2021-1235', 'title': 'Soft x-ray absorption of thin films'}]
+
+
+@pytest.fixture
+def server():
+    with IcatServer(users=users, investigations=investigations) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    return ICATClient(server.url, proxies={})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ICATSessionCache(str(tmp_path / 'cache.json'))
+
+### implement the tests
+
+def test_relogin_uses_cache(server, client, cache):
+
+    assert getInvestigations('qqu', 'secret', client=client, cache=cache) == (investigations, 'Quentin Quux')
+    assert server.requests == 2
+
+    # a new shell reads the same file
+    cache = ICATSessionCache(cache.path)
+    assert getInvestigations('qqu', 'secret', client=client, cache=cache) == (investigations, 'Quentin Quux')
+    assert server.requests == 2
+
+    assert stat.S_IMODE(os.stat(cache.path).st_mode) == 0o600
+    assert 'secret' not in open(cache.path).read()
+
+
+def test_cache_needs_password(server, client, cache):
+
+    session = getSessionID('qqu', 'secret', client=client, cache=cache)
+    assert cache.get_session('qqu', 'secret') == session
+    assert cache.get_session('qqu', 'wrong') is None
+    assert cache.get_session('other', 'secret') is None
+
+
+def test_concurrent_writers(tmp_path):
+
+    # two shells writing the cache at the same time
+    caches = [ICATSessionCache(str(tmp_path / 'cache.json')) for i in range(2)]
+    errors = []
+
+    def write(cache, username):
+        try:
+            for n in range(50):
+                cache.put_investigations(username, investigations*50)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(cache, f'user{i}')) for i, cache in enumerate(caches)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open(caches[0].path) as f:
+        assert set(json.load(f)) <= {'user0', 'user1'}
+    assert os.listdir(tmp_path) == ['cache.json']
+    assert stat.S_IMODE(os.stat(caches[0].path).st_mode) == 0o600
+
+
+def test_expired_entries_are_refreshed(server, client, tmp_path):
+
+    cache = ICATSessionCache(str(tmp_path / 'cache.json'), session_ttl=0.1, investigations_ttl=0.1)
+    first, _ = getSessionID('qqu', 'secret', client=client, cache=cache)
+    getInvestigations('qqu', 'secret', client=client, cache=cache)
+    time.sleep(0.2)
+
+    requests_sent = server.requests
+    getInvestigations('qqu', 'secret', client=client, cache=cache)
+    assert server.requests == requests_sent + 2
+    # the refreshed session may be older than 0.1 s already
+    cache.session_ttl = 3600
+    assert cache.get_session('qqu', 'secret')[0] != first
+
+
+def test_session_rejected_by_server(server, client, tmp_path):
+
+    cache = ICATSessionCache(str(tmp_path / 'cache.json'), investigations_ttl=0)
+    getInvestigations('qqu', 'secret', client=client, cache=cache)
+    server.sessions.clear()
+
+    # the cached session is refused, a new one is requested transparently
+    assert getInvestigations('qqu', 'secret', client=client, cache=cache) == (investigations, 'Quentin Quux')
+    assert cache.get_session('qqu', 'secret')[0] in server.sessions
+
+
+def test_request_investigation_name(server, client, cache, monkeypatch):
+
+    monkeypatch.setattr('builtins.input', lambda prompt: 'UE52')
+    assert requestInvestigationName('qqu', 'secret', client=client, cache=cache) == \
+        ('Resolving power of the UE52 PGM', '2021-1234', 7645, 'Quentin Quux')
+
+
+def test_cache_keeps_the_user_who_logged_in(server, client, cache, monkeypatch):
+
+    server.users['abc'] = ('other secret', 'Anna B. Cee')
+    monkeypatch.setattr('builtins.input', lambda prompt: 'abc')
+    monkeypatch.setattr('bessyii.eLog.getpass', lambda: 'other secret')
+
+    # the password of qqu is rejected and abc logs in instead
+    assert getInvestigations('qqu', 'wrong', client=client, cache=cache, return_username=True) == \
+        (investigations, 'Anna B. Cee', 'abc')
+    assert cache.get_investigations('qqu') is None and cache.get_session('qqu', 'wrong') is None
+    assert cache.get_investigations('abc') == investigations
+    assert cache.get_session('abc', 'other secret')[1] == 'Anna B. Cee'
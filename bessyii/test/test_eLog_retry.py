@@ -0,0 +1,141 @@
+import threading
+import time
+
+import pytest
+import requests
+from bessyii.eLog import (ICATClient, RetryPolicy, CircuitBreaker, ICATUnavailableError,
+                          getSessionID, requestInvestigationName, writeToELog)
+from icat_sim import IcatServer
+
+## Set up env
+
+users = {'qqu': ('secret', 'Quentin Quux')}
+
+
+@pytest.fixture
+def server():
+    with IcatServer(users=users) as server:
+        yield server
+
+
+def make_client(server, breaker=None, **kwargs):
+    policy = RetryPolicy(max_attempts=4, backoff=0.01, max_backoff=0.05, max_elapsed=5)
+    return ICATClient(server.url, proxies={}, timeout=0.3, policy=policy, breaker=breaker, **kwargs)
+
+### implement the tests
+
+def test_backoff_is_capped_and_jittered():
+
+    policy = RetryPolicy(backoff=1, max_backoff=8, jitter=0.5)
+    for attempt, expected in enumerate([1, 2, 4, 8, 8, 8]):
+        delays = [policy.delay(attempt) for i in range(100)]
+        assert all(expected/2 <= d <= expected for d in delays)
+        assert len(set(delays)) > 1
+
+
+def test_waits_for_the_trial_of_another_call():
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    # the trial request of another call, not answered yet
+    assert breaker.allow()
+    policy = RetryPolicy(max_attempts=3, backoff=0.05, jitter=0, fail_fast=False)
+    t0 = time.monotonic()
+    with pytest.raises(ICATUnavailableError, match='trial request') as error:
+        policy.call(lambda: pytest.fail("sent while the trial request is pending"), breaker)
+    # the attempts back off instead of spinning
+    assert time.monotonic() - t0 >= 0.3
+    assert 'None' not in str(error.value)
+
+
+def test_retries_counted_across_threads():
+
+    policy = RetryPolicy(max_attempts=51, backoff=0, jitter=0)
+
+    def fail():
+        raise requests.ConnectionError("refused")
+
+    def call():
+        with pytest.raises(ICATUnavailableError):
+            policy.call(fail)
+
+    threads = [threading.Thread(target=call) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert policy.retries == 8*50
+
+
+def test_get_session_id(server):
+
+    session_id, full_name = getSessionID('qqu', 'secret', client=make_client(server))
+    assert session_id in server.sessions
+    assert full_name == 'Quentin Quux'
+
+
+def test_get_session_id_gives_up_on_5xx(server):
+
+    server.error_code = 503
+    t0 = time.monotonic()
+    assert getSessionID('qqu', 'secret', client=make_client(server)) == (None, None)
+    assert time.monotonic() - t0 < 2
+    assert server.requests == 4
+
+
+def test_request_investigation_name_gives_up_on_timeout(server):
+
+    # the session is granted, then the server stops answering in time
+    client = make_client(server)
+    server.latency = 1
+    assert requestInvestigationName('qqu', 'secret', client=client) == (None, None, None, None)
+    assert server.requests <= 4
+
+
+def test_circuit_breaker_fails_fast(server):
+
+    server.error_code = 500
+    client = make_client(server, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.5))
+
+    assert writeToELog("lost", 7645, client=client) is None
+    assert client.breaker.is_open
+    requests_sent = server.requests
+
+    # while the breaker is open nothing reaches the server
+    t0 = time.monotonic()
+    with pytest.raises(ICATUnavailableError):
+        client.post('/session', {})
+    assert time.monotonic() - t0 < 0.1
+    assert server.requests == requests_sent
+
+    # after reset_timeout a trial request closes the breaker again
+    server.error_code = None
+    time.sleep(0.5)
+    assert writeToELog("written", 7645, client=client) == 200
+    assert not client.breaker.is_open
+
+
+def test_wait_for_breaker_when_not_failing_fast(server):
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+    breaker.record_failure()
+    policy = RetryPolicy(max_attempts=2, backoff=0.01, max_elapsed=5, fail_fast=False)
+    client = ICATClient(server.url, proxies={}, breaker=breaker)
+
+    response = client.post('/session', {'username': 'qqu', 'password': 'secret'}, policy=policy)
+    assert response.status_code == 200
+    assert not breaker.is_open
+
+
+def test_throttled_and_flaky_server_gets_every_entry():
+
+    policy = RetryPolicy(max_attempts=20, backoff=0.01, max_backoff=0.1, max_elapsed=10)
+    with IcatServer(error_rate=0.2, max_rate=50, seed=1) as server:
+        client = ICATClient(server.url, proxies={}, timeout=1, policy=policy)
+        codes = [writeToELog(f"entry {i}", 7645, client=client) for i in range(100)]
+        tags = client.get('/logbook/0/investigation/id/7645/tag')
+
+    assert codes == [200]*100
+    assert [event['event']['content'][0]['text'] for event in server.events] == [f"<p>entry {i}</p>" for i in range(100)]
+    assert policy.retries > 0
+    assert tags.json() == IcatServer.tags
@@ -0,0 +1,50 @@
+import pytest
+from bessyii.eLog import InvestigationIndex, selectInvestigation
+
+## Set up env
+
+investigations = [{'id': 7645, 'name': 'HZB:2021-1234', 'title': 'Resolving power of the UE52 PGM'},
+                  {'id': 7646, 'name': 'HZB:2021-1235', 'title': 'Soft x-ray absorption of thin films'},
+                  {'id': 7647, 'name': 'HZB:2022-0042', 'title': 'Commissioning of the UE52 SGM'},
+                  {'id': 7648, 'name': 'HZB:2022-0043', 'title': 'Magnetic dichroism in thin films'}]
+
+index = InvestigationIndex(investigations)
+
+
+def ids(matches):
+    return [item['id'] for score, item in matches]
+
+### implement the tests
+
+def test_verbatim_match():
+    assert ids(index.search('thin films')) == [7648, 7646]
+    assert ids(index.search('2022-0042')) == [7647]
+    assert ids(index.search('7646')) == [7646]
+    # shorter than a trigram, inside a word
+    assert ids(index.search('04')) == [7647, 7648]
+    assert ids(index.search('e5')) == [7647, 7645]
+
+
+def test_typos_and_word_order():
+    assert ids(index.search('resolvng powr'))[0] == 7645
+    assert ids(index.search('films thin'))[:2] == [7648, 7646]
+
+
+def test_top_k_and_no_match():
+    assert len(index.search('ue52', k=1)) == 1
+    assert index.search('tomography') == []
+    assert index.search('  ') == []
+
+
+def test_select_investigation(monkeypatch):
+
+    answers = iter(['tomography', 'ue52', '7', '1'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    assert selectInvestigation(investigations, index)['id'] == 7647
+
+
+def test_select_investigation_exit(monkeypatch):
+
+    answers = iter(['tomography', 'exit'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    assert selectInvestigation(investigations) is None
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+from bessyii.eLog import ICATClient, RetryPolicy, ELogCallback, ELogWriter, ELogSpool, _elog_event
+from jinja2 import Template
+from icat_sim import IcatServer
+
+## Set up env
+
+
+@pytest.fixture
+def server():
+    with IcatServer() as server:
+        yield server
+
+
+def texts(server):
+    return [e['event']['content'][0]['text'] for e in server.events]
+
+### implement the tests
+
+def test_spool_survives_outage_and_restart(server, tmp_path):
+
+    path = str(tmp_path / 'spool.msgpack')
+    server.error_code = 503
+
+    writer = ELogWriter(policy=RetryPolicy(max_attempts=1), client=ICATClient(server.url, proxies={}), spool=ELogSpool(path))
+    for i in range(3):
+        assert writer.submit(f"message {i}", 7645, uid=f"uid{i}")
+    assert not writer.flush(timeout=0.5)
+    writer.close(timeout=1)
+    assert server.events == []
+
+    # a new shell finds the posts in the spool and writes them in order once ICAT is back
+    server.error_code = None
+    spool = ELogSpool(path)
+    assert len(spool) == 3
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}), spool=spool, batch_size=2)
+    assert writer.flush(timeout=10)
+    assert texts(server) == ["<p>message 0</p>", "<p>message 1</p>", "<p>message 2</p>"]
+    assert writer.metrics['written'] == 3
+    writer.close()
+
+    assert len(ELogSpool(path)) == 0
+
+
+def test_spool_deduplicates_by_uid(server, tmp_path):
+
+    path = str(tmp_path / 'spool.msgpack')
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}), spool=ELogSpool(path))
+    assert writer.submit("start", 7645, uid='abc')
+    assert not writer.submit("start again", 7645, uid='abc')
+    assert writer.flush(timeout=10)
+    writer.close()
+
+    assert texts(server) == ["<p>start</p>"]
+    assert not ELogSpool(path).append(_elog_event("start"), 7645, None, uid='abc')
+
+
+def test_spool_ignores_truncated_record(tmp_path):
+
+    path = str(tmp_path / 'spool.msgpack')
+    spool = ELogSpool(path)
+    spool.append(_elog_event("kept"), 7645, None, uid='a')
+    spool.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x85\xa2op')
+
+    spool = ELogSpool(path)
+    assert [r['key'] for r in spool.pending()] == ['a']
+
+
+def test_spool_is_locked(tmp_path):
+
+    path = str(tmp_path / 'spool.msgpack')
+    spool = ELogSpool(path)
+    with pytest.raises(RuntimeError):
+        ELogSpool(path)
+    spool.close()
+
+
+def test_coalesced_messages_held_in_spool(server, tmp_path):
+
+    path = str(tmp_path / 'spool.msgpack')
+    template = Template("{{ uid }}")
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}), spool=ELogSpool(path))
+    callback = ELogCallback(None, template, template, template, writer=writer, coalesce=True)
+    callback.start({'uid': 'run1', 'eLog_id_num': '7645'})
+    callback.stop({'uid': 'stop1'})
+    assert writer.flush(timeout=10)
+    # the held messages are replaced by the entry of the run
+    assert texts(server) == ["<p>run1\nstop1</p>"]
+
+    # a crash before stop leaves the start in the spool, it is written next time
+    callback.start({'uid': 'run2', 'eLog_id_num': '7645'})
+    assert len(writer.spool) == 0
+    writer.close(timeout=1)
+    spool = ELogSpool(path)
+    assert [record['key'] for record in spool.pending()] == ['run2-held']
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}), spool=spool)
+    assert writer.flush(timeout=10)
+    assert texts(server) == ["<p>run1\nstop1</p>", "<p>run2</p>"]
+    writer.close()
+
+
+def test_spool_keeps_rendered_messages_during_outage(server, tmp_path):
+
+    server.error_code = 503
+    writer = ELogWriter(maxsize=2, policy=RetryPolicy(max_attempts=1), client=ICATClient(server.url, proxies={}),
+                        spool=ELogSpool(str(tmp_path / 'spool.msgpack')), replay_interval=0.3)
+    for i in range(20):
+        assert writer.submit(f"message {i}", 7645, uid=f"uid{i}")
+        assert writer.submit(lambda i=i: f"rendered {i}", 7645, uid=f"rendered{i}")
+    time.sleep(0.5)
+    # the spool is not written again for every message while ICAT is down
+    assert server.requests < 10
+    assert writer.metrics['dropped'] == 0
+
+    server.error_code = None
+    assert writer.flush(timeout=10)
+    assert sorted(texts(server)) == sorted([f"<p>message {i}</p>" for i in range(20)] +
+                                           [f"<p>rendered {i}</p>" for i in range(20)])
+    writer.close()
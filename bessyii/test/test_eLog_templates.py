@@ -0,0 +1,89 @@
+import os
+
+import pytest
+from bessyii.eLog import ICATClient, ELogWriter, ELogSpool, ELogCallback, TemplateRegistry
+from icat_sim import IcatServer
+from ophyd.sim import noisy_det
+from bluesky.preprocessors import SupplementalData
+from bluesky import RunEngine
+from bluesky import Msg
+
+## Set up env
+
+
+@pytest.fixture
+def server():
+    with IcatServer() as server:
+        yield server
+
+
+@pytest.fixture
+def RE():
+    RE = RunEngine({})
+    sd = SupplementalData()
+    sd.baseline = [noisy_det]
+    RE.preprocessors.append(sd)
+    RE.md['eLog_id_num'] = '7645'
+    return RE
+
+
+@pytest.fixture
+def templates(tmp_path):
+    paths = {}
+    for name, source in [('start', "Started {{ uid[:6] }}"), ('baseline', "noisy_det: {{ noisy_det }}"),
+                         ('stop', "Ended {{ exit_status }}")]:
+        paths[name] = str(tmp_path / (name + '.html'))
+        with open(paths[name], 'w') as f:
+            f.write(source)
+    return paths
+
+
+def texts(server):
+    return [e['event']['content'][0]['text'] for e in server.events]
+
+### implement the tests
+
+def test_registry_compiles_once_and_reloads(templates):
+
+    registry = TemplateRegistry(check_interval=0)
+    template = registry.get(templates['stop'])
+    assert registry.get(templates['stop']) is template
+    assert template.render(exit_status='success') == "Ended success"
+
+    with open(templates['stop'], 'w') as f:
+        f.write("Finished {{ exit_status }}")
+    stat = os.stat(templates['stop'])
+    os.utime(templates['stop'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert registry.get(templates['stop']).render(exit_status='success') == "Finished success"
+
+    assert registry.from_string("{{ a }}") is registry.from_string("{{ a }}")
+
+
+@pytest.mark.parametrize('spool', [False, True])
+def test_render_in_writer(server, RE, templates, tmp_path, spool):
+
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}),
+                        spool=ELogSpool(str(tmp_path / 'spool.msgpack')) if spool else None)
+    RE.subscribe(ELogCallback(None, templates['start'], templates['baseline'], templates['stop'], writer=writer,
+                              registry=TemplateRegistry(), render_in_writer=True))
+
+    uid, = RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+
+    assert texts(server)[0] == f"<p>Started {uid[:6]}</p>"
+    assert texts(server)[1].startswith("<p>noisy_det: ")
+    assert texts(server)[2] == "<p>Ended success</p>"
+    writer.close()
+
+
+def test_render_in_writer_coalesced(server, RE, templates):
+
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    RE.subscribe(ELogCallback(None, templates['start'], templates['baseline'], templates['stop'], writer=writer,
+                              coalesce=True, render_in_writer=True))
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+
+    text, = texts(server)
+    assert text.startswith("<p>Started ") and text.endswith("\nEnded success</p>")
+    writer.close()
@@ -0,0 +1,227 @@
+import time
+
+import pytest
+from bessyii import eLog
+from bessyii.eLog import ICATClient, RetryPolicy, ELogWriter, ELogCallback, ELogSpool, get_writer, writeToELog
+from icat_sim import IcatServer
+from ophyd.sim import noisy_det
+from ophyd import Signal
+from bluesky.preprocessors import SupplementalData
+from jinja2 import Template
+from bluesky import RunEngine
+from bluesky import Msg
+
+## Set up env
+
+LATENCY = 0.5
+
+j2_start_template = Template("<b>Plan Started</b> {{ uid[:6] }}")
+j2_baseline_template = Template("<b>Beamline Status</b><br>noisy_det: {{noisy_det}}")
+j2_end_template = Template("<b>Plan ended</b> exit_status: {{exit_status}}")
+
+
+@pytest.fixture
+def server():
+    with IcatServer() as server:
+        yield server
+
+
+@pytest.fixture
+def default_writer(server, monkeypatch, tmp_path):
+    # the shared writer and client talk to the simulated server and keep their files in tmp_path
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(eLog, '_default_client', ICATClient(server.url, proxies={}))
+    monkeypatch.setattr(eLog, '_default_writer', None)
+    yield
+    if eLog._default_writer is not None:
+        eLog._default_writer.close(timeout=10)
+
+
+@pytest.fixture
+def RE():
+    RE = RunEngine({})
+    sd = SupplementalData()
+    sd.baseline = [noisy_det]
+    RE.preprocessors.append(sd)
+    return RE
+
+### implement the tests
+
+def test_write(server):
+    assert writeToELog("eLog pytest message", 7645, client=ICATClient(server.url, proxies={})) == 200
+    assert server.events[0]['investigation_id'] == '7645'
+    assert server.events[0]['event']['content'][0]['text'] == "<p>eLog pytest message</p>"
+
+
+def test_write_through_default_spool(server, default_writer, tmp_path):
+
+    assert writeToELog("eLog pytest message", 7645) == 200
+    assert server.events[0]['event']['content'][0]['text'] == "<p>eLog pytest message</p>"
+    spool = get_writer().spool
+    assert spool.path == str(tmp_path / '.bessyii' / 'elog_spool.msgpack') and len(spool) == 0
+
+    # another shell running at the same time gets its own spool
+    other = eLog._open_default_spool()
+    assert other.path == str(tmp_path / '.bessyii' / 'elog_spool-1.msgpack')
+    other.close()
+
+
+def test_write_kept_while_icat_is_down(server, tmp_path):
+
+    server.error_code = 503
+    writer = ELogWriter(policy=RetryPolicy(max_attempts=1), client=ICATClient(server.url, proxies={}),
+                        spool=ELogSpool(str(tmp_path / 'spool.msgpack')), replay_interval=0.2)
+    assert writeToELog("kept", 7645, writer=writer, timeout=0.5) is None
+    assert len(writer.spool) == 1
+
+    server.error_code = None
+    assert writer.flush(timeout=10)
+    assert [event['event']['content'][0]['text'] for event in server.events] == ["<p>kept</p>"]
+    writer.close()
+
+
+def test_callback_does_not_block(server, RE):
+
+    server.latency = LATENCY
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    RE.subscribe(ELogCallback(None, j2_start_template, j2_baseline_template, j2_end_template, writer=writer))
+    RE.md['eLog_id_num'] = '7645'
+
+    t0 = time.monotonic()
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    blocked = time.monotonic() - t0
+
+    # start, one baseline and stop are written, each one delayed by the server
+    assert blocked < LATENCY
+    assert writer.flush(timeout=10)
+    assert len(server.events) == 3
+    assert server.events[0]['event']['content'][0]['text'].startswith("<p><b>Plan Started</b>")
+
+    metrics = writer.metrics
+    assert metrics['written'] == 3
+    assert metrics['pending'] == 0
+    assert metrics['max_latency'] >= LATENCY
+    writer.close()
+
+
+def test_callbacks_share_the_default_writer(server, default_writer, RE):
+
+    callbacks = [ELogCallback(None, j2_start_template, j2_baseline_template, j2_end_template) for i in range(3)]
+    writer = get_writer()
+    assert all(callback._writer is writer for callback in callbacks)
+
+    RE.subscribe(callbacks[0])
+    RE.md['eLog_id_num'] = '7645'
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+    assert len(server.events) == 3
+
+
+def test_writer_drops_when_full(server):
+
+    writer = ELogWriter(maxsize=1, client=ICATClient(server.url, proxies={}))
+    results = [writer.submit(f"message {i}", 7645) for i in range(5)]
+
+    assert not all(results)
+    assert writer.flush(timeout=10)
+    metrics = writer.metrics
+    assert metrics['dropped'] == results.count(False)
+    assert metrics['written'] == results.count(True) == len(server.events)
+    writer.close()
+
+
+def test_writer_retries_and_gives_up():
+
+    # nothing listens on this port, every attempt fails
+    writer = ELogWriter(policy=RetryPolicy(max_attempts=3, backoff=0.01), client=ICATClient('http://127.0.0.1:9/icatplus', proxies={}, timeout=1))
+    writer.submit("lost message", 7645)
+
+    assert writer.flush(timeout=10)
+    metrics = writer.metrics
+    assert metrics['failed'] == 1
+    assert metrics['retries'] == 2
+    writer.close()
+
+
+def test_coalesced_entry_per_run(server, RE):
+
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    RE.subscribe(ELogCallback(None, j2_start_template, j2_baseline_template, j2_end_template, writer=writer, coalesce=True))
+    RE.md['eLog_id_num'] = '7645'
+
+    for i in range(2):
+        RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+
+    # one entry per run with the start, the baseline and the stop
+    assert len(server.events) == 2
+    for event in server.events:
+        text = event['event']['content'][0]['text']
+        assert "Plan Started" in text and "Beamline Status" in text and "Plan ended" in text
+    writer.close()
+
+
+def test_coalesced_entry_size_threshold(server, RE):
+
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    RE.subscribe(ELogCallback(None, j2_start_template, j2_baseline_template, j2_end_template, writer=writer,
+                              coalesce=True, max_size=50))
+    RE.md['eLog_id_num'] = '7645'
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+
+    # the start and baseline exceed max_size and are written before the stop
+    texts = [event['event']['content'][0]['text'] for event in server.events]
+    assert len(texts) == 2
+    assert "Beamline Status" in texts[0] and "Plan ended" in texts[1]
+    writer.close()
+
+
+def test_coalesced_entry_written_after_max_delay(server):
+
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    callback = ELogCallback(None, j2_start_template, j2_baseline_template, j2_end_template, writer=writer,
+                            coalesce=True, max_delay=0.2)
+    callback.start({'uid': 'abcdef-1', 'eLog_id_num': '7645'})
+    time.sleep(0.5)
+    assert writer.flush(timeout=10)
+    # the start of a long run is written without waiting for another document
+    assert [event['event']['content'][0]['text'] for event in server.events] == ["<p><b>Plan Started</b> abcdef</p>"]
+
+    # clear writes the messages collected so far
+    callback.start({'uid': 'abcdef-2', 'eLog_id_num': '7645'})
+    callback.clear()
+    assert writer.flush(timeout=10)
+    assert len(server.events) == 2
+    writer.close()
+
+
+def test_baseline_diff(server):
+
+    s1 = Signal(name='s1', value=1.0)
+    s2 = Signal(name='s2', value=5)
+    RE = RunEngine({})
+    sd = SupplementalData()
+    sd.baseline = [s1, s2]
+    RE.preprocessors.append(sd)
+
+    template = Template("{% if s1 is defined %}s1: {{s1}};{% endif %}{% if s2 is defined %}s2: {{s2}};{% endif %}")
+    writer = ELogWriter(client=ICATClient(server.url, proxies={}))
+    RE.subscribe(ELogCallback(None, j2_start_template, template, j2_end_template, writer=writer,
+                              baseline_diff=True, tolerances={'s1': 0.1}))
+    RE.md['eLog_id_num'] = '7645'
+
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    s1.put(1.05)
+    s2.put(6)
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    s1.put(1.15)
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    RE([Msg('open_run', plan_args={}), Msg('close_run')])
+    assert writer.flush(timeout=10)
+
+    texts = [event['event']['content'][0]['text'] for event in server.events]
+    baselines = [text for text in texts if 'Plan' not in text]
+    # the drift of s1 is reported once it exceeds the tolerance, unchanged baselines are not written
+    assert baselines == ["<p>s1: 1.0;s2: 5;</p>", "<p>s2: 6;</p>", "<p>s1: 1.15;</p>"]
+    writer.close()
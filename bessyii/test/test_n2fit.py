@@ -0,0 +1,334 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import types
+import warnings
+
+import numpy as np
+import pytest
+from lmfit import Parameters
+from lmfit.models import LinearModel, SkewedVoigtModel
+from scipy.special import wofz
+from bessyii.plans.n2fit import FaddeevaTable, SkewedVoigtPeaksModel, faddeeva_function
+
+## Set up env, the fixtures are in conftest.py
+
+
+def finite_difference(f, params, name, h=1e-7):
+    up, down = params.copy(), params.copy()
+    step = h*max(1, abs(params[name].value))
+    up[name].value += step
+    down[name].value -= step
+    return (f(up)-f(down))/(2*step)
+
+
+### implement the tests
+
+@pytest.mark.parametrize('skew', [0, 0.7, -2])
+def test_skewed_voigt_derivatives(skew, n2):
+
+    x = np.linspace(400, 401, 200)
+    values = {'amplitude': 0.2, 'center': 400.5, 'sigma': 0.03, 'gamma': 0.05, 'skew': skew}
+    derivatives = n2.skewed_voigt_derivatives(x, **values)
+    for name, derivative in derivatives.items():
+        h = 1e-7*max(1, abs(values[name]))
+        up, down = dict(values), dict(values)
+        up[name] += h
+        down[name] -= h
+        expected = (n2.skewed_voigt(x, **up)-n2.skewed_voigt(x, **down))/(2*h)
+        assert np.allclose(derivative, expected, rtol=1e-5, atol=1e-6*np.max(np.abs(expected))), name
+
+
+def test_fixed_param_jacobian(n2, n2_spectrum, centers, amplitudes):
+
+    x, y = n2_spectrum()
+    params = Parameters()
+    for i, (a, c) in enumerate(zip(amplitudes, centers)):
+        params.add(f'a{i+1}', value=a)
+    for i, c in enumerate(centers):
+        params.add(f'c{i+1}', value=c)
+    params.add('sigma', value=0.025)
+    params.add('gamma', value=0.05)
+    params.add('skew', value=0.4)
+    params.add('lin_slope', value=0.001)
+    params.add('lin_intercept', value=0.01)
+    params['c7'].vary = False
+
+    def model(p):
+        v = p.valuesdict()
+        return n2.n2_model(x, *[v[f'a{i}'] for i in range(1, 8)], *[v[f'c{i}'] for i in range(1, 8)],
+                           v['sigma'], v['gamma'], v['skew']) + v['lin_slope']*x + v['lin_intercept']
+
+    jac = -n2._make_jacobian(fix_param=True)(params, y, None, x=x)
+    varied = [name for name, par in params.items() if par.vary]
+    assert jac.shape == (len(varied), len(x))
+    for column, name in zip(jac, varied):
+        expected = finite_difference(model, params, name)
+        assert np.allclose(column, expected, rtol=1e-4, atol=1e-5*np.max(np.abs(expected))), name
+
+
+def test_free_param_jacobian(n2, n2_spectrum):
+
+    x, y = n2_spectrum()
+    mod = SkewedVoigtModel(prefix='v1_') + SkewedVoigtModel(prefix='v2_') + LinearModel(prefix='lin_')
+    params = mod.make_params(v1_amplitude=0.08, v1_center=400.35, v1_sigma=0.02, v1_skew=0.3,
+                             v2_amplitude=0.1, v2_center=400.6, v2_sigma=0.015, v2_skew=-0.5,
+                             lin_slope=0.001, lin_intercept=0.01)
+    for prefix, gamma in [('v1_', 0.05), ('v2_', 0.04)]:
+        params[prefix+'gamma'].set(value=gamma, vary=True, expr='')
+
+    jac = -n2._make_jacobian(fix_param=False)(params, y, None, x=x)
+    varied = [name for name, par in params.items() if par.vary and not par.expr]
+    assert len(varied) == 12
+    for column, name in zip(jac, varied):
+        expected = finite_difference(lambda p: mod.eval(p, x=x), params, name)
+        assert np.allclose(column, expected, rtol=1e-4, atol=1e-5*np.max(np.abs(expected))), name
+
+
+def test_fit_with_jacobian_matches_finite_differences(n2, n2_spectrum):
+
+    x, y = n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005)
+    results = [n2._fit_n2(x, y, gamma=0.03, fix_param=True, jacobian=jacobian) for jacobian in [False, True]]
+    (sigma_fd, center_fd, _, ratio_fd), (sigma, center, _, ratio) = results
+    assert sigma == pytest.approx(sigma_fd, rel=1e-4)
+    assert sigma == pytest.approx(0.015, rel=0.05)
+    assert center == pytest.approx(center_fd, abs=1e-5)
+    assert ratio == pytest.approx(ratio_fd, rel=1e-4)
+
+    sigma, center, sigma_err, ratio = n2._fit_n2(x, y, gamma=0.03, fix_param=False)
+    assert 0.001 <= sigma <= 0.02
+    assert center == pytest.approx(400.345, abs=0.02)
+
+
+@pytest.mark.parametrize('n_peaks', [1, 3, 12])
+def test_skewed_voigt_peaks_model(n_peaks):
+
+    x = np.linspace(399.9, 402.1, 500)
+    rng = np.random.default_rng(n_peaks)
+    fused = SkewedVoigtPeaksModel(n_peaks)
+    params = fused.make_params()
+    composite = None
+    for i in range(n_peaks):
+        prefix = f'v{i+1}_'
+        peak = SkewedVoigtModel(prefix=prefix)
+        values = {prefix+'amplitude': rng.uniform(0.01, 0.1), prefix+'center': rng.uniform(400, 402),
+                  prefix+'sigma': rng.uniform(0.01, 0.03), prefix+'gamma': rng.uniform(0.02, 0.06), prefix+'skew': rng.normal()}
+        composite_params = peak.make_params(**values) if composite is None else composite_params
+        if composite is not None:
+            composite_params.update(peak.make_params(**values))
+        composite_params[prefix+'gamma'].set(value=values[prefix+'gamma'], expr='')
+        for name, value in values.items():
+            params[name].set(value=value)
+        composite = peak if composite is None else composite + peak
+
+    assert np.allclose(fused.eval(params, x=x), composite.eval(composite_params, x=x), rtol=1e-12, atol=1e-14)
+    components = fused.eval_components(params=params, x=x)
+    expected = composite.eval_components(params=composite_params, x=x)
+    assert list(components) == list(expected) + ['skewed_voigt_peaks']
+    assert np.allclose(components['skewed_voigt_peaks'], fused.eval(params, x=x))
+    for prefix in expected:
+        assert np.allclose(components[prefix], expected[prefix], rtol=1e-12, atol=1e-14)
+
+
+def test_fit_n_peaks(n2, n2_spectrum):
+
+    x, y = n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005)
+    sigma, center, sigma_err, ratio = n2._fit_n2(x, y, gamma=0.03, n_peaks=7)
+    assert 0.001 <= sigma <= 0.02
+    assert center == pytest.approx(400.345, abs=0.02)
+    assert np.isfinite(ratio)
+    with pytest.raises(ValueError):
+        n2._fit_n2(x, y, n_peaks=11)
+
+
+def test_headless_fit_result(tmp_path, n2, n2_spectrum):
+
+    x, y = n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005)
+    result = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True)
+
+    assert result.success
+    assert (result.sigma, result.center, result.sigma_err, result.vp_ratio) == n2._fit_n2(x, y, gamma=0.03, fix_param=True, plot=False)
+    assert result.RP == pytest.approx(result.center/(2*result.sigma*np.sqrt(2*np.log(2))))
+    # the uncertainty band is only computed for the figure
+    assert result._uncertainty is None
+
+    future = result.render_async(str(tmp_path / 'fit.png'))
+    assert future.result(timeout=30) == str(tmp_path / 'fit.png')
+    assert (tmp_path / 'fit.png').stat().st_size > 0
+    assert result.uncertainty.shape == x.shape
+
+    fig = result.plot()
+    assert len(fig.axes) == 3
+
+
+def test_coarse_to_fine(n2, n2_spectrum):
+
+    x, y = n2_spectrum(n=6000, sigma=0.015, gamma=0.03, noise=0.0015)
+    full = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True)
+    result = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, coarse=8)
+
+    assert list(full.stages) == ['full'] and list(result.stages) == ['coarse', 'fine']
+    assert result.stages['coarse']['points'] == 750
+    # the fine stage starts next to the optimum and only sees the peaks
+    assert result.stages['fine']['nfev'] < full.stages['full']['nfev']
+    assert result.stages['fine']['points'] < 6000
+    assert result.success
+    assert result.sigma == pytest.approx(full.sigma, rel=1e-3)
+    assert result.vp_ratio == pytest.approx(full.vp_ratio, rel=1e-3)
+    # bins as wide as the peaks are not used, at most sigma/4 = 13 points here
+    assert n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, coarse=1000).stages['coarse']['bin'] == 13
+
+
+def loop_find_first_max(x, y, fwhm):
+    # the window scan find_first_max did before it was vectorized
+    step    = x[1]-x[0]
+    ind     = int(fwhm/step/1)
+    n_steps = int(x.shape[0]/ind)
+    for i in range(n_steps):
+        if i == 0:
+            amax    = np.max(y[i*ind:i*ind+ind])
+            argmax  = np.argmax(y[i*ind:i*ind+ind])
+        else:
+            tmax    = np.max(y[i*ind:i*ind+ind])
+            targmax = np.argmax(y[i*ind:i*ind+ind]) +i*ind
+            if tmax <= amax and amax > 0.8:
+                break
+            if tmax >= amax:
+                amax = tmax
+                argmax = targmax
+    return x[argmax]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_vectorized_guess_helpers(seed, n2, n2_spectrum):
+
+    rng = np.random.default_rng(seed)
+    x, y = n2_spectrum(n=int(rng.integers(300, 3000)), noise=0.02, seed=seed)
+    y = y/np.max(y)
+    # plateaus and a spectrum never above 0.8 take the other branches of the scan
+    y = np.round(y, 1) if seed % 3 == 1 else y*0.7 if seed % 3 == 2 else y
+    assert n2.find_first_max(x, y, 0.094) == loop_find_first_max(x, y, 0.094)
+
+    values = rng.uniform(399.5, 402.5, 10)
+    for positions in [x, x[::-1], np.round(x, 2), rng.permutation(x)]:
+        expected = [np.abs(positions-value).argmin() for value in values]
+        assert list(n2.find_nearest_idx(positions, values)) == expected
+        assert n2.find_nearest_idx(positions, values[0]) == expected[0]
+    assert list(n2.guess_amp(x, y, values)) == [y[np.abs(x-value).argmin()] for value in values]
+    assert n2.RMS(y-0.5) == pytest.approx(np.sqrt(sum((v-0.5)**2 for v in y)/len(y)))
+
+
+def test_faddeeva_table():
+
+    table = faddeeva_function('table')
+    assert faddeeva_function('table') is table
+    assert table.error < 1e-6
+    rng = np.random.default_rng(0)
+    # the inside of the table, its edge, far out as the tails of narrow peaks, and the real axis
+    z = np.concatenate([rng.uniform(-6, 6, 20000) + 1j*rng.uniform(0, 6, 20000),
+                        6*np.exp(1j*rng.uniform(0, np.pi, 2000))*rng.uniform(0.99, 1.01, 2000),
+                        rng.uniform(-2000, 2000, 20000) + 1j*rng.uniform(0, 100, 20000),
+                        np.linspace(-10, 10, 2001) + 0j])
+    w = wofz(z)
+    assert np.max(np.abs(table(z) - w)/np.abs(w)) < 1e-6
+    # below the real axis it is wofz
+    z = rng.uniform(-3, 3, 100) - 1j*rng.uniform(0, 3, 100)
+    assert np.allclose(table(z), wofz(z), rtol=1e-14)
+    # in place, as SkewedVoigtPeaksModel uses it, also into a buffer which is not contiguous
+    z = z.reshape(2, 50)
+    out = np.empty((2, 50), dtype=complex)
+    assert table(z, out=out) is out and np.allclose(out, wofz(z), rtol=1e-14)
+    out = np.empty((50, 2), dtype=complex).T
+    assert table(z, out=out) is out and np.allclose(out, wofz(z), rtol=1e-14)
+    # a coarser table has a larger error
+    assert FaddeevaTable(step=0.1, order=2).error > table.error
+    with pytest.raises(ValueError):
+        faddeeva_function('humlicek')
+
+
+def test_fit_with_faddeeva_table(n2, n2_spectrum, centers):
+
+    x, y = n2_spectrum(n=2000, sigma=0.015, gamma=0.03, noise=0.0005)
+    result = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True)
+    table = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, faddeeva='table')
+    assert table.fit_kwargs['faddeeva'] == 'table' and 'faddeeva' not in result.fit_kwargs
+    assert table.success
+    assert table.sigma == pytest.approx(result.sigma, rel=1e-6)
+    assert table.vp_ratio == pytest.approx(result.vp_ratio, rel=1e-6)
+    fused = SkewedVoigtPeaksModel(3, faddeeva=faddeeva_function('table'))
+    params = fused.make_params()
+    for i, c in enumerate(centers[:3]):
+        params[f'v{i+1}_center'].set(value=c)
+        params[f'v{i+1}_sigma'].set(value=0.015)
+        params[f'v{i+1}_skew'].set(value=0.5)
+    assert np.allclose(fused.eval(params, x=x), SkewedVoigtPeaksModel(3).eval(params, x=x), rtol=1e-6, atol=0)
+
+
+def check_jit_kernels(n2, x, y):
+    # the model and the jacobian of the kernels against the NumPy ones
+    y = y/np.max(y)
+    weights = np.linspace(0.5, 2, len(x))
+    for fix_param in [True, False]:
+        mod, pars, _ = n2._make_n2_model(x, y, gamma=0.03, fix_param=fix_param)
+        jit_mod, jit_pars, _ = n2._make_n2_model(x, y, gamma=0.03, fix_param=fix_param, jit=True)
+        expected = mod.eval(pars, x=x)
+        assert np.allclose(jit_mod.eval(jit_pars, x=x), expected, rtol=0, atol=1e-6*np.max(np.abs(expected)))
+        # a negative gamma takes the kernel below the real axis
+        pars['gamma' if fix_param else 'v2_gamma'].set(value=-0.01, min=-1)
+        jac = n2._make_jacobian(fix_param=fix_param)(pars, y, weights, x=x)
+        jit_jac = n2._make_jacobian(fix_param=fix_param, jit=True)(pars, y, weights, x=x)
+        assert jit_jac.shape == jac.shape
+        assert np.allclose(jit_jac, jac, rtol=0, atol=1e-6*np.max(np.abs(jac)))
+
+
+def test_jit_kernels(n2, n2_spectrum):
+
+    pytest.importorskip('numba')
+    check_jit_kernels(n2, *n2_spectrum(n=1000, sigma=0.015, gamma=0.03))
+
+
+def test_jit_kernels_python(n2, n2_spectrum, monkeypatch):
+
+    # the Python functions of the kernels, so that their logic is tested with or without numba
+    from bessyii.plans import n2fit, n2fit_jit
+    kernels = types.SimpleNamespace(skewed_voigt_peaks=n2fit_jit.skewed_voigt_peaks.py_func,
+                                    skewed_voigt_peaks_jacobian=n2fit_jit.skewed_voigt_peaks_jacobian.py_func)
+    monkeypatch.setattr(n2fit, '_jit_kernels', lambda: kernels)
+    check_jit_kernels(n2, *n2_spectrum(n=200, sigma=0.015, gamma=0.03))
+
+    table = faddeeva_function('table')
+    rng = np.random.default_rng(1)
+    # inside the table, outside of it, and below the real axis
+    z = np.concatenate([rng.uniform(-6, 6, 200) + 1j*rng.uniform(0, 6, 200),
+                        rng.uniform(-200, 200, 50) + 1j*rng.uniform(0, 10, 50),
+                        rng.uniform(-3, 3, 50) - 1j*rng.uniform(0, 3, 50)])
+    w = np.array([n2fit_jit.faddeeva.py_func(complex(value), table._coefficients, table._n, table.step,
+                                             table.radius, table.terms) for value in z])
+    assert np.allclose(w, wofz(z), rtol=1e-6, atol=0)
+
+
+def test_jit_without_numba_warns_once(n2, n2_spectrum):
+
+    from bessyii.plans import n2fit
+    if n2fit._jit_kernels() is not None:
+        pytest.skip('numba is installed')
+    n2fit._warn_no_numba.cache_clear()
+    x, y = n2_spectrum(n=200)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        for i in range(3):
+            n2._make_n2_model(x, y/np.max(y), gamma=0.03, fix_param=True, jit=True)
+    assert [str(warning.message) for warning in caught] == ['numba is not installed, the N2 fit is evaluated with NumPy']
+
+
+def test_fit_with_jit(n2, n2_spectrum):
+
+    x, y = n2_spectrum(n=2000, sigma=0.015, gamma=0.03, noise=0.0005)
+    result = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True)
+    # without numba the same fit runs with NumPy
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        jit = n2.fit_spectrum(x, y, gamma=0.03, fix_param=True, jit=True)
+    assert jit.fit_kwargs['jit'] is True and jit.success
+    assert jit.sigma == pytest.approx(result.sigma, rel=1e-6)
+    assert jit.vp_ratio == pytest.approx(result.vp_ratio, rel=1e-6)
@@ -0,0 +1,171 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import os
+import time
+
+import numpy as np
+import pytest
+from bessyii.plans.n2fit import N2_fit, N2FitCache, N2FitResult, RPTrendStore
+
+## Set up env, the fixtures are in conftest.py
+
+### implement the tests
+
+def test_retrieve_spectra(n2_spectrum, fake_run, lazy_run):
+
+    x, y = n2_spectrum(n=1000, noise=0.05)
+    assert (y < 0).any()
+    camera = np.zeros((1000, 64, 64))
+    for run in [fake_run(x, y), lazy_run(x, y, camera=camera)]:
+        fit = N2_fit({-1: run}, cache=False, trend=False)
+        x_read, y_read = fit.retrieve_spectra(-1, chunk_size=300)
+        assert np.array_equal(x_read, x[y >= 0]) and np.array_equal(y_read, y[y >= 0])
+    # only the motor and detector are read, in chunks
+    assert run.columns == ['pgm_en', 'kth01']
+    assert run.slices == [slice(start, start+300) for start in [0, 300, 600, 900] for field in range(2)]
+
+
+def test_fit_cache(tmp_path, n2_spectrum, fake_run):
+
+    db = {-1: fake_run(*n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005))}
+    cache = N2FitCache(str(tmp_path / 'fits.sqlite'))
+    fitter = N2_fit(db, cache=cache, trend=False)
+
+    result = fitter.fit_scan(-1, gamma=0.03, fix_param=True)
+    assert db[-1].reads == 1 and len(cache) == 1
+
+    # the same fit is read from the cache, another one is fitted
+    cached = N2_fit(db, cache=cache, trend=False).fit_scan(-1, gamma=0.03, fix_param=True)
+    assert db[-1].reads == 1
+    for key in ['sigma', 'center', 'sigma_err', 'vp_ratio', 'RP']:
+        assert getattr(cached, key) == getattr(result, key)
+    assert np.array_equal(cached.covar, result.covar)
+    assert cached.var_names == result.var_names
+    fitter.fit_scan(-1, gamma=0.04, fix_param=True)
+    assert db[-1].reads == 2 and len(cache) == 2
+
+    # the figure of a cached result is made from the stored best fit
+    assert np.allclose(cached.out.best_fit, result.out.best_fit, atol=1e-8)
+    assert np.allclose(cached.out.init_fit, result.out.init_fit)
+    assert cached.out.params['sigma'].value == pytest.approx(result.sigma, rel=1e-6)
+    assert np.allclose(cached.uncertainty, result.uncertainty)
+    assert cached.report() == result.report()
+    assert len(cached.plot().axes) == 3
+
+    # the uncertainty of the valley/peak ratio is only stored once computed
+    entry = N2FitResult.from_entry(fitter, cached.to_entry())
+    assert entry.to_entry()['vp_ratio_err'] is None
+    entry.compute_errors()
+    assert entry.to_entry()['vp_ratio_err'] == pytest.approx(result.vp_ratio_err) and result.vp_ratio_err > 0
+
+    rows = N2_fit(db, cache=cache, trend=False).fit_n2_many([-1], gamma=0.03, fix_param=True, progress=False)
+    assert db[-1].reads == 2
+    assert rows[0]['RP'] == result.RP and rows[0]['status'] == 'ok'
+
+
+def test_fit_cache_evicts_least_recently_used(tmp_path):
+
+    cache = N2FitCache(str(tmp_path / 'fits.sqlite'), max_size=3500)
+    entry = {'data': bytes(1000)}
+    keys = [cache.key(f'uid{i}', 'pgm_en', 'kth01', {'gamma': 0.03}) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, entry)
+    assert cache.get(keys[0]) == entry
+    cache.put(keys[3], entry)
+
+    assert len(cache) == 3
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) == entry for key in [keys[0], keys[2], keys[3]])
+    assert cache.key('uid0', 'pgm_en', 'kth01', {'gamma': 0.03}) != cache.key('uid0', 'pgm_en', 'kth01', {'gamma': 0.04})
+    assert cache.key('uid0', 'pgm_en', 'kth01', {'gamma': 0.03}) != cache.key('uid0', 'pgm_en', 'kth01', {'gamma': 0.03},
+                                                                             start={'sigma': 0.02})
+
+
+def test_warm_start(tmp_path, n2_spectrum, fake_run):
+
+    db = {-3: fake_run(*n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005), cff=2.0, grating='1200 l/mm'),
+          -2: fake_run(*n2_spectrum(sigma=0.02, gamma=0.03, noise=0.0005, seed=1), cff=5.0, grating='1200 l/mm'),
+          -1: fake_run(*n2_spectrum(sigma=0.016, gamma=0.03, noise=0.0005, seed=2), cff=2.2, grating='1200 l/mm')}
+    fit = N2_fit(db, cache=N2FitCache(tmp_path/'cache.sqlite'), trend=False)
+    assert fit.fit_scan(-3, warm_start=True, gamma=0.03, fix_param=True).warm_start is None
+    assert fit.fit_scan(-2, gamma=0.03, fix_param=True).success
+
+    cold = N2_fit(None, cache=False, trend=False).fit_spectrum(*fit.retrieve_spectra(-1), gamma=0.03, fix_param=True)
+    warm = fit.fit_scan(-1, warm_start=True, gamma=0.03, fix_param=True)
+
+    # the closest cff is 2.0, and the fit needs fewer evaluations to reach the same result
+    assert warm.warm_start == db[-3].metadata['start']['uid']
+    assert warm.out.nfev < cold.out.nfev
+    assert warm.sigma == pytest.approx(cold.sigma, rel=1e-3)
+    assert warm.vp_ratio == pytest.approx(cold.vp_ratio, rel=1e-3)
+    # another grating, which is not a number, has no fit to start from
+    other = fake_run(*n2_spectrum(sigma=0.016, gamma=0.03, noise=0.0005, seed=3), cff=2.2, grating='400 l/mm')
+    fit._db[-4] = other
+    assert fit.fit_scan(-4, warm_start=True, gamma=0.03, fix_param=True).warm_start is None
+    # a fit from the cache is not started again
+    assert fit.fit_scan(-1, warm_start=True, gamma=0.03, fix_param=True).warm_start is None
+    # the warm started fit is not returned for the cold one
+    fitted = len(fit.cache)
+    assert fit.fit_scan(-1, gamma=0.03, fix_param=True).out.nfev == cold.out.nfev
+    assert len(fit.cache) == fitted + 1
+    # without a cache there is no fit to start from
+    with pytest.warns(UserWarning, match='warm_start'):
+        assert N2_fit(db).fit_scan(-1, warm_start=True, gamma=0.03, fix_param=True).warm_start is None
+
+
+def test_rp_trend_store(tmp_path, n2_spectrum, fake_run):
+
+    now = time.time()
+    db = {-3: fake_run(*n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005), cff=3.0, grating='1200', time=now-200*86400),
+          -2: fake_run(*n2_spectrum(sigma=0.02, gamma=0.03, noise=0.0005, seed=1), cff=2.5, grating='1200', time=now-86400),
+          -1: fake_run(*n2_spectrum(sigma=0.016, gamma=0.03, noise=0.0005, seed=2), cff=2.0, grating='1200', time=now-2*86400)}
+    cache = N2FitCache(tmp_path/'cache.sqlite')
+    N2_fit(db, cache=cache, trend=False).fit_scan(-3, gamma=0.03, fix_param=True)
+    store = RPTrendStore(tmp_path/'trend.sqlite')
+    fit = N2_fit(db, cache=cache, trend=store)
+    results = {identifier: fit.fit_scan(identifier, gamma=0.03, fix_param=True) for identifier in db}
+    # the fits from the cache are recorded once
+    fit.fit_scan(-1, gamma=0.03, fix_param=True)
+    assert len(store.query(success=None)['uid']) == 3
+
+    recent = store.query(days=90)
+    assert list(recent['uid']) == [db[i].metadata['start']['uid'] for i in [-1, -2]]
+    assert list(recent['cff']) == [2.0, 2.5] and list(recent['grating']) == ['1200', '1200']
+    assert recent['RP'] == pytest.approx([results[-1].RP, results[-2].RP])
+    # sigma is not a free parameter of fits with fixed parameters, their errors are not recorded
+    assert np.isnan(recent['sigma_err']).all() and np.isnan(recent['RP_err']).all()
+    assert all(np.isnan(store.average('RP', days=90)))
+    assert list(store.query(cff=(2.1, 3.5))['cff']) == [3.0, 2.5]
+    assert len(store.query(grating='400')['RP']) == 0
+    with pytest.raises(ValueError):
+        store.query(mirror='M1')
+    axes = store.plot('cff', 'RP', days=90)
+    assert axes.get_xlabel() == 'cff' and len(axes.containers) == 1
+
+    # the fits with free parameters have errors and are weighted by them
+    errors = {-1: 0.001, -2: 0.002}
+    for identifier, sigma_err in errors.items():
+        entry = dict(results[identifier].to_entry(), fit_kwargs={'fix_param': False}, sigma_err=sigma_err)
+        store.append(entry, db[identifier].metadata['start']['uid'], start_time=now-86400, options={'free': True},
+                     config={'cff': 2.0})
+    weights = np.array([(results[i].sigma/(results[i].RP*errors[i]))**2 for i in errors])
+    mean, error = store.average('RP', days=90)
+    assert mean == pytest.approx(np.sum(weights*[results[i].RP for i in errors])/np.sum(weights))
+    assert error == pytest.approx(1/np.sqrt(np.sum(weights)))
+    assert len(store.query(days=90)['RP']) == 4
+
+
+def test_nothing_written_unless_asked(tmp_path, monkeypatch, n2_spectrum, fake_run):
+
+    monkeypatch.setenv('HOME', str(tmp_path))
+    db = {-1: fake_run(*n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005), cff=2.0)}
+    fit = N2_fit(db)
+    assert fit.cache is None and fit.trend is None
+    fit.fit_scan(-1, gamma=0.03, fix_param=True)
+    assert not (tmp_path / '.bessyii').exists()
+
+    fit = N2_fit(db, cache=True, trend=True)
+    fit.fit_scan(-1, gamma=0.03, fix_param=True)
+    assert len(fit.cache) == 1 and len(fit.trend.query(success=None)['uid']) == 1
+    assert sorted(os.listdir(tmp_path / '.bessyii')) == ['n2fit_cache.sqlite', 'rp_trend.sqlite']
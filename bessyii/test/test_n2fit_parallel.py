@@ -0,0 +1,180 @@
+import matplotlib
+matplotlib.use('Agg')
+
+import threading
+import time
+
+import numpy as np
+import pytest
+from bessyii.plans.n2fit import N2_fit, N2FitCache, N2FitCallback, RPTrendStore
+
+## Set up env, the fixtures are in conftest.py
+
+### implement the tests
+
+def test_fit_n2_many(n2_spectrum, fake_run):
+
+    db = {-1: fake_run(*n2_spectrum(sigma=0.015, gamma=0.03, noise=0.0005)),
+          -2: fake_run(*n2_spectrum(sigma=0.018, gamma=0.03, noise=0.0005, seed=1))}
+    progress = []
+    rows = N2_fit(db, cache=False, trend=False).fit_n2_many([-1, 'missing', -2], max_workers=2, gamma=0.03, fix_param=True,
+                                                            progress=lambda done, total, row: progress.append((done, total, row['scan'])))
+
+    assert [row['scan'] for row in rows] == [-1, 'missing', -2]
+    assert rows[0]['status'] == rows[2]['status'] == 'ok'
+    assert rows[0]['sigma'] == pytest.approx(0.015, rel=0.05)
+    assert rows[2]['sigma'] == pytest.approx(0.018, rel=0.05)
+    assert rows[0]['RP'] == pytest.approx(rows[0]['center']/(2*rows[0]['sigma']*np.sqrt(2*np.log(2))))
+    assert rows[1]['status'].startswith('reading failed') and np.isnan(rows[1]['sigma'])
+    assert [(done, total) for done, total, scan in progress] == [(1, 3), (2, 3), (3, 3)]
+    assert sorted(map(str, [scan for done, total, scan in progress])) == ['-1', '-2', 'missing']
+
+
+def test_fit_multistart(n2, n2_spectrum):
+
+    x, y = n2_spectrum(sigma=0.015, gamma=0.03, noise=0.002)
+    result = n2.fit_multistart(x, y, n_starts=4, n_bootstrap=24, max_workers=2, gamma=0.03, fix_param=True)
+
+    assert len(result.starts) == 4 and result.starts[0]['jitter'] is None
+    assert result.success
+    assert result.out.chisqr == pytest.approx(min(start['chisqr'] for start in result.starts if start['success']))
+    assert result.intervals['n'] > 20
+    for key in ['sigma', 'vp_ratio', 'RP']:
+        low, median, high = result.intervals[key]
+        assert low < median < high
+        assert low <= getattr(result, key) <= high
+    assert result.intervals['sigma'][0] < 0.015 < result.intervals['sigma'][2]
+    # the same seed gives the same starts
+    again = n2.fit_multistart(x, y, n_starts=4, max_workers=2, gamma=0.03, fix_param=True)
+    assert [start['jitter'] for start in again.starts] == [start['jitter'] for start in result.starts]
+    assert again.intervals is None
+
+
+def test_live_fit_callback(n2_spectrum):
+
+    from bluesky import RunEngine
+    from bluesky.plans import scan
+    from ophyd.sim import SynAxis, SynSignal
+
+    motor = SynAxis(name='pgm_en')
+    x, y = n2_spectrum(n=2000, sigma=0.015, gamma=0.03, noise=0.0005)
+    detector = SynSignal(func=lambda: np.interp(motor.readback.get(), x, y), name='kth01')
+    estimates = []
+    live = N2FitCallback(N2_fit(None, cache=False, trend=False), every=100, min_points=200, sigma_rel_err=0.01,
+                         on_update=estimates.append, gamma=0.03, fix_param=True)
+    RE = RunEngine({})
+    RE.subscribe(live)
+    RE(scan([detector], motor, 399.9, 402.1, 600))
+    result = live.wait(timeout=60)
+
+    assert live.estimates == estimates and len(estimates) >= 2
+    assert [e['points'] for e in estimates] == sorted(e['points'] for e in estimates)
+    assert estimates[-1]['points'] == 600
+    # the fits after the first one start from the previous solution
+    assert not estimates[0]['warm_start'] and estimates[-1]['warm_start']
+    assert result.sigma == pytest.approx(0.015, rel=0.02)
+    assert estimates[-1]['RP'] == pytest.approx(result.RP)
+    assert estimates[-1]['good_enough'] and live.good_enough
+    live.close()
+
+
+def test_live_fit_callback_filters_runs(n2_spectrum):
+
+    from bluesky import RunEngine
+    from bluesky.plans import count, scan
+    from ophyd.sim import SynAxis, SynSignal
+
+    motor, other = SynAxis(name='pgm_en'), SynAxis(name='m1_tx')
+    x, y = n2_spectrum(n=2000, sigma=0.015, gamma=0.03, noise=0.0005)
+    detector = SynSignal(func=lambda: np.interp(motor.readback.get(), x, y), name='kth01')
+    estimates = []
+    RE = RunEngine({})
+    callbacks = [N2FitCallback(N2_fit(None), motor='pgm_en', min_points=100, on_update=estimates.append,
+                               gamma=0.03, fix_param=True),
+                 N2FitCallback(N2_fit(None), min_points=100, on_update=estimates.append,
+                               predicate=lambda doc: doc.get('purpose') == 'N2', gamma=0.03, fix_param=True)]
+    for live in callbacks:
+        token = RE.subscribe(live)
+        # runs which are not N2 scans are ignored
+        RE(scan([detector], other, 0, 1, 150))
+        RE(count([detector], 150))
+        assert live.wait(timeout=60) is None and estimates == []
+        RE.unsubscribe(token)
+
+    # the predicate selects the runs tagged as N2 scans
+    RE.subscribe(live)
+    RE(scan([detector], motor, 399.9, 402.1, 150), purpose='N2')
+    assert live.wait(timeout=60) is not None and len(estimates) >= 1
+    for live in callbacks:
+        live.close()
+
+
+def test_live_fit_callback_does_not_wait_at_start(n2_spectrum):
+
+    from bluesky import RunEngine
+    from bluesky.plans import count, scan
+    from ophyd.sim import SynAxis, SynSignal
+
+    motor = SynAxis(name='pgm_en')
+    x, y = n2_spectrum(n=2000, sigma=0.015, gamma=0.03, noise=0.0005)
+    detector = SynSignal(func=lambda: np.interp(motor.readback.get(), x, y), name='kth01')
+    # the fits of the first run do not end before the second run starts
+    release = threading.Event()
+    live = N2FitCallback(N2_fit(None), min_points=100, on_update=lambda estimate: release.wait(timeout=30),
+                         gamma=0.03, fix_param=True)
+    RE = RunEngine({})
+    RE.subscribe(live)
+    RE(scan([detector], motor, 399.9, 402.1, 150))
+
+    t0 = time.monotonic()
+    RE(count([detector]))
+    assert time.monotonic() - t0 < 5
+    release.set()
+    # the results of the first run are dropped
+    assert live.wait(timeout=60) is None and live.estimates == []
+    live.close()
+    assert live.result is None and live.estimates == []
+
+
+def test_rp_map(tmp_path, n2, n2_spectrum, fake_run, grid_run):
+
+    sigmas = [[0.014, 0.018], [0.016, 0.02]]
+    db = {-2: grid_run([2.0, 4.0], [0.02, 0.05], sigmas)}
+    cache = N2FitCache(tmp_path/'cache.sqlite')
+    store = RPTrendStore(tmp_path/'trend.sqlite', config_keys=('cff', 'exit_slit'))
+    fit = N2_fit(db, cache=cache, trend=store)
+    rp_map = fit.rp_map(-2, 'cff', 'exit_slit', max_workers=2, progress=False, gamma=0.03, fix_param=True)
+
+    assert list(rp_map.x) == [2.0, 4.0] and list(rp_map.y) == [0.02, 0.05]
+    assert (rp_map.status == 'ok').all()
+    assert rp_map.sigma == pytest.approx(np.array(sigmas), rel=0.05)
+    assert rp_map.RP == pytest.approx(rp_map.center/(2*rp_map.sigma*np.sqrt(2*np.log(2))))
+    assert (rp_map.RP_err > 0).all() and (rp_map.RP_err < 0.05*rp_map.RP).all()
+    assert (rp_map.vp_ratio_err > 0).all() and (rp_map.vp_ratio_err < 0.05*rp_map.vp_ratio).all()
+    uid = db[-2].metadata['start']['uid']
+    assert rp_map.scans[1, 0] == f'{uid}[1,0]'
+    # the same cell alone gives the same fit
+    x, y = n2_spectrum(n=400, sigma=0.016, gamma=0.03, noise=0.0005, seed=10)
+    assert rp_map.RP[1, 0] == pytest.approx(n2.fit_spectrum(x, y, gamma=0.03, fix_param=True).RP)
+    assert sorted(zip(store.query()['cff'], store.query()['exit_slit'])) == [(2.0, 0.02), (2.0, 0.05), (4.0, 0.02),
+                                                                            (4.0, 0.05)]
+
+    # the grid is extended by another grid_scan and a single scan, only the new cells are fitted
+    db[-1] = grid_run([6.0], [0.02, 0.05], [[0.017, 0.021]])
+    db[0] = fake_run(*n2_spectrum(n=400, sigma=0.019, gamma=0.03, noise=0.0005, seed=5), cff=4.0, exit_slit=0.1)
+    reads = db[-2].reads
+    # a fit cached by fit_scan, before the valley/peak ratio has an uncertainty
+    fit.fit_scan(0, gamma=0.03, fix_param=True)
+    progress = []
+    extended = fit.rp_map([-2, -1, 0], 'cff', 'exit_slit', max_workers=2, gamma=0.03, fix_param=True,
+                          progress=lambda done, total, cell: progress.append((done, total)))
+    assert db[-2].reads == reads and db[0].reads == 1 and len(cache) == 7
+    assert progress == [(done, 7) for done in range(1, 8)]
+    assert list(extended.x) == [2.0, 4.0, 6.0] and list(extended.y) == [0.02, 0.05, 0.1]
+    assert np.array_equal(extended.RP[:2, :2], rp_map.RP)
+    assert extended.sigma[2, 1] == pytest.approx(0.021, rel=0.05)
+    assert extended.sigma[1, 2] == pytest.approx(0.019, rel=0.05) and extended.vp_ratio_err[1, 2] > 0
+    assert list(extended.status[:, 2]) == ['missing', 'ok', 'missing'] and np.isnan(extended.RP[0, 2])
+    assert extended.scans[1, 2] == 0
+
+    assert len(extended.plot().axes) == 4